@@ -0,0 +1,446 @@
+#!/usr/bin/env python3
+#
+# Electron Cash - lightweight Bitcoin Cash client
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+'''
+Compact binary encoding for the large per-transaction wallet keys
+('transactions', 'txi', 'txo' and 'addr_history').
+
+The journal storage engine (see storage.py) embeds one such "binary section"
+in unencrypted wallet files at compaction time. Instead of hex strings and
+address strings inside JSON, it stores raw transaction bytes, 32-byte txids,
+21-byte address keys (kind byte + hash160) and packed integers.
+
+Each key is stored as a sorted index of fixed-width entries followed by the
+encoded values, so the section can be memory-mapped and individual entries
+decoded on demand (see SectionMapping), rather than parsing everything at
+wallet open time.
+
+Layout (all integers little-endian, offsets relative to the section start):
+
+    header:  magic b'ECWB', u32 version, u32 number of tables
+    tables:  (u8 table id, 3 pad bytes, u32 count, u64 index offset) * n
+    values:  the encoded values, back to back
+    indexes: per table, sorted (key, u64 value offset, u32 value length)
+'''
+import copy
+import mmap
+import struct
+from collections.abc import ItemsView, Mapping, MutableMapping
+
+from .address import Address
+
+MAGIC = b'ECWB'
+VERSION = 1
+
+# The wallet storage keys that may live in a binary section, in table-id order
+SECTION_KEYS = ('transactions', 'txi', 'txo', 'addr_history')
+
+_header = struct.Struct('<4sII')
+_table = struct.Struct('<B3xIQ')
+_u32 = struct.Struct('<I')
+_txi_entry = struct.Struct('<32sIq')  # prevout_hash, prevout_n, value
+_txo_entry = struct.Struct('<Iq?')    # n, value, is_coinbase
+_hist_entry = struct.Struct('<32si')  # tx_hash, height
+
+
+class BinarySectionError(Exception):
+    ''' Raised when data cannot be represented in (or read from) a binary
+    section. Callers fall back to plain JSON for the key in question. '''
+
+
+# --- keys
+
+def _enc_txid(txid):
+    try:
+        b = bytes.fromhex(txid)
+    except (TypeError, ValueError) as e:
+        raise BinarySectionError('bad txid: {!r}'.format(txid)) from e
+    if len(b) != 32 or b.hex() != txid:
+        raise BinarySectionError('bad txid: {!r}'.format(txid))
+    return b
+
+def _dec_txid(b):
+    return bytes(b).hex()
+
+def _enc_addr(text):
+    try:
+        addr = Address.from_string(text)
+    except Exception as e:
+        raise BinarySectionError('bad address: {!r}'.format(text)) from e
+    if addr.to_storage_string() != text:
+        # not in canonical storage format, can't round-trip it
+        raise BinarySectionError('bad address: {!r}'.format(text))
+    return bytes([addr.kind]) + addr.hash160
+
+def _dec_addr(b):
+    return Address(bytes(b[1:]), b[0]).to_storage_string()
+
+# --- values
+
+def _enc_raw_tx(value):
+    try:
+        b = bytes.fromhex(value)
+    except (TypeError, ValueError) as e:
+        raise BinarySectionError('bad hex value') from e
+    if b.hex() != value:
+        raise BinarySectionError('non-canonical hex value')
+    return b
+
+def _dec_raw_tx(b):
+    return bytes(b).hex()
+
+def _enc_addr_groups(d, enc_entry):
+    ''' Encodes a {address: [entry, ...]} dict, as used by 'txi' and 'txo' '''
+    if not isinstance(d, Mapping):
+        raise BinarySectionError('expected a dict')
+    parts = [_u32.pack(len(d))]
+    for addr, entries in d.items():
+        parts.append(_enc_addr(addr))
+        parts.append(_u32.pack(len(entries)))
+        for entry in entries:
+            parts.append(enc_entry(entry))
+    return b''.join(parts)
+
+def _dec_addr_groups(b, dec_entry, entry_size):
+    d = {}
+    count, = _u32.unpack_from(b, 0)
+    pos = 4
+    for _ in range(count):
+        addr = _dec_addr(b[pos:pos+21])
+        n, = _u32.unpack_from(b, pos + 21)
+        pos += 25
+        l = []
+        for _ in range(n):
+            l.append(dec_entry(b, pos))
+            pos += entry_size
+        d[addr] = l
+    return d
+
+def _enc_txi_entry(entry):
+    ser, v = entry
+    prevout_hash, sep, n = ser.rpartition(':')
+    try:
+        packed = _txi_entry.pack(_enc_txid(prevout_hash), int(n), v)
+    except (ValueError, struct.error) as e:
+        raise BinarySectionError('bad txi entry') from e
+    if '{}:{}'.format(prevout_hash, int(n)) != ser:
+        raise BinarySectionError('non-canonical txi entry')
+    return packed
+
+def _dec_txi_entry(b, pos):
+    prevout_hash, n, v = _txi_entry.unpack_from(b, pos)
+    return ['{}:{}'.format(prevout_hash.hex(), n), v]
+
+def _enc_txo_entry(entry):
+    n, v, is_cb = entry
+    try:
+        return _txo_entry.pack(n, v, is_cb)
+    except struct.error as e:
+        raise BinarySectionError('bad txo entry') from e
+
+def _dec_txo_entry(b, pos):
+    return list(_txo_entry.unpack_from(b, pos))
+
+def _enc_history(hist):
+    parts = [_u32.pack(len(hist))]
+    for tx_hash, height in hist:
+        try:
+            parts.append(_hist_entry.pack(_enc_txid(tx_hash), height))
+        except struct.error as e:
+            raise BinarySectionError('bad history entry') from e
+    return b''.join(parts)
+
+def _dec_history(b):
+    count, = _u32.unpack_from(b, 0)
+    return [[tx_hash.hex(), height]
+            for tx_hash, height in _hist_entry.iter_unpack(b[4:4 + count * _hist_entry.size])]
+
+# table id -> (key size, key encoder, key decoder, value encoder, value decoder)
+_CODECS = {
+    0: (32, _enc_txid, _dec_txid, _enc_raw_tx, _dec_raw_tx),
+    1: (32, _enc_txid, _dec_txid,
+        lambda d: _enc_addr_groups(d, _enc_txi_entry),
+        lambda b: _dec_addr_groups(b, _dec_txi_entry, _txi_entry.size)),
+    2: (32, _enc_txid, _dec_txid,
+        lambda d: _enc_addr_groups(d, _enc_txo_entry),
+        lambda b: _dec_addr_groups(b, _dec_txo_entry, _txo_entry.size)),
+    3: (21, _enc_addr, _dec_addr, _enc_history, _dec_history),
+}
+
+
+def encode_table(key, d):
+    ''' Encodes the dict `d` stored under wallet storage key `key`. Returns a
+    list of (key bytes, value bytes) tuples, sorted by key. Raises
+    BinarySectionError if any item can't be represented. '''
+    table_id = SECTION_KEYS.index(key)
+    _, enc_key, _, enc_value, _ = _CODECS[table_id]
+    return sorted((enc_key(k), enc_value(v)) for k, v in d.items())
+
+
+def write_section(f, tables):
+    ''' Writes a binary section to the binary file object `f`, at its current
+    position. `tables` is a dict of storage key -> encoded table (as returned
+    by encode_table). Returns the number of bytes written. '''
+    table_ids = sorted(SECTION_KEYS.index(key) for key in tables)
+    start = f.tell()
+    pos = _header.size + _table.size * len(table_ids)
+    f.write(_header.pack(MAGIC, VERSION, len(table_ids)))
+    f.write(b'\0' * _table.size * len(table_ids))
+    table_entries, indexes = [], []
+    for table_id in table_ids:
+        index = []
+        for kb, vb in tables[SECTION_KEYS[table_id]]:
+            index.append(kb + struct.pack('<QI', pos, len(vb)))
+            f.write(vb)
+            pos += len(vb)
+        indexes.append(index)
+    for table_id, index in zip(table_ids, indexes):
+        table_entries.append(_table.pack(table_id, len(index), pos))
+        for entry in index:
+            f.write(entry)
+            pos += len(entry)
+    end = f.tell()
+    f.seek(start + _header.size)
+    f.write(b''.join(table_entries))
+    f.seek(end)
+    assert end - start == pos
+    return pos
+
+
+class BinarySection:
+    ''' A read-only, memory-mapped binary section living at `offset` in the
+    file `path`. Use `table(key)` to get a lazily decoding Mapping for one of
+    the SECTION_KEYS. '''
+
+    def __init__(self, path, offset, length):
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self.buf = memoryview(self.mm)[offset:offset + length]
+            if len(self.buf) != length:
+                raise BinarySectionError('truncated binary section')
+            magic, version, ntables = _header.unpack_from(self.buf, 0)
+            if magic != MAGIC:
+                raise BinarySectionError('bad binary section magic')
+            if version != VERSION:
+                raise BinarySectionError('unsupported binary section version {}'.format(version))
+            self.tables = {}
+            for i in range(ntables):
+                table_id, count, index_offset = _table.unpack_from(self.buf, _header.size + i * _table.size)
+                if table_id not in _CODECS:
+                    raise BinarySectionError('unknown table id {}'.format(table_id))
+                self.tables[SECTION_KEYS[table_id]] = SectionMapping(self.buf, table_id, count, index_offset)
+        except Exception:
+            self.close()
+            raise
+
+    def table(self, key):
+        return self.tables.get(key)
+
+    def close(self):
+        buf, self.buf = getattr(self, 'buf', None), None
+        if buf is not None:
+            for t in getattr(self, 'tables', {}).values():
+                t.release()
+            buf.release()
+        self.mm.close()
+
+
+class _ItemsView(ItemsView):
+    def __iter__(self):
+        return self._mapping.iter_items()
+
+
+class SectionMapping(Mapping):
+    ''' Read-only view of one table of a BinarySection. Lookups binary-search
+    the fixed-width index; values are decoded on each access. '''
+
+    def __init__(self, buf, table_id, count, index_offset):
+        self.ksize, self.enc_key, self.dec_key, _, self.dec_value = _CODECS[table_id]
+        self.esize = self.ksize + 12
+        self.count = count
+        self.index = buf[index_offset:index_offset + count * self.esize]
+        self.buf = buf
+        if len(self.index) != count * self.esize:
+            raise BinarySectionError('truncated binary section index')
+
+    def release(self):
+        self.index.release()
+        self.buf = None
+
+    def _key_at(self, i):
+        p = i * self.esize
+        return bytes(self.index[p:p + self.ksize])
+
+    def _find(self, kb):
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key_at(mid) < kb:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.count and self._key_at(lo) == kb:
+            return lo
+        return None
+
+    def _value_at(self, i):
+        off, length = struct.unpack_from('<QI', self.index, i * self.esize + self.ksize)
+        return self.dec_value(self.buf[off:off + length])
+
+    def __getitem__(self, key):
+        try:
+            i = self._find(self.enc_key(key))
+        except BinarySectionError:
+            i = None
+        if i is None:
+            raise KeyError(key)
+        return self._value_at(i)
+
+    def __contains__(self, key):
+        try:
+            return self._find(self.enc_key(key)) is not None
+        except BinarySectionError:
+            return False
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self.dec_key(self._key_at(i))
+
+    def __len__(self):
+        return self.count
+
+    def iter_items(self):
+        for i in range(self.count):
+            yield self.dec_key(self._key_at(i)), self._value_at(i)
+
+    def items(self):
+        # decode each key once, rather than iterating and then looking up
+        return _ItemsView(self)
+
+    def encoded_items(self):
+        ''' Yields (key bytes, value bytes) pairs without decoding them, for
+        fast re-encoding of unchanged entries at compaction time. '''
+        for i in range(self.count):
+            p = i * self.esize
+            off, length = struct.unpack_from('<QI', self.index, p + self.ksize)
+            yield bytes(self.index[p:p + self.ksize]), bytes(self.buf[off:off + length])
+
+
+class DictTable(dict):
+    ''' An in-memory stand-in for a SectionMapping, for LazyDicts that had
+    to be detached from their BinarySection (see LazyDict.detach). '''
+
+    def iter_items(self):
+        return iter(list(self.items()))
+
+
+class LazyDict(MutableMapping):
+    ''' A dict-like object layered on top of a (read-only) SectionMapping.
+    Writes and deletions go to an in-memory overlay. '''
+
+    def __init__(self, base):
+        self.base = base
+        self.overlay = {}
+        self.deleted = set()
+
+    def __getitem__(self, key):
+        if key in self.overlay:
+            return self.overlay[key]
+        if key in self.deleted:
+            raise KeyError(key)
+        return self.base[key]
+
+    def __setitem__(self, key, value):
+        self.overlay[key] = value
+        self.deleted.discard(key)
+
+    def __delitem__(self, key):
+        if key in self.overlay:
+            del self.overlay[key]
+            if key in self.base:
+                self.deleted.add(key)
+        elif key in self.base and key not in self.deleted:
+            self.deleted.add(key)
+        else:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self.overlay or (key not in self.deleted and key in self.base)
+
+    def __iter__(self):
+        for key in self.base:
+            if key not in self.deleted and key not in self.overlay:
+                yield key
+        yield from self.overlay
+
+    def __len__(self):
+        shadowed = sum(1 for key in self.overlay if key in self.base)
+        return len(self.base) - len(self.deleted) + len(self.overlay) - shadowed
+
+    def iter_items(self):
+        for key, value in self.base.iter_items():
+            if key not in self.deleted and key not in self.overlay:
+                yield key, value
+        yield from self.overlay.items()
+
+    def items(self):
+        return _ItemsView(self)
+
+    def __deepcopy__(self, memo):
+        # values decoded from the base are fresh objects already, so only
+        # the overlay needs copying
+        d = {}
+        for key, value in self.base.iter_items():
+            if key not in self.deleted and key not in self.overlay:
+                d[key] = value
+        d.update(copy.deepcopy(self.overlay, memo))
+        return d
+
+    def copy(self):
+        return dict(self.iter_items())
+
+    def encode(self, key):
+        ''' Like encode_table(key, self), but copies unchanged base entries
+        across without decoding and re-encoding them. '''
+        if not isinstance(self.base, SectionMapping):
+            return encode_table(key, self)
+        _, enc_key, _, enc_value, _ = _CODECS[SECTION_KEYS.index(key)]
+        changed = self.deleted | set(self.overlay)
+        changed_kb = {enc_key(k) for k in changed if k in self.base}
+        ret = [(kb, vb) for kb, vb in self.base.encoded_items() if kb not in changed_kb]
+        ret.extend((enc_key(k), enc_value(v)) for k, v in self.overlay.items())
+        ret.sort()
+        return ret
+
+    def rebase(self, base):
+        ''' Called after compaction, once `base` holds everything this object
+        holds. '''
+        self.base = base
+        self.overlay = {}
+        self.deleted = set()
+
+    def detach(self):
+        ''' Moves everything into memory, so that the BinarySection the base
+        belongs to can be closed. '''
+        self.rebase(DictTable(self.iter_items()))
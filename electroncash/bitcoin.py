@@ -39,7 +39,7 @@ from . import networks
 from .util import (bfh, bh2u, to_string, print_error, InvalidPassword,
                    assert_bytes, to_bytes, inv_dict, profiler)
 from . import version
-from .ecc_fast import do_monkey_patching_of_python_ecdsa_internals_with_libsecp256k1
+from .ecc_fast import do_monkey_patching_of_python_ecdsa_internals_with_libsecp256k1, pubkey_tweak_add
 
 # Ensure Python interpreter is not running with -O, since this entire
 # codebase depends on "assert" not being a no-op.
@@ -775,12 +775,15 @@ def CKD_pub(cK, c, n):
 
 # helper function, callable with arbitrary string
 def _CKD_pub(cK, c, s):
-    order = generator_secp256k1.order()
     I = hmac.new(c, cK + s, hashlib.sha512).digest()
+    c_n = I[32:]
+    # fast path: a single tweak-add in libsecp256k1
+    cK_n = pubkey_tweak_add(cK, I[0:32])
+    if cK_n is not None:
+        return cK_n, c_n
     curve = SECP256k1
     pubkey_point = string_to_number(I[0:32])*curve.generator + ser_to_point(cK)
     public_key = ecdsa.VerifyingKey.from_public_point( pubkey_point, curve = SECP256k1 )
-    c_n = I[32:]
     cK_n = GetPubKey(public_key.pubkey,True)
     return cK_n, c_n
 
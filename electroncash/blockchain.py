@@ -21,9 +21,11 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import mmap
 import os
 import sys
 import threading
+from collections import OrderedDict
 
 from typing import Optional
 
@@ -208,6 +210,13 @@ class Blockchain(util.PrintError):
         self.parent_base_height = parent_base_height
 
         self.lock = threading.Lock()
+        # Headers are read through a read-only mmap of the headers file, and
+        # the recently read ones (and their hashes) are cached. All of these
+        # are guarded by self.lock, and reset whenever the file is written.
+        self._mmap = None
+        self._header_cache = OrderedDict()  # height -> header dict
+        self._hash_cache = OrderedDict()  # height -> header hash hex
+        self._cache_gen = 0  # bumped when the caches are reset
         with self.lock:
             self.update_size()
 
@@ -275,15 +284,31 @@ class Blockchain(util.PrintError):
             if int('0x' + this_header_hash, 16) > target:
                 raise VerifyError("insufficient proof of work: %s vs target %s" % (int('0x' + this_header_hash, 16), target))
 
-    def verify_chunk(self, chunk_base_height, chunk_data):
-        chunk = HeaderChunk(chunk_base_height, chunk_data)
+    # number of headers below a chunk that are needed to verify it, once the
+    # ASERT DAA is active (see can_verify_detached)
+    MTP_SPAN = 11
+
+    def can_verify_detached(self, chunk_base_height):
+        ''' Returns True if a chunk can be verified given only the MTP_SPAN
+        headers below it, without reading any saved headers. That is the
+        case once the ASERT DAA is active and its anchor block is known, and
+        means it can be verified in another thread, even before the headers
+        below it are saved. '''
+        anchor = networks.net.asert_daa.anchor or self._cached_asert_anchor
+        return anchor is not None and chunk_base_height - self.MTP_SPAN > anchor.height
+
+    def verify_chunk(self, chunk_base_height, chunk_data, prev_data=b''):
+        ''' Raises VerifyError if the chunk doesn't verify. prev_data may hold
+        headers right below the chunk that are not saved (yet). '''
+        prev_count = len(prev_data) // HEADER_SIZE
+        chunk = HeaderChunk(chunk_base_height - prev_count, prev_data + chunk_data)
 
         prev_header = None
         if chunk_base_height != 0:
-            prev_header = self.read_header(chunk_base_height - 1)
+            prev_header = self.read_header(chunk_base_height - 1, chunk)
 
         header_count = len(chunk_data) // HEADER_SIZE
-        for i in range(header_count):
+        for i in range(prev_count, prev_count + header_count):
             header = chunk.get_header_at_index(i)
             # Check the chain of hashes and the difficulty.
             bits = self.get_bits(header, chunk)
@@ -324,9 +349,11 @@ class Blockchain(util.PrintError):
             parent_data = f.read(parent_branch_size*HEADER_SIZE)
         self.write(parent_data, 0)
         parent.write(my_data, (base_height - parent.base_height)*HEADER_SIZE)
-        # store file path
+        # store file path, and unmap the files that may get renamed
         for b in blockchains.values():
             b.old_path = b.path()
+            with b.lock:
+                b.reset_cache()
         # swap parameters
         self.parent_base_height = parent.parent_base_height; parent.parent_base_height = parent_base_height
         self.base_height = parent.base_height; parent.base_height = base_height
@@ -342,8 +369,13 @@ class Blockchain(util.PrintError):
         blockchains[parent.base_height] = parent
 
     def write(self, data, offset, truncate=True):
+        ''' Writes (and fsyncs) the serialized headers in `data` at byte
+        offset `offset` in the file, truncating the file after them unless
+        told otherwise. Write whole chunks at once where possible. '''
         filename = self.path()
         with self.lock:
+            # (the file can't be truncated while mapped on Windows)
+            self.reset_cache(self.base_height + offset // HEADER_SIZE)
             with open(filename, 'rb+') as f:
                 if truncate and offset != self._size*HEADER_SIZE:
                     f.seek(offset)
@@ -362,6 +394,49 @@ class Blockchain(util.PrintError):
         self.write(data, delta*HEADER_SIZE)
         self.swap_with_parent()
 
+    def reset_cache(self, from_height=None):
+        ''' Unmaps the file and forgets the cached headers (from from_height
+        on, if specified). Needs self.lock. '''
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        for cache in (self._header_cache, self._hash_cache):
+            if from_height is None:
+                cache.clear()
+            else:
+                for height in [h for h in cache if h >= from_height]:
+                    del cache[height]
+        self._cache_gen += 1
+
+    HEADER_CACHE_SIZE = 4096  # number of headers (and hashes) kept in memory
+
+    def _read_header(self, height):
+        ''' Returns the saved header at `height` (which must be in this
+        branch), or None. Needs self.lock. The returned dict is shared. '''
+        header = self._header_cache.get(height)
+        if header is not None:
+            self._header_cache.move_to_end(height)
+            return header
+        if self._mmap is None or len(self._mmap) < self._size * HEADER_SIZE:
+            # (re)map the file, it grew
+            if self._mmap is not None:
+                self._mmap.close()
+                self._mmap = None
+            if not self._size:
+                return None
+            with open(self.path(), 'rb') as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        offset = (height - self.base_height) * HEADER_SIZE
+        h = self._mmap[offset : offset + HEADER_SIZE]
+        # Is it a pre-checkpoint header that has never been requested?
+        if len(h) < HEADER_SIZE or h == NULL_HEADER:
+            return None
+        header = deserialize_header(h, height)
+        self._header_cache[height] = header
+        if len(self._header_cache) > self.HEADER_CACHE_SIZE:
+            self._header_cache.popitem(last=False)
+        return header
+
     def read_header(self, height, chunk=None):
         # If the read is done within an outer call with local unstored header data, we first look in the chunk data currently being processed.
         if chunk is not None and chunk.contains_height(height):
@@ -374,23 +449,32 @@ class Blockchain(util.PrintError):
             return self.parent().read_header(height)
         if height > self.height():
             return
-        delta = height - self.base_height
-        name = self.path()
-        if os.path.exists(name):
-            with open(name, 'rb') as f:
-                f.seek(delta * HEADER_SIZE)
-                h = f.read(HEADER_SIZE)
-            # Is it a pre-checkpoint header that has never been requested?
-            if h == NULL_HEADER:
-                return None
-            return deserialize_header(h, height)
+        with self.lock:
+            header = self._read_header(height)
+        # callers get their own copy
+        return header and dict(header)
 
     def get_hash(self, height):
         if height == -1:
             return NULL_HASH_HEX
         elif height == 0:
             return networks.net.GENESIS
-        return hash_header(self.read_header(height))
+        elif height < self.base_height:
+            return self.parent().get_hash(height)
+        with self.lock:
+            ret = self._hash_cache.get(height)
+            if ret is not None:
+                self._hash_cache.move_to_end(height)
+            gen = self._cache_gen
+        if ret is None:
+            ret = hash_header(self.read_header(height))
+            if ret != NULL_HASH_HEX:
+                with self.lock:
+                    if gen == self._cache_gen:  # else the file changed meanwhile
+                        self._hash_cache[height] = ret
+                        if len(self._hash_cache) > self.HEADER_CACHE_SIZE:
+                            self._hash_cache.popitem(last=False)
+        return ret
 
     # Not used.
     def BIP9(self, height, flag):
@@ -5,11 +5,13 @@
 # This file Copyright (C) 2019 Calin Culianu <calin.culianu@gmail.com>
 # License: MIT License
 #
+import hashlib
 import time
 import threading
 import queue
 import weakref
 import math
+import os
 from collections import defaultdict
 from .util import PrintError, print_error
 
@@ -257,6 +259,136 @@ class _ExpiringCacheMgr(PrintError):
         return ct
 
 
+class RawTxDiskCache(PrintError):
+    ''' A persistent cache of raw transactions, keyed by txid, so that
+    transactions fetched from the network (eg prevouts for the Transaction
+    dialog) need not be fetched again the next time they are needed.
+
+    Each tx lives in its own file under `path`, in a subdirectory named
+    after the first 2 hex digits of its txid. Writes and pruning happen in a
+    background thread so that put() never blocks on the disk (it is called
+    from the network thread). The cache is kept below `max_bytes` by
+    deleting the least recently written files first. '''
+
+    def __init__(self, path, *, max_bytes=64 * 1024 * 1024):
+        super().__init__()
+        self.path = path
+        self.max_bytes = max_bytes
+        self.size = None  # total bytes on disk; unknown until the first prune
+        self.pending = {}  # txid -> raw bytes, not yet written
+        self.q = queue.Queue()
+        self.q.put(None)  # prune (and measure) at startup
+        self.thread = threading.Thread(target=self._writer_thread, daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def _valid_txid(txid):
+        return isinstance(txid, str) and len(txid) == 64 and all(c in '0123456789abcdef' for c in txid)
+
+    def _file(self, txid):
+        return os.path.join(self.path, txid[:2], txid)
+
+    def get(self, txid):
+        ''' Returns the raw tx bytes for txid, or None if not cached. '''
+        if not self._valid_txid(txid):
+            return None
+        raw = self.pending.get(txid)
+        if raw is not None:
+            return raw
+        fn = self._file(txid)
+        try:
+            with open(fn, 'rb') as f:
+                raw = f.read()
+        except OSError:
+            return None
+        if self._txid(raw) != txid:
+            # truncated or corrupt; serving it would make the tx unobtainable
+            self.print_error("bad file for", txid, "removing")
+            self.discard(txid)
+            return None
+        return raw
+
+    @staticmethod
+    def _txid(raw):
+        return hashlib.sha256(hashlib.sha256(raw).digest()).digest()[::-1].hex()
+
+    def discard(self, txid):
+        ''' Removes txid from the cache, if it's there. '''
+        if not self._valid_txid(txid):
+            return
+        self.pending.pop(txid, None)
+        try:
+            os.remove(self._file(txid))
+        except OSError:
+            pass
+
+    def put(self, txid, raw):
+        ''' Queues raw tx bytes to be written to disk. '''
+        if not self._valid_txid(txid) or txid in self.pending:
+            return
+        self.pending[txid] = raw
+        self.q.put(txid)
+
+    def _write(self, txid):
+        raw = self.pending.get(txid)
+        fn = self._file(txid)
+        try:
+            if raw is None or os.path.exists(fn):
+                return
+            os.makedirs(os.path.dirname(fn), exist_ok=True)
+            tmp = fn + '.tmp'
+            with open(tmp, 'wb') as f:
+                f.write(raw)
+            os.replace(tmp, fn)
+            if self.size is not None:
+                self.size += len(raw)
+        except OSError as e:
+            self.print_error("failed to write", txid, repr(e))
+        finally:
+            self.pending.pop(txid, None)
+
+    def prune(self):
+        ''' Measures the cache and deletes the oldest files until it is below
+        max_bytes. '''
+        files = []
+        try:
+            for d in os.scandir(self.path):
+                if d.is_dir():
+                    for e in os.scandir(d.path):
+                        st = e.stat()
+                        files.append((st.st_mtime, st.st_size, e.path))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            self.print_error("failed to scan", self.path, repr(e))
+        size = sum(f[1] for f in files)
+        if size > self.max_bytes:
+            files.sort()
+            target, ct = self.max_bytes * 3 // 4, 0
+            for _mtime, fsize, fn in files:
+                if size <= target:
+                    break
+                try:
+                    os.remove(fn)
+                except OSError:
+                    continue
+                size -= fsize
+                ct += 1
+            self.print_error(f"pruned {ct} files")
+        self.size = size
+
+    def _writer_thread(self):
+        while True:
+            txid = self.q.get()
+            if txid is None:
+                self.prune()
+                continue
+            self._write(txid)
+            if self.size is not None and self.size > self.max_bytes:
+                self.size = None
+                self.q.put(None)
+
+
 def get_object_size(obj_0):
     ''' Debug tool -- returns the amount of memory taken by an object in bytes
     by deeply examining its contents recursively (more accurate than
@@ -843,6 +843,7 @@ class CashAcct(util.PrintError, verifier.SPVDelegate):
         self.v_tx = dict() # dict of txid -> VerifTx
         self.v_by_addr = defaultdict(set) # dict of addr -> set of txid
         self.v_by_name = defaultdict(set) # dict of lowercased name -> set of txid
+        self.v_by_height = util.HeightIndex() # the txids in v_tx, by block_height
 
         self.ext_unverif = dict()  # ephemeral (not saved) dict of txid -> block_height. This is however re-computed in load() (TODO: see if this should not be the case)
 
@@ -1617,6 +1618,7 @@ class CashAcct(util.PrintError, verifier.SPVDelegate):
     def _add_vtx(self, vtx, script):
         ''' lock should be held by caller '''
         self.v_tx[vtx.txid] = vtx
+        self.v_by_height.add(vtx.txid, vtx.block_height)
         self.v_by_addr[script.address].add(vtx.txid)
         self.v_by_name[script.name.lower()].add(vtx.txid)
 
@@ -1627,6 +1629,7 @@ class CashAcct(util.PrintError, verifier.SPVDelegate):
             # was not relevant, abort early
             return
         assert txid == vtx.txid
+        self.v_by_height.discard(txid)
         script = self._find_script(txid, print_if_missing=not force)  # will print_error if script not found
         if script:
             addr, name = script.address, script.name.lower()
@@ -1845,16 +1848,16 @@ class CashAcct(util.PrintError, verifier.SPVDelegate):
         verifications when a reorg has happened. Returns a set of tx_hash. '''
         txs = set()
         with self.lock:
-            for txid, vtx in self.v_tx.copy().items():
+            for txid in self.v_by_height.keys_from(height):
                 if txid in self.wallet_reg_tx:
                     # wallet verifier will take care of this one
                     continue
-                if vtx.block_height >= height:
-                    header = bchain.read_header(vtx.block_height)
-                    if not header or vtx.block_hash != blockchain.hash_header(header):
-                        self._rm_vtx(txid)
-                        self.ext_unverif[txid] = vtx.block_height  # re-enqueue for verification with private verifier...? TODO: how to detect tx's dropped out of new chain?
-                        txs.add(txid)
+                vtx = self.v_tx[txid]
+                header = bchain.read_header(vtx.block_height)
+                if not header or vtx.block_hash != blockchain.hash_header(header):
+                    self._rm_vtx(txid)
+                    self.ext_unverif[txid] = vtx.block_height  # re-enqueue for verification with private verifier...? TODO: how to detect tx's dropped out of new chain?
+                    txs.add(txid)
         return txs
 
     def verification_failed(self, tx_hash, reason):
@@ -439,6 +439,12 @@ class Commands:
         """Return the list of available servers"""
         return self.network.get_servers()
 
+    @command('n')
+    def getjobstats(self):
+        """Return how often, and for how long, each job of the network thread
+        has run (times are in seconds)"""
+        return self.network.get_job_stats()
+
     @command('')
     def version(self):
         """Return the version of Electron Cash."""
@@ -578,7 +584,8 @@ class Commands:
         return tx.as_dict()
 
     @command('w')
-    def history(self, year=0, show_addresses=False, show_fiat=False, use_net=False, timeout=30.0):
+    def history(self, year=0, show_addresses=False, show_fiat=False, use_net=False, timeout=30.0,
+                limit=None, cursor=None):
         """Wallet history. Returns the transaction history of your wallet."""
         t0 = time.time()
         year, show_addresses, show_fiat, use_net, timeout = (
@@ -587,7 +594,11 @@ class Commands:
         def time_remaining(): return max(timeout - (time.time()-t0), 0)
         kwargs = { 'show_addresses'   : show_addresses,
                    'fee_calc_timeout' : timeout,
-                   'download_inputs'  : use_net,        }
+                   'download_inputs'  : use_net,
+                   'limit'            : None if limit is None else int(limit), }
+        if cursor:
+            timestamp, _sep, txid = str(cursor).partition(':')
+            kwargs['cursor'] = (float(timestamp), txid)
         if year:
             start_date = datetime.datetime(year, 1, 1)
             end_date = datetime.datetime(year+1, 1, 1)
@@ -865,6 +876,7 @@ command_options = {
     'addtransaction': (None, 'Whether transaction is to be used for broadcasting afterwards. Adds transaction to the wallet'),
     'balance':     ("-b", "Show the balances of listed addresses"),
     'change':      (None, "Show only change addresses"),
+    'cursor':      (None, "Resume a history listing after the given item. Format is <timestamp>:<txid>, taken from the last item previously returned."),
     'change_addr': ("-c", "Change address. Default is a spare address, or the source address if it's not in the wallet"),
     'domain':      ("-D", "List of addresses"),
     'encrypt_file':(None, "Whether the file on disk should be encrypted with the provided password"),
@@ -880,6 +892,7 @@ command_options = {
     'index_url':   (None, 'Override the URL where you would like users to be shown the BIP70 Payment Request'),
     'labels':      ("-l", "Show the labels of listed addresses"),
     'language':    ("-L", "Default language for wordlist"),
+    'limit':       (None, "Maximum number of items to return"),
     'locktime':    (None, "Set locktime block number"),
     'memo':        ("-m", "Description of the request"),
     'nbits':       (None, "Number of bits of entropy"),
@@ -914,6 +927,7 @@ arg_types = {
     'num': int,
     'nbits': int,
     'imax': int,
+    'limit': int,
     'year': int,
     'entropy': int,
     'tx': tx_from_str,
@@ -271,6 +271,7 @@ class Daemon(DaemonThread):
             return
         if storage.get_action():
             return
+        self.maybe_convert_storage(storage)
         wallet = Wallet(storage)
         wallet.start_threads(self.network)
         self.wallets[path] = wallet
@@ -278,8 +279,17 @@ class Daemon(DaemonThread):
 
     def add_wallet(self, wallet):
         path = wallet.storage.path
+        self.maybe_convert_storage(wallet.storage)
         self.wallets[path] = wallet
 
+    def maybe_convert_storage(self, storage):
+        ''' If the user enabled the 'wallet_storage_journal' config option,
+        migrate the wallet file to the append-only journal format (which only
+        writes what changed on each save, rather than rewriting the whole
+        file). '''
+        if self.config.get('wallet_storage_journal', False) and not storage.is_journal():
+            storage.convert_to_journal()
+
     def get_wallet(self, path):
         return self.wallets.get(path)
 
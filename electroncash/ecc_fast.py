@@ -139,4 +139,65 @@ def is_using_fast_ecc():
     return _patched_functions.monkey_patching_active
 
 
+def ecdsa_verify_batch(items):
+    ''' Verifies a list of (pubkey, DER signature, msghash) bytes triples
+    with libsecp256k1, parsing each distinct pubkey only once. Returns a list
+    of bools, or None if libsecp256k1 is not in use. Signatures are decoded
+    and normalized like the patched python-ecdsa verify() does. '''
+    if not is_using_fast_ecc():
+        return None
+    lib = secp256k1.secp256k1
+    curve_order = ecdsa.curves.SECP256k1.order
+    parsed = {}  # pubkey -> parsed pubkey buffer, or None if it doesn't parse
+    sig = create_string_buffer(64)
+    results = []
+    for pubkey, der_sig, msghash in items:
+        if pubkey in parsed:
+            pk = parsed[pubkey]
+        else:
+            pk = create_string_buffer(64)
+            if not lib.secp256k1_ec_pubkey_parse(lib.ctx, pk, pubkey, len(pubkey)):
+                pk = None
+            parsed[pubkey] = pk
+        try:
+            r, s = ecdsa.util.sigdecode_der(der_sig, curve_order)
+        except Exception:
+            r = None
+        else:
+            # DER allows integers wider than 256 bits, which to_bytes() can't fit
+            if not (0 < r < curve_order and 0 < s < curve_order):
+                r = None
+        if (pk is None or r is None or len(msghash) != 32
+                or not lib.secp256k1_ecdsa_signature_parse_compact(
+                    lib.ctx, sig, int(r).to_bytes(32, 'big') + int(s).to_bytes(32, 'big'))):
+            results.append(False)
+            continue
+        lib.secp256k1_ecdsa_signature_normalize(lib.ctx, sig, sig)
+        results.append(1 == lib.secp256k1_ecdsa_verify(lib.ctx, sig, msghash, pk))
+    return results
+
+
+def pubkey_tweak_add(pubkey_ser, tweak):
+    ''' Returns the compressed serialization of the point pubkey + tweak*G,
+    where pubkey_ser is a serialized public key and tweak 32 bytes (big
+    endian). Returns None if libsecp256k1 is not in use, or if the tweak or
+    the result is invalid, in which case the caller should fall back to
+    python-ecdsa. '''
+    if not is_using_fast_ecc():
+        return None
+    pubkey = create_string_buffer(64)
+    r = secp256k1.secp256k1.secp256k1_ec_pubkey_parse(
+        secp256k1.secp256k1.ctx, pubkey, pubkey_ser, len(pubkey_ser))
+    if not r:
+        return None
+    r = secp256k1.secp256k1.secp256k1_ec_pubkey_tweak_add(secp256k1.secp256k1.ctx, pubkey, tweak)
+    if not r:
+        return None
+    pubkey_serialized = create_string_buffer(33)
+    pubkey_size = c_size_t(33)
+    secp256k1.secp256k1.secp256k1_ec_pubkey_serialize(
+        secp256k1.secp256k1.ctx, pubkey_serialized, byref(pubkey_size), pubkey, secp256k1.SECP256K1_EC_COMPRESSED)
+    return bytes(pubkey_serialized)
+
+
 _prepare_monkey_patching_of_python_ecdsa_internals_with_libsecp256k1()
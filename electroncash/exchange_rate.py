@@ -352,9 +352,11 @@ class FxThread(ThreadJob):
             rounded_amount = amount
         return fmt_str.format(rounded_amount)
 
+    run_interval = 5.0  # see ThreadJob
+
     def run(self):
-        """This runs from the Network thread. It is invoked roughly every
-        100ms (see network.py), with actual work being done every 2.5 minutes."""
+        """This runs from the Network thread. It is invoked every few seconds
+        (see run_interval), with actual work being done every 2.5 minutes."""
         if self.is_enabled():
             if self.timeout <= time.time():
                 self.exchange.update(self.ccy)
@@ -409,6 +411,7 @@ class FxThread(ThreadJob):
         if self.get_currency() != ccy:
             self.config.set_key('currency', ccy, True)
         self.timeout = 0  # Force update because self.ccy changes
+        self.wakeup()
         self.on_quotes()
 
     def set_exchange(self, name):
@@ -429,6 +432,7 @@ class FxThread(ThreadJob):
         # A new exchange means new fx quotes, initially empty.
         # This forces a quote refresh, which will happen in the Network thread.
         self.timeout = 0
+        self.wakeup()
 
     def on_quotes(self):
         if self.network:
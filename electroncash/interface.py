@@ -323,6 +323,16 @@ class Interface(util.PrintError):
         self.unsent_requests = []
         self.unanswered_requests = {}
         self.last_send = time.time()
+        # JSON-RPC batching (see send_requests). The batch size starts out at
+        # the configured chunk size and adapts to the measured round trip time.
+        self.use_batches = bool(config.get('network_batch_requests', True)) if config else True
+        self.batch_size = self.get_req_throttle_params(config).chunkSize
+        self.batch_max = self.BATCH_MAX  # lowered when the server rejects a batch
+        self.batches_in_flight = {}  # first wire id -> (time sent, wire ids)
+        # for scoring the server, see score()
+        self.rtt = None  # moving average of the round trip time, in seconds
+        self.num_responses = 0
+        self.num_errors = 0
 
         self.mode = None
 
@@ -382,14 +392,63 @@ class Interface(util.PrintError):
             l[1] = chunkSize
         config.set_key("network_unanswered_requests_throttle", l)
 
+    BATCH_MIN = 10
+    BATCH_MAX = 1000
+    BATCH_TARGET_RTT = 1.0  # seconds
+
     def num_requests(self):
         """If there are more than tup.max (default: 2000) unanswered requests,
         don't send any more. Otherwise send more requests, but not more than tup.chunkSize
-        (default: 100) at a time."""
+        (default: 100) at a time, or when batching, not more than the current
+        batch size."""
         tup = self.get_req_throttle_params(self.config)
         if len(self.unanswered_requests) >= tup.max:
             return 0
-        return min(tup.chunkSize, len(self.unsent_requests))
+        chunk = self.batch_size if self.use_batches else tup.chunkSize
+        return min(chunk, tup.max - len(self.unanswered_requests), len(self.unsent_requests))
+
+    def on_batch_response(self, sent_time, count, nbytes):
+        """Updates the round trip time estimate, and adapts the batch size
+        to it: full batches that come back quickly double it, slow ones halve
+        it. The expected size of a reply is also kept well below the message
+        size limit."""
+        rtt = time.time() - sent_time
+        self.rtt = rtt if self.rtt is None else 0.8 * self.rtt + 0.2 * rtt
+        if count < 2:
+            return
+        size = self.batch_size
+        if rtt < self.BATCH_TARGET_RTT:
+            if count >= size:
+                size *= 2
+        elif rtt > 2 * self.BATCH_TARGET_RTT:
+            size //= 2
+        max_bytes = self.pipe.max_message_bytes
+        if max_bytes > 0:
+            size = min(size, max_bytes // 4 // max(nbytes // count, 1))
+        tup = self.get_req_throttle_params(self.config)
+        self.batch_size = max(self.BATCH_MIN, min(size, self.batch_max, tup.max))
+
+    def on_batch_error(self, first_id):
+        """The server rejected a whole batch, answering it with a single
+        error with no id (Fulcrum does this for batches larger than its
+        max_batch). Lowers the batch size limit for this server, or stops
+        batching once batches can't get any smaller, and queues the batch's
+        requests to be sent again."""
+        sent_time, wire_ids = self.batches_in_flight.pop(first_id)
+        if len(wire_ids) > self.BATCH_MIN:
+            self.batch_max = max(self.BATCH_MIN, len(wire_ids) // 2)
+            self.batch_size = min(self.batch_size, self.batch_max)
+        else:
+            self.use_batches = False
+        requests = [self.unanswered_requests.pop(wire_id) for wire_id in wire_ids
+                    if wire_id in self.unanswered_requests]
+        self.unsent_requests[0:0] = requests
+
+    def score(self):
+        """Lower is better. Combines the measured round trip time with the
+        rate of error responses; used to spread requests over servers."""
+        rtt = self.BATCH_TARGET_RTT if self.rtt is None else self.rtt
+        return rtt * (1.0 + 10.0 * self.num_errors / (self.num_responses + 1))
 
     def send_requests(self):
         """Sends queued requests. Returns False on failure."""
@@ -405,8 +464,20 @@ class Interface(util.PrintError):
             make_dict = lambda m, p, i: {'method': m, 'params': p, 'id': i}
             n = self.num_requests()
             wire_requests = self.unsent_requests[0:n]
-
-            self.pipe.send_all([make_dict(*r) for r in wire_requests])
+            messages = [make_dict(*r) for r in wire_requests]
+
+            if n and (n == 1 or self.use_batches):
+                # single requests are timed too
+                if len(self.batches_in_flight) >= 1000:
+                    # forget the oldest one; a misbehaving server never answered it
+                    del self.batches_in_flight[min(self.batches_in_flight)]
+                self.batches_in_flight[wire_requests[0][2]] = (self.last_send, [r[2] for r in wire_requests])
+            if self.use_batches and n > 1:
+                # send them as a single JSON-RPC batch (a JSON array), which
+                # the server answers with one array of responses
+                self.pipe.send_all([messages])
+            else:
+                self.pipe.send_all(messages)
         except util.timeout:
             # this is OK, the send is in the pipe and we'll flush it out
             # eventually.
@@ -448,16 +519,29 @@ class Interface(util.PrintError):
         or the remote server is misbehaving, a (None, None) will appear.
         """
         responses = []
+        batch = []  # the not yet processed part of a batch response, reversed
         while True:
             response = None
-            try:
-                response = self.pipe.get()
-            except util.timeout:
-                break
-            except self.pipe.Closed as e:
-                self.print_error(str(e))
-            except Exception as e:
-                traceback.print_exc(file=sys.stderr)
+            if batch:
+                response = batch.pop()
+            else:
+                try:
+                    response = self.pipe.get()
+                except util.timeout:
+                    break
+                except self.pipe.Closed as e:
+                    self.print_error(str(e))
+                except Exception as e:
+                    traceback.print_exc(file=sys.stderr)
+
+                if isinstance(response, list) and response:
+                    # response to a JSON-RPC batch
+                    ids = [r.get('id') for r in response if isinstance(r, dict)]
+                    sent = self.batches_in_flight.pop(min((i for i in ids if isinstance(i, int)), default=None), None)
+                    if sent:
+                        self.on_batch_response(sent[0], len(sent[1]), self.pipe.last_message_bytes)
+                    batch = response[::-1]
+                    continue
 
             if type(response) is not dict:
                 # time to close this connection.
@@ -473,6 +557,14 @@ class Interface(util.PrintError):
             if wire_id is None:  # Notification
                 if not isinstance(response.get('method'), str):  # defend against funny/out-of-spec JSON
                     if response.get('error'):
+                        batches = [first_id for first_id, (t, wire_ids) in self.batches_in_flight.items()
+                                   if len(wire_ids) > 1]
+                        if batches:
+                            # the server rejected a whole batch; the oldest one
+                            # in flight, as batches are answered in order
+                            self.print_error("Server rejected a batch of requests:", response.get('error'))
+                            self.on_batch_error(min(batches))
+                            continue
                         # Fulcrum servers versions 1.0.1 and earlier sometimes
                         # would send spurious 'error' messages with id=null and
                         # no 'method'. This would only happen on idle timeout
@@ -495,6 +587,12 @@ class Interface(util.PrintError):
             else:
                 request = self.unanswered_requests.pop(wire_id, None)
                 if request:
+                    self.num_responses += 1
+                    if response.get('error'):
+                        self.num_errors += 1
+                    sent = self.batches_in_flight.pop(wire_id, None)
+                    if sent:
+                        self.on_batch_response(sent[0], len(sent[1]), self.pipe.last_message_bytes)
                     responses.append((request, response))
                 else:
                     self.print_error("unknown wire ID", wire_id)
@@ -25,6 +25,8 @@
 # SOFTWARE.
 
 import inspect
+import threading
+import weakref
 from . import bitcoin
 from .bitcoin import *
 
@@ -273,25 +275,90 @@ class Deterministic_KeyStore(Software_KeyStore):
         return pw_decode(self.passphrase, password) if self.passphrase else ''
 
 
+# xpub -> Xpub keystore, for the keystores whose derived pubkeys are cached.
+# Used by xpubkey_to_address to avoid re-deriving our own keys.
+_xpub_keystores = weakref.WeakValueDictionary()
+
+
 class Xpub:
 
     def __init__(self):
         self.xpub = None
         self.xpub_receive = None
         self.xpub_change = None
+        self._branch_keys = {}  # for_change -> (chain code, pubkey) of the branch xpub
+        # for_change -> the 33 byte pubkeys of the branch, back to back, from index 0
+        self._pubkey_cache = {0: bytearray(), 1: bytearray()}
+        self._pubkey_cache_lock = threading.Lock()  # guards extending the cache
 
     def get_master_public_key(self):
         return self.xpub
 
     def derive_pubkey(self, for_change, n):
-        xpub = self.xpub_change if for_change else self.xpub_receive
-        if xpub is None:
-            xpub = bip32_public_derivation(self.xpub, "", "/%d"%for_change)
-            if for_change:
-                self.xpub_change = xpub
-            else:
-                self.xpub_receive = xpub
-        return self.get_pubkey_from_xpub(xpub, (n,))
+        return self.derive_pubkeys_range(for_change, n, 1)[0]
+
+    def derive_pubkeys_range(self, for_change, start, count):
+        ''' Returns the hex pubkeys for_change/start ... for_change/start+count-1.
+        Keys are served from (and appended to) the pubkey cache; only the ones
+        past its end are derived. '''
+        for_change = int(for_change)
+        end = start + count
+        with self._pubkey_cache_lock:
+            # held while deriving, so that two threads extending the same
+            # branch don't both append from the same index
+            cache = self._pubkey_cache.get(for_change)
+            if cache is not None and start <= len(cache) // 33:
+                have = len(cache) // 33
+                if end > have:
+                    for pubkey in self._derive_pubkeys(for_change, range(have, end)):
+                        cache += bfh(pubkey)
+                    if self.xpub:
+                        _xpub_keystores[self.xpub] = self
+                return [bh2u(cache[33*n:33*(n+1)]) for n in range(start, end)]
+        # not contiguous with the cache, don't extend it
+        return self._derive_pubkeys(for_change, range(start, end))
+
+    def _derive_pubkeys(self, for_change, sequence):
+        branch = self._branch_keys.get(for_change)
+        if branch is None:
+            xpub = self.xpub_change if for_change else self.xpub_receive
+            if xpub is None:
+                xpub = bip32_public_derivation(self.xpub, "", "/%d"%for_change)
+                if for_change:
+                    self.xpub_change = xpub
+                else:
+                    self.xpub_receive = xpub
+            _, _, _, _, c, cK = deserialize_xpub(xpub)
+            branch = self._branch_keys[for_change] = (c, cK)
+        c, cK = branch
+        return [bh2u(CKD_pub(cK, c, n)[0]) for n in sequence]
+
+    def get_cached_pubkey(self, for_change, n):
+        ''' Returns the hex pubkey at for_change/n if it is in the pubkey
+        cache, else None. '''
+        cache = self._pubkey_cache.get(for_change)
+        if cache is None or n < 0 or n >= len(cache) // 33:
+            return None
+        return bh2u(cache[33*n:33*(n+1)])
+
+    def dump_pubkey_cache(self):
+        return {'xpub': self.xpub,
+                '0': bh2u(self._pubkey_cache[0]), '1': bh2u(self._pubkey_cache[1])}
+
+    def load_pubkey_cache(self, d):
+        ''' Loads a cache saved by dump_pubkey_cache(), unless it was made
+        for another xpub or looks corrupt. '''
+        if not isinstance(d, dict) or not self.xpub or d.get('xpub') != self.xpub:
+            return
+        try:
+            cache = {0: bytearray(bfh(d['0'])), 1: bytearray(bfh(d['1']))}
+        except (KeyError, TypeError, ValueError):
+            return
+        if any(len(b) % 33 for b in cache.values()):
+            return
+        with self._pubkey_cache_lock:
+            self._pubkey_cache = cache
+        _xpub_keystores[self.xpub] = self
 
     @classmethod
     def get_pubkey_from_xpub(self, xpub, sequence):
@@ -497,6 +564,9 @@ class Old_KeyStore(Deterministic_KeyStore):
     def derive_pubkey(self, for_change, n):
         return self.get_pubkey_from_mpk(self.mpk, for_change, n)
 
+    def derive_pubkeys_range(self, for_change, start, count):
+        return [self.derive_pubkey(for_change, n) for n in range(start, start + count)]
+
     def get_private_key_from_stretched_exponent(self, for_change, n, secexp):
         order = generator_secp256k1.order()
         secexp = (secexp + self.get_sequence(self.mpk, for_change, n)) % order
@@ -653,7 +723,10 @@ def xpubkey_to_address(x_pubkey):
         pubkey = x_pubkey
     elif x_pubkey[0:2] == 'ff':
         xpub, s = BIP32_KeyStore.parse_xpubkey(x_pubkey)
-        pubkey = BIP32_KeyStore.get_pubkey_from_xpub(xpub, s)
+        keystore = _xpub_keystores.get(xpub)
+        pubkey = keystore and keystore.get_cached_pubkey(*s)
+        if not pubkey:
+            pubkey = BIP32_KeyStore.get_pubkey_from_xpub(xpub, s)
     elif x_pubkey[0:2] == 'fe':
         mpk, s = Old_KeyStore.parse_xpubkey(x_pubkey)
         pubkey = Old_KeyStore.get_pubkey_from_mpk(mpk, s[0], s[1])
@@ -22,6 +22,8 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import asyncio
+import concurrent.futures
 import time
 import queue
 import os
@@ -45,6 +47,8 @@ from .i18n import _
 from .interface import Connection, Interface
 from . import blockchain
 from . import version
+from .caches import ExpiringCache, RawTxDiskCache
+from .transaction import Transaction
 from .tor import TorController, check_proxy_bypass_tor_control
 from .utils import Event
 
@@ -53,6 +57,21 @@ DEFAULT_AUTO_CONNECT = True
 # promote network health by allowing clients to connect to new servers easily.
 DEFAULT_WHITELIST_SERVERS_ONLY = False
 
+class PipelinedChunk:
+    ''' A header chunk requested by request_header_chunks(), on behalf of the
+    `owner` interface which is catching up, from `interface` (which may be
+    another one on the same chain). '''
+    __slots__ = ('owner', 'interface', 'count', 'data', 'prev_data', 'future')
+
+    def __init__(self, owner, interface, count):
+        self.owner = owner
+        self.interface = interface
+        self.count = count
+        self.data = None  # the headers, once received
+        self.prev_data = None  # the headers below them it was verified against
+        self.future = None  # the verification running in header_verify_pool
+
+
 def parse_servers(result):
     """ parse servers list into dict format"""
     servers = {}
@@ -261,6 +280,9 @@ class Network(util.DaemonThread):
 
         self.pending_sends = []
         self.message_id = util.Monotonic(locking=True)
+        # set while run_asyncio_loop is running
+        self._aio_loop = None
+        self._aio_wakeup = None
         self.verified_checkpoint = False
         self.verifications_required = 1
         # If the height is cleared from the network constants, we're
@@ -279,6 +301,13 @@ class Network(util.DaemonThread):
         # callbacks passed with subscriptions
         self.subscriptions = defaultdict(list)
         self.sub_cache = {}                     # note: needs self.interface_lock
+        # Subscriptions, tx and merkle proof requests are shared by all the
+        # wallets (and other clients) of this network: a request already in
+        # flight isn't sent again, and its response goes to everyone who asked
+        # for it. See process_pending_sends.
+        self.pending_subscriptions = set()  # get_index() keys
+        self.shared_requests = {}  # (method, params tuple) -> list of callbacks
+        self.merkle_cache = ExpiringCache(maxlen=10000, name="MerkleProofCache", timeout=600)
         # callbacks set by the GUI
         self.callbacks = defaultdict(list)
 
@@ -287,6 +316,10 @@ class Network(util.DaemonThread):
             os.mkdir(dir_path)
             os.chmod(dir_path, stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR)
 
+        # persistent cache for tx's fetched by Transaction.fetch_input_data
+        if self.config.get('tx_disk_cache', True):
+            Transaction.set_tx_disk_cache(RawTxDiskCache(os.path.join(self.config.path, 'tx_cache')))
+
         # subscriptions and requests
         self.subscribed_addresses = set()
         # Requests from client we've not seen a response to
@@ -302,6 +335,11 @@ class Network(util.DaemonThread):
         self.auto_connect = self.config.get('auto_connect', DEFAULT_AUTO_CONNECT)
         self.connecting = set()
         self.requested_chunks = set()
+        # Header chunks requested ahead of time while catching up, see
+        # request_header_chunks(). (owner interface, base height) -> PipelinedChunk
+        self.header_pipeline = {}
+        self.header_pipeline_depth = max(1, int(self.config.get('network_header_pipeline', 4)))
+        self.header_verify_pool = None  # created on demand
         self.socket_queue = queue.Queue()
         if Network.INSTANCE:
             # This happens on iOS which kills and restarts the daemon on app sleep/wake
@@ -481,6 +519,7 @@ class Network(util.DaemonThread):
         if self.debug:
             self.print_error(interface.host, "-->", method, params, message_id)
         interface.queue_request(method, params, message_id)
+        self._aio_kick()
         if self is not Network.INSTANCE:
             self.print_error("*** WARNING: queueing request on a stale instance!")
         return message_id
@@ -575,6 +614,18 @@ class Network(util.DaemonThread):
             return list(self.interfaces.values() if interfaces
                         else self.interfaces.keys())
 
+    def get_sync_interfaces(self):
+        """Returns the connected interfaces that follow our chain and are
+        caught up with it, best scoring (see Interface.score) first. The main
+        interface is always included, if there is one."""
+        with self.interface_lock:
+            main = self.interface
+            chain = self.blockchain()
+            height = chain.height()
+            ret = [i for i in self.interfaces.values()
+                   if i is main or (i.blockchain is chain and i.tip >= height)]
+        return sorted(ret, key=lambda i: i.score())
+
     def get_servers(self):
         out = networks.net.DEFAULT_SERVERS.copy()
         if self.irc_servers:
@@ -871,7 +922,7 @@ class Network(util.DaemonThread):
                 # and are placed in the unanswered_requests dictionary
                 client_req = self.unanswered_requests.pop(message_id, None)
                 if client_req:
-                    if interface != self.interface:
+                    if self.debug and interface != self.interface:
                         self.print_error("advisory: response from non-primary {}".format(interface))
                     callbacks = [client_req[2]]
                 else:
@@ -923,6 +974,7 @@ class Network(util.DaemonThread):
         if messages: # Guard against empty message-list which is a no-op and just wastes CPU to enque/dequeue (not even callback is called). I've seen the code send empty message lists before in synchronizer.py
             with self.pending_sends_lock:
                 self.pending_sends.append((messages, callback))
+            self._aio_kick()
 
     def process_pending_sends(self):
         # Requests needs connectivity.  If we don't have an interface,
@@ -945,12 +997,78 @@ class Network(util.DaemonThread):
                         l.append(callback)
                     # check cached response for subscriptions
                     r = self.sub_cache.get(k)
+                    if r is None:
+                        if k not in self.pending_subscriptions:
+                            # the response goes to all the callbacks in
+                            # self.subscriptions[k] by then
+                            self.pending_subscriptions.add(k)
+                            self.queue_request(method, params, callback=self.on_shared_subscription)
+                        continue
+                elif method in self.SHARED_METHODS:
+                    r = self.get_shared_response(method, params)
+                    if r is None:
+                        key = (method, tuple(params))
+                        waiting = self.shared_requests.get(key)
+                        if waiting is None:
+                            self.shared_requests[key] = [callback]
+                            self.queue_request(method, params, callback=self.on_shared_response)
+                        elif callback not in waiting:
+                            waiting.append(callback)
+                        continue
                 if r is not None:
-                    util.print_error("cache hit", k)
+                    if method.endswith('.subscribe'):
+                        util.print_error("cache hit", k)
                     callback(r)
                 else:
                     self.queue_request(method, params, callback = callback)
 
+    SHARED_METHODS = ('blockchain.transaction.get', 'blockchain.transaction.get_merkle')
+
+    def get_shared_response(self, method, params):
+        ''' Returns a cached response for a request in SHARED_METHODS, if
+        there is one. '''
+        if method == 'blockchain.transaction.get':
+            tx = len(params) == 1 and Transaction.tx_cache_get(params[0])
+            if not tx:
+                return None
+            if Transaction._txid(tx.raw) != params[0]:
+                # a bad cache entry would be served to every re-request
+                Transaction.tx_cache_remove(params[0])
+                return None
+            return {'method': method, 'params': params, 'result': tx.raw}
+        if method == 'blockchain.transaction.get_merkle':
+            result, block_hash = self.merkle_cache.get(tuple(params), (None, None))
+            if result and block_hash == self.blockchain().get_hash(result['block_height']):
+                return {'method': method, 'params': params, 'result': result}
+
+    def on_shared_subscription(self, response):
+        k = self.get_index(response.get('method'), response.get('params'))
+        self.pending_subscriptions.discard(k)
+        for callback in list(self.subscriptions.get(k, ())):
+            callback(response)
+
+    def on_shared_response(self, response):
+        method, params = response.get('method'), response.get('params')
+        callbacks = self.shared_requests.pop((method, tuple(params)), ())
+        result = response.get('result')
+        if result and not response.get('error'):
+            if method == 'blockchain.transaction.get' and len(params) == 1 and isinstance(result, str):
+                try:
+                    # (it's stored under its actual txid, whatever the server sent)
+                    Transaction.tx_cache_put(Transaction(result))
+                except Exception:
+                    pass
+            elif method == 'blockchain.transaction.get_merkle' and isinstance(result, dict):
+                try:
+                    # only good as long as the block is in our chain
+                    block_hash = self.blockchain().get_hash(result['block_height'])
+                except Exception:
+                    pass
+                else:
+                    self.merkle_cache.put(tuple(params), (result, block_hash))
+        for callback in callbacks:
+            callback(response)
+
     def _cancel_pending_sends(self, callback):
         ct = 0
         with self.pending_sends_lock:
@@ -996,6 +1114,12 @@ class Network(util.DaemonThread):
             if callback == client_req[2]:
                 self.unanswered_requests.pop(message_id, None) # guard against race conditions here. Note: this usually is called from the network thread but who knows what future programmers may do. :)
                 ct += 1
+        for waiting in self.shared_requests.values():
+            if callback in waiting:
+                # (the request itself stays, if nobody is waiting on it anymore
+                # its response will just be cached)
+                waiting.remove(callback)
+                ct += 1
         ct2 = self._cancel_pending_sends(callback)
         if ct or ct2:
             qname = getattr(callback, '__qualname__', repr(callback))
@@ -1129,6 +1253,10 @@ class Network(util.DaemonThread):
         error = response.get('error')
         result = response.get('result')
         params = response.get('params')
+        entry = request and self._find_pipelined_chunk(interface, request[1][0])
+        if entry:
+            self.on_pipelined_chunk(interface, request, response, entry)
+            return
         if not request or result is None or params is None or error is not None:
             interface.print_error(error or 'bad response')
             # Ensure the chunk can be rerequested, but only if the request originated from us.
@@ -1239,13 +1367,200 @@ class Network(util.DaemonThread):
             pass
         else:
             if interface.blockchain.height() < interface.tip:
-                self.request_headers(interface, request_base_height + actual_header_count, 2016)
+                self.request_header_chunks(interface, request_base_height + actual_header_count)
             else:
                 interface.set_mode(Interface.MODE_DEFAULT)
                 interface.print_error('catch up done', interface.blockchain.height())
                 interface.blockchain.catch_up = None
         self.notify('blockchain_updated')
 
+    def request_header_chunks(self, interface, base_height):
+        ''' Requests the headers from base_height on, for an interface that is
+        catching up. Rather than waiting for each chunk to be connected before
+        requesting the next one, keeps up to header_pipeline_depth chunks in
+        flight, spread over the interface and the other ones that are on the
+        same chain and have those headers. The chunks are verified in
+        header_verify_pool where possible, and connected in order by
+        process_header_pipeline(). '''
+        if self.header_pipeline_depth < 2 or base_height <= networks.net.VERIFICATION_BLOCK_HEIGHT:
+            self.request_headers(interface, base_height, 2016)
+            return
+        chain = interface.blockchain
+        with self.interface_lock:
+            helpers = [i for i in self.interfaces.values()
+                       if i is not interface and i.blockchain is chain
+                       and i.mode == Interface.MODE_DEFAULT]
+        helpers.sort(key=lambda i: i.score())
+        end = min(interface.tip + 1, base_height + self.header_pipeline_depth * 2016)
+        for n, height in enumerate(range(base_height, end, 2016)):
+            if (interface, height) in self.header_pipeline:
+                continue
+            count = min(2016, interface.tip + 1 - height)
+            # (another interface catching up may have asked a helper for the
+            # same chunk; its response would be ambiguous)
+            busy = {e.interface for (owner, h), e in self.header_pipeline.items() if h == height}
+            candidates = [interface] + [i for i in helpers
+                                        if i.tip >= height + count - 1 and i not in busy]
+            entry = PipelinedChunk(interface, candidates[n % len(candidates)], count)
+            self._request_pipelined_chunk(height, entry)
+
+    def _request_pipelined_chunk(self, height, entry):
+        if self.request_headers(entry.interface, height, entry.count, silent=True):
+            self.header_pipeline[(entry.owner, height)] = entry
+
+    def _find_pipelined_chunk(self, interface, height):
+        ''' Returns the PipelinedChunk at `height` requested from
+        `interface`, or None. '''
+        for (owner, h), entry in self.header_pipeline.items():
+            if h == height and entry.interface is interface:
+                return entry
+        return None
+
+    def on_pipelined_chunk(self, interface, request, response, entry):
+        ''' Handles the response to a request made by request_header_chunks. '''
+        height, count = request[1][:2]
+        if entry.data is not None:
+            return  # dupe
+        result = response.get('result')
+        data = None
+        if (not response.get('error') and response.get('params') == request[1]
+                and isinstance(result, dict) and isinstance(result.get('hex'), str)):
+            try:
+                data = bfh(result['hex'])
+            except ValueError:
+                pass
+        # the interface catching up may send less headers than asked for, if
+        # its chain got shorter, the others were asked for what they have
+        min_size = blockchain.HEADER_SIZE if interface is entry.owner else count * blockchain.HEADER_SIZE
+        if data is None or not min_size <= len(data) <= count * blockchain.HEADER_SIZE:
+            interface.print_error("bad response to header chunk request, height={} count={}"
+                                  .format(height, count))
+            self._on_bad_pipelined_chunk(height, entry)
+            return
+        entry.data = data[:len(data) - len(data) % blockchain.HEADER_SIZE]
+        self.process_header_pipeline()
+
+    def _on_bad_pipelined_chunk(self, height, entry):
+        del self.header_pipeline[(entry.owner, height)]
+        if entry.interface is entry.owner:
+            # give up, as on_block_headers() would have
+            self.connection_down(entry.owner.server)
+        else:
+            # the chunk can still be had from the interface catching up
+            entry.interface.num_errors += 1
+            self._request_pipelined_chunk(height, PipelinedChunk(entry.owner, entry.owner, entry.count))
+
+    def _read_chunk_prev_data(self, chain, height):
+        ''' Returns the serialized saved headers right below `height` that
+        are needed to verify a chunk on its own, or None. '''
+        prev_data = []
+        for h in range(height - blockchain.Blockchain.MTP_SPAN, height):
+            header = chain.read_header(h)
+            if header is None:
+                return None
+            prev_data.append(bfh(blockchain.serialize_header(header)))
+        return b''.join(prev_data)
+
+    def process_header_pipeline(self):
+        ''' Starts the verification of the received pipelined chunks whose
+        predecessor is known, and connects the ones next in line. Called from
+        the network loop. '''
+        pipeline = self.header_pipeline
+        if not pipeline:
+            return
+        owners = set()
+        for (owner, height), entry in sorted(pipeline.items(), key=lambda item: item[0][1]):
+            if (owner.server not in self.interfaces or owner.mode != Interface.MODE_CATCH_UP
+                    or owner.blockchain is None):
+                del pipeline[(owner, height)]  # the catch up was abandoned
+                continue
+            owners.add(owner)
+            if entry.data is None:
+                if entry.interface.server not in self.interfaces:
+                    # the server went away; get it from the one catching up
+                    del pipeline[(owner, height)]
+                    self._request_pipelined_chunk(height, PipelinedChunk(owner, owner, entry.count))
+                continue
+            chain = owner.blockchain
+            if entry.future is None and chain.can_verify_detached(height):
+                prev = pipeline.get((owner, height - 2016))
+                if prev is not None:
+                    prev_data = prev.data and prev.data[-blockchain.Blockchain.MTP_SPAN * blockchain.HEADER_SIZE:]
+                elif height == chain.height() + 1:
+                    prev_data = self._read_chunk_prev_data(chain, height)
+                else:
+                    prev_data = None
+                if prev_data:
+                    if self.header_verify_pool is None:
+                        self.header_verify_pool = concurrent.futures.ThreadPoolExecutor(
+                            max_workers=min(4, os.cpu_count() or 1), thread_name_prefix='HeaderVerify')
+                    entry.prev_data = prev_data
+                    entry.future = self.header_verify_pool.submit(chain.verify_chunk, height, entry.data, prev_data)
+                    entry.future.add_done_callback(lambda f: self._aio_kick())
+
+        for owner in owners:
+            chain = owner.blockchain
+            connected = False
+            forked = False
+            while True:
+                height = chain.height() + 1
+                entry = pipeline.get((owner, height))
+                if (entry is None or entry.data is None
+                        or (entry.future is not None and not entry.future.done())):
+                    break
+                connect_state = self._connect_pipelined_chunk(chain, height, entry)
+                if connect_state == blockchain.CHUNK_ACCEPTED:
+                    del pipeline[(owner, height)]
+                    connected = True
+                    owner.print_error("connected chunk, height={} count={} from {}"
+                                      .format(height, len(entry.data) // blockchain.HEADER_SIZE,
+                                              entry.interface))
+                elif connect_state == blockchain.CHUNK_FORKS and entry.interface is owner:
+                    # Like on_block_headers(), don't disconnect, just discard
+                    # what we have for this interface and stop catching up
+                    # for now.
+                    owner.print_error("identified forking chunk, height={}".format(height))
+                    for key in [k for k in pipeline if k[0] is owner]:
+                        del pipeline[key]
+                    forked = True
+                    break
+                elif connect_state == blockchain.CHUNK_FORKS:
+                    # a helper's idea of the chain; ask the one catching up
+                    entry.interface.print_error("forking chunk, height={}".format(height))
+                    del pipeline[(owner, height)]
+                    self._request_pipelined_chunk(height, PipelinedChunk(owner, owner, entry.count))
+                    break
+                else:
+                    entry.interface.print_error("discarded bad chunk, height={}".format(height))
+                    self._on_bad_pipelined_chunk(height, entry)
+                    break
+            if forked:
+                if connected:
+                    self.notify('blockchain_updated')
+                continue
+            if not connected or owner.server not in self.interfaces:
+                continue
+            if chain.height() < owner.tip:
+                self.request_header_chunks(owner, chain.height() + 1)
+            else:
+                owner.set_mode(Interface.MODE_DEFAULT)
+                owner.print_error('catch up done', chain.height())
+                chain.catch_up = None
+                for key in [k for k in pipeline if k[0] is owner]:
+                    del pipeline[key]
+            self.notify('blockchain_updated')
+
+    def _connect_pipelined_chunk(self, chain, height, entry):
+        prev_header = chain.read_header(height - 1)
+        if (entry.future is not None and entry.future.exception() is None and prev_header
+                and entry.prev_data[-blockchain.HEADER_SIZE:] == bfh(blockchain.serialize_header(prev_header))):
+            # it was verified against what we have, just save it
+            chain.save_chunk(height, entry.data)
+            return blockchain.CHUNK_ACCEPTED
+        # verify it here (again, if it was verified against other headers
+        # which have since been replaced)
+        return chain.connect_chunk(height, entry.data)
+
     def request_header(self, interface, height):
         """
         This works for all modes except for 'default'.
@@ -1410,7 +1725,7 @@ class Network(util.DaemonThread):
         # If not finished, get the next header
         if next_height:
             if interface.mode == Interface.MODE_CATCH_UP and interface.tip > next_height:
-                self.request_headers(interface, next_height, 2016)
+                self.request_header_chunks(interface, next_height)
             else:
                 self.request_header(interface, next_height)
         else:
@@ -1493,16 +1808,125 @@ class Network(util.DaemonThread):
         for interface in rout:
             self.process_responses(interface)
 
+    def run_asyncio_loop(self):
+        ''' Alternative to the select() loop in run(), enabled with the
+        'network_asyncio' config key. The interface sockets are watched by an
+        asyncio event loop, so responses are processed and queued requests
+        are written out as soon as the sockets are ready, and requests queued
+        from other threads wake the loop up immediately, rather than waiting
+        out the 100 msec select() timeout. '''
+        # add_reader/add_writer need a selector loop (Windows defaults to proactor)
+        loop = asyncio.SelectorEventLoop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(self._asyncio_main(loop))
+        finally:
+            self._aio_loop = None
+            loop.close()
+
+    async def _asyncio_main(self, loop):
+        self._aio_wakeup = asyncio.Event()
+        self._aio_loop = loop
+        watched = {}  # interface -> [fd, is_writer_registered]
+        try:
+            while self.is_running():
+                self.maintain_sockets()
+                if self.verified_checkpoint:
+                    self.run_jobs()    # Synchronizer and Verifier and Fx
+                self.process_pending_sends()
+                self.process_header_pipeline()
+                read_now = self._aio_update_watches(loop, watched)
+                if read_now:
+                    # buffered data left to read, loop again right away
+                    for interface in read_now:
+                        self.process_responses(interface)
+                    continue
+                # Note: the event can only get set while we're awaiting it
+                # below, or by the code above (which has run by now).
+                self._aio_wakeup.clear()
+                try:
+                    # time out for the periodic work in maintain_sockets()
+                    await asyncio.wait_for(self._aio_wakeup.wait(), 0.1)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            for fd, writing in watched.values():
+                loop.remove_reader(fd)
+                if writing:
+                    loop.remove_writer(fd)
+
+    def _aio_update_watches(self, loop, watched):
+        ''' Brings the event loop's reader/writer registrations in line with
+        the current interfaces. Returns the interfaces which have data
+        buffered that the event loop can't know about (see
+        JSONSocketPipe.get_selectloop_info). '''
+        read_now = []
+        with self.interface_lock:
+            interfaces = [i for i in self.interfaces.values() if i.fileno() >= 0]
+        current = set(interfaces)
+        for interface in list(watched):
+            fd, writing = watched[interface]
+            if interface not in current or interface.fileno() != fd:
+                loop.remove_reader(fd)
+                if writing:
+                    loop.remove_writer(fd)
+                del watched[interface]
+        try:
+            for interface in interfaces:
+                read_pending, write_pending = interface.pipe.get_selectloop_info()
+                if read_pending:
+                    read_now.append(interface)
+                want_write = bool(write_pending or interface.num_requests())
+                w = watched.get(interface)
+                if w is None:
+                    w = watched[interface] = [interface.fileno(), False]
+                    loop.add_reader(w[0], self._aio_on_readable, interface)
+                if want_write and not w[1]:
+                    loop.add_writer(w[0], self._aio_on_writable, interface)
+                elif w[1] and not want_write:
+                    loop.remove_writer(w[0])
+                w[1] = want_write
+        except (OSError, ValueError) as e:
+            # fd closed from underneath us, see wait_on_sockets
+            self.print_error("_aio_update_watches: {} raised, trying to recover...".format(repr(e)))
+            self.find_bad_fds_and_kill()
+        return read_now
+
+    def _aio_on_readable(self, interface):
+        self.process_responses(interface)
+        self._aio_wakeup.set()
+
+    def _aio_on_writable(self, interface):
+        if not interface.send_requests():
+            self.connection_down(interface.server)
+        self._aio_wakeup.set()
+
+    def _aio_kick(self):
+        ''' Wakes up the asyncio loop (if running) so that newly queued
+        requests get sent right away. Safe to call from any thread. '''
+        loop = self._aio_loop
+        if loop is None:
+            return
+        if threading.current_thread() is self:
+            self._aio_wakeup.set()
+        else:
+            try:
+                loop.call_soon_threadsafe(self._aio_wakeup.set)
+            except RuntimeError:
+                pass  # loop was closed
+
     def init_headers_file(self):
         b = self.blockchains[0]
         filename = b.path()
         # NB: HEADER_SIZE = 80 bytes
         length = blockchain.HEADER_SIZE * (networks.net.VERIFICATION_BLOCK_HEIGHT + 1)
         if not os.path.exists(filename) or os.path.getsize(filename) < length:
-            with open(filename, 'wb') as f:
-                if length>0:
-                    f.seek(length-1)
-                    f.write(b'\x00')
+            with b.lock:
+                b.reset_cache()  # unmap it first
+                with open(filename, 'wb') as f:
+                    if length>0:
+                        f.seek(length-1)
+                        f.write(b'\x00')
         util.ensure_sparse_file(filename)
         with b.lock:
             b.update_size()
@@ -1516,13 +1940,19 @@ class Network(util.DaemonThread):
         if header is not None:
             self.verified_checkpoint = True
 
-        while self.is_running():
-            self.maintain_sockets()
-            self.wait_on_sockets()
-            if self.verified_checkpoint:
-                self.run_jobs()    # Synchronizer and Verifier and Fx
-            self.process_pending_sends()
+        if self.config.get('network_asyncio', False):
+            self.run_asyncio_loop()
+        else:
+            while self.is_running():
+                self.maintain_sockets()
+                self.wait_on_sockets()
+                if self.verified_checkpoint:
+                    self.run_jobs()    # Synchronizer and Verifier and Fx
+                self.process_pending_sends()
+                self.process_header_pipeline()
         self.stop_network()
+        if self.header_verify_pool:
+            self.header_verify_pool.shutdown(wait=False)
 
         self.tor_controller.active_port_changed.remove(self.on_tor_port_changed)
         self.tor_controller.stop()
@@ -182,6 +182,38 @@ def sign(privkey, message_hash, *, ndata=None):
         return rbytes + int(s).to_bytes(32, 'big')
 
 
+def verify_batch(items):
+    ''' Verifies a list of (pubkey, signature, message_hash) bytes triples,
+    returning a list of bools. With libsecp256k1 each distinct pubkey is only
+    parsed once. Items that verify() would raise ValueError for are False. '''
+    results = []
+    if not _secp256k1_schnorr_verify:
+        for item in items:
+            try:
+                results.append(verify(*item))
+            except ValueError:
+                results.append(False)
+        return results
+    lib = secp256k1.secp256k1
+    parsed = {}  # pubkey -> parsed pubkey buffer, or None if it doesn't parse
+    for pubkey, signature, message_hash in items:
+        if pubkey in parsed:
+            pubkey_parsed = parsed[pubkey]
+        else:
+            pubkey_parsed = create_string_buffer(64)
+            if (not isinstance(pubkey, bytes) or len(pubkey) not in (33, 65)
+                    or not lib.secp256k1_ec_pubkey_parse(lib.ctx, pubkey_parsed, pubkey, c_size_t(len(pubkey)))):
+                pubkey_parsed = None
+            parsed[pubkey] = pubkey_parsed
+        if (pubkey_parsed is None
+                or not isinstance(signature, bytes) or len(signature) != 64
+                or not isinstance(message_hash, bytes) or len(message_hash) != 32):
+            results.append(False)
+            continue
+        results.append(bool(_secp256k1_schnorr_verify(lib.ctx, signature, message_hash, pubkey_parsed)))
+    return results
+
+
 def verify(pubkey, signature, message_hash):
     '''Verify a Schnorr signature, returning True if valid.
 
@@ -32,12 +32,16 @@ import stat
 import hmac, hashlib
 import base64
 import zlib
+from collections.abc import Mapping, MutableMapping
+from types import MappingProxyType
 
 from .address import Address
 from .util import PrintError, profiler, standardize_path
 from .plugins import run_hook, plugin_loaders
 from .keystore import bip44_derivation
 from . import bitcoin
+from .binary_section import (SECTION_KEYS, BinarySection, BinarySectionError,
+                             LazyDict, encode_table, write_section)
 
 
 # seed_version is now used for the version of the wallet file
@@ -49,6 +53,27 @@ FINAL_SEED_VERSION = 17     # electrum >= 2.7 will set this to prevent
 
 TMP_SUFFIX = ".tmp.{}".format(os.getpid())
 
+# Journaled wallet files start with this line. Each subsequent line is one
+# (optionally BIE1-encrypted) JSON record describing a batch of changes. The
+# first record after the magic line is always a full snapshot of the data.
+JOURNAL_MAGIC = "ELECTRONCASH-JOURNAL-1"
+# The journal is compacted (rewritten as a single snapshot) once it has grown
+# past this many bytes *and* past twice the size of the last snapshot, or once
+# it has accumulated this many records (each encrypted record costs an EC
+# multiplication to decrypt at load time).
+JOURNAL_COMPACT_MIN_BYTES = 1 << 20
+JOURNAL_COMPACT_MAX_RECORDS = 256
+# Unencrypted journal files may store the big per-transaction keys in a
+# binary section (see binary_section.py) which sits right after the magic
+# line. It is introduced by this tag followed by its length in hex.
+JOURNAL_BINARY_TAG = b'#binary '
+
+
+def _json_default(o):
+    if isinstance(o, LazyDict):
+        return dict(o.items())
+    raise TypeError('Object of type {} is not JSON serializable'.format(type(o).__name__))
+
 
 def multisig_type(wallet_type):
     '''If wallet_type is mofn multi-sig, return [m, n],
@@ -74,18 +99,58 @@ class WalletStorage(PrintError):
         self.pubkey = None
         self.raw = None
         self._in_memory_only=in_memory_only
+        # Journal engine state. If self.journal is True, writes append only
+        # the keys that changed since the last write (see self._dirty) to the
+        # wallet file, instead of rewriting the whole file.
+        self.journal = False
+        self._dirty = {}  # key -> None (whole value changed) or set of changed sub-keys (dict values)
+        self._journal_on_disk = False  # True iff the file on disk is currently in journal format
+        self._journal_encrypted = False
+        self._journal_pubkey = None  # the pubkey the on-disk journal records are encrypted with
+        self._journal_base_size = 0  # size in bytes of the snapshot written at the last compaction
+        self._journal_size = 0  # current size of the journal file in bytes
+        self._journal_records = 0  # number of records appended since the last compaction
+        self._journal_torn = False  # True if the file ended in a partially written record
+        self._binary = None  # the BinarySection the LazyDicts in self.data read from, if any
+        self._binary_span = None  # (offset, length) of the binary section in the file
         if self.file_exists() and not self._in_memory_only:
             try:
-                with open(self.path, "r", encoding='utf-8') as f:
-                    self.raw = f.read()
+                self.raw = self._read_file()
             except UnicodeDecodeError as e:
                 raise IOError("Error reading file: "+ str(e))
+            if self.raw.startswith(JOURNAL_MAGIC + '\n'):
+                self.journal = self._journal_on_disk = True
+                self._journal_size = os.path.getsize(self.path)
+                self._journal_encrypted = self._journal_lines()[0].startswith('QklF')  # base64 of b'BIE1'
             if not self.is_encrypted():
-                self.load_data(self.raw)
+                if self.journal:
+                    self.load_journal(lambda line: line)
+                else:
+                    self.load_data(self.raw)
         else:
             # avoid new wallets getting 'upgraded'
             self.put('seed_version', FINAL_SEED_VERSION)
 
+    def _read_file(self):
+        ''' Returns the text of the wallet file. For journal files with a
+        binary section, the section is skipped (and remembered in
+        self._binary_span) rather than read into memory. '''
+        magic = (JOURNAL_MAGIC + '\n').encode('utf-8')
+        with open(self.path, "rb") as f:
+            head = f.read(len(magic))
+            if head == magic:
+                line = f.readline()
+                if line.startswith(JOURNAL_BINARY_TAG):
+                    try:
+                        length = int(line[len(JOURNAL_BINARY_TAG):], 16)
+                    except ValueError as e:
+                        raise IOError("Cannot read wallet file '%s'" % self.path) from e
+                    self._binary_span = (f.tell(), length)
+                    f.seek(length + 1, os.SEEK_CUR)  # +1 for the newline ending the section
+                    line = b''
+                head += line
+            return (head + f.read()).decode('utf-8')
+
     def load_data(self, s):
         try:
             self.data = json.loads(s)
@@ -108,6 +173,78 @@ class WalletStorage(PrintError):
                     continue
                 self.data[key] = value
 
+        self._on_data_loaded()
+
+    def _journal_lines(self):
+        lines = self.raw.split('\n')
+        assert lines[0] == JOURNAL_MAGIC
+        return lines[1:]
+
+    def load_journal(self, decode):
+        ''' Replays the journal in self.raw. `decode` is a function that takes
+        one record line and returns the JSON text of that record. A trailing
+        record that cannot be decoded is assumed to be the result of an
+        interrupted append and is dropped (the next write will then compact
+        the journal). '''
+        lines = self._journal_lines()
+        # A complete file always ends in a newline, so the last element is ''
+        torn = lines.pop() != ''
+        data = {}
+        if not lines:
+            raise IOError("Cannot read wallet file '%s'" % self.path)
+        binary_size = 0
+        if self._binary_span:
+            try:
+                self._binary = BinarySection(self.path, *self._binary_span)
+            except (BinarySectionError, ValueError, OSError) as e:
+                raise IOError("Cannot read wallet file '%s'" % self.path) from e
+            for key, table in self._binary.tables.items():
+                data[key] = LazyDict(table)
+            binary_size = len(JOURNAL_BINARY_TAG) + 17 + self._binary_span[1] + 1
+        # Decode the snapshot outside of the try block below so that a bad
+        # password raises the usual InvalidPassword exception.
+        snapshot = decode(lines[0])
+        for i, line in enumerate(lines):
+            try:
+                rec = json.loads(decode(line) if i else snapshot)
+                if not isinstance(rec, dict):
+                    raise ValueError('bad record')
+            except Exception as e:
+                if i == 0:
+                    raise IOError("Cannot read wallet file '%s'" % self.path) from e
+                if i + 1 < len(lines):
+                    raise IOError("Corrupt journal record {} in wallet file '{}'".format(i, self.path)) from e
+                self.print_error("ignoring truncated journal record", i)
+                torn = True
+                break
+            self._apply_journal_record(data, rec)
+        self.data = data
+        self._journal_torn = torn
+        self._journal_records = max(len(lines) - 1, 0)
+        self._journal_base_size = len(lines[0]) + 1 + binary_size
+        self._dirty = {}
+        # we no longer need the raw text, and it may be large
+        self.raw = None
+        self._on_data_loaded()
+
+    @staticmethod
+    def _apply_journal_record(data, rec):
+        for key, value in rec.get('put', {}).items():
+            data[key] = value
+        for key, items in rec.get('upd', {}).items():
+            d = data.get(key)
+            if not isinstance(d, MutableMapping):
+                data[key] = d = {}
+            d.update(items)
+        for key, subkeys in rec.get('pop', {}).items():
+            d = data.get(key)
+            if isinstance(d, MutableMapping):
+                for subkey in subkeys:
+                    d.pop(subkey, None)
+        for key in rec.get('del', []):
+            data.pop(key, None)
+
+    def _on_data_loaded(self):
         # check here if I need to load a plugin
         t = self.get('wallet_type')
         l = plugin_loaders.get(t)
@@ -120,6 +257,8 @@ class WalletStorage(PrintError):
                 self.upgrade()
 
     def is_encrypted(self):
+        if self.journal:
+            return self._journal_encrypted
         try:
             return base64.b64decode(self.raw)[0:4] == b'BIE1'
         except:
@@ -136,6 +275,10 @@ class WalletStorage(PrintError):
     @profiler
     def decrypt(self, password):
         ec_key = self.get_key(password)
+        if self.journal:
+            self.load_journal(lambda line: zlib.decompress(ec_key.decrypt_message(line)).decode('utf8'))
+            self.pubkey = self._journal_pubkey = ec_key.get_public_key()
+            return
         s = zlib.decompress(ec_key.decrypt_message(self.raw)) if self.raw else None
         self.pubkey = ec_key.get_public_key()
         s = s.decode('utf8')
@@ -161,16 +304,95 @@ class WalletStorage(PrintError):
                 v = copy.deepcopy(v)
         return v
 
+    def get_view(self, key, default=None):
+        ''' Like get(), but for dict values returns a read-only view of the
+        stored dict rather than a deep copy of it. This avoids doubling peak
+        memory when reading very large keys such as 'transactions'. The view
+        is shallow: callers must not mutate any nested values they obtain
+        through it. '''
+        with self.lock:
+            v = self.data.get(key)
+            if v is None:
+                return default
+            if isinstance(v, Mapping):
+                return MappingProxyType(v)
+            return copy.deepcopy(v)
+
     def put(self, key, value):
         with self.lock:
             if value is not None:
-                if self.data.get(key) != value:
+                old = self.data.get(key)
+                if old != value:
                     self.modified = True
-                    self.data[key] = copy.deepcopy(value)
+                    value = copy.deepcopy(value)
+                    if self.journal:
+                        self._mark_dirty(key, old, value)
+                    self.data[key] = value
             elif key in self.data:
                 self.modified = True
+                self._dirty[key] = None
                 self.data.pop(key)
 
+    def put_items(self, key, items, removed=()):
+        ''' Incrementally update the dict stored under `key`: sets each of the
+        (sub-key, value) pairs in the dict `items` and deletes each sub-key in
+        `removed`. Unlike put(), this neither compares nor copies the whole
+        dict, so its cost is proportional to the size of the change. The caller
+        hands over ownership of the values in `items` and must not mutate
+        them afterwards. '''
+        if not items and not removed:
+            return
+        with self.lock:
+            d = self.data.get(key)
+            if not isinstance(d, MutableMapping):
+                self.data[key] = d = {}
+                self._dirty[key] = None
+            d.update(items)
+            for subkey in removed:
+                d.pop(subkey, None)
+            self.modified = True
+            if self.journal:
+                subkeys = self._dirty.get(key, set())
+                if subkeys is not None:
+                    subkeys.update(items)
+                    subkeys.update(removed)
+                    self._dirty[key] = subkeys
+
+    def _mark_dirty(self, key, old, new):
+        ''' Remember what changed about `key` so that the next journal append
+        only has to write that. For dict values (transactions, txi, txo, etc)
+        we track the changed sub-keys, so that adding 1 tx to a wallet with
+        100k txs appends 1 tx to the journal rather than 100k. '''
+        subkeys = self._dirty.get(key, set())
+        if subkeys is None or not isinstance(old, Mapping) or not isinstance(new, Mapping):
+            self._dirty[key] = None
+            return
+        for k, v in new.items():
+            if k not in old or old[k] != v:
+                subkeys.add(k)
+        subkeys.update(k for k in old if k not in new)
+        if len(subkeys) > len(new) // 2:
+            # Most of the dict changed, just write the whole thing
+            self._dirty[key] = None
+        else:
+            self._dirty[key] = subkeys
+
+    def is_journal(self):
+        return self.journal
+
+    def convert_to_journal(self):
+        ''' One-shot migration of a plain JSON or BIE1-encrypted wallet file
+        to the journaled format. The wallet must already be loaded (that is,
+        decrypted). Returns True if a conversion took place. '''
+        with self.lock:
+            if self.journal:
+                return False
+            self.print_error("converting wallet file to journal format")
+            self.journal = True
+            self.modified = True
+        self.write()
+        return True
+
     @profiler
     def write(self):
         if self._in_memory_only:
@@ -178,26 +400,132 @@ class WalletStorage(PrintError):
         with self.lock:
             self._write()
 
+    def _journal_needs_compaction(self):
+        return (not self._journal_on_disk
+                or not self.file_exists()
+                or self._journal_torn
+                or self.pubkey != self._journal_pubkey
+                or self._journal_records >= JOURNAL_COMPACT_MAX_RECORDS
+                or self._journal_size > max(JOURNAL_COMPACT_MIN_BYTES,
+                                            2 * self._journal_base_size))
+
+    def _encode_journal_record(self, rec):
+        s = json.dumps(rec, separators=(',', ':'), default=_json_default)
+        if self.pubkey:
+            s = bitcoin.encrypt_message(zlib.compress(bytes(s, 'utf8')), self.pubkey).decode('utf8')
+        return s + '\n'
+
+    def _make_journal_record(self):
+        ''' Builds a record out of the keys flagged in self._dirty. '''
+        rec = {}
+        for key, subkeys in self._dirty.items():
+            value = self.data.get(key)
+            if value is None:
+                rec.setdefault('del', []).append(key)
+            elif subkeys is None or not isinstance(value, Mapping):
+                rec.setdefault('put', {})[key] = value
+            else:
+                for subkey in subkeys:
+                    if subkey in value:
+                        rec.setdefault('upd', {}).setdefault(key, {})[subkey] = value[subkey]
+                    else:
+                        rec.setdefault('pop', {}).setdefault(key, []).append(subkey)
+        return rec
+
+    def _append_journal(self):
+        line = self._encode_journal_record(self._make_journal_record()).encode('utf-8')
+        with open(self.path, "ab") as f:
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+        self._journal_size += len(line)
+        self._journal_records += 1
+        self._dirty = {}
+        self.print_error("appended journal record", self._journal_records, "to", self.path)
+        self.modified = False
+
+    def _encode_binary_tables(self):
+        ''' Encodes those of the SECTION_KEYS that can be represented in a
+        binary section. Only used for unencrypted journal files. '''
+        tables = {}
+        if self.pubkey:
+            return tables
+        for key in SECTION_KEYS:
+            value = self.data.get(key)
+            if not isinstance(value, Mapping) or not value:
+                continue
+            try:
+                if isinstance(value, LazyDict):
+                    tables[key] = value.encode(key)
+                else:
+                    tables[key] = encode_table(key, value)
+            except BinarySectionError as e:
+                self.print_error("storing", key, "as JSON:", repr(e))
+        return tables
+
+    def _write_journal_file(self, f, tables, snapshot):
+        f.write((JOURNAL_MAGIC + '\n').encode('utf-8'))
+        if tables:
+            tag_pos = f.tell()
+            f.write(JOURNAL_BINARY_TAG + b'%016x\n' % 0)
+            offset = f.tell()
+            length = write_section(f, tables)
+            f.write(b'\n')
+            f.seek(tag_pos)
+            f.write(JOURNAL_BINARY_TAG + b'%016x\n' % length)
+            f.seek(0, os.SEEK_END)
+            span = (offset, length)
+        else:
+            span = None
+        f.write(snapshot.encode('utf-8'))
+        return span
+
+    def _detach_binary(self):
+        ''' Moves all LazyDicts into memory and closes the current binary
+        section. '''
+        for value in self.data.values():
+            if isinstance(value, LazyDict):
+                value.detach()
+        if self._binary:
+            self._binary.close()
+            self._binary = None
+
     def _write(self):
         if threading.currentThread().isDaemon():
             self.print_error('warning: daemon thread cannot write wallet')
             return
         if not self.modified:
             return
-        s = json.dumps(self.data,
-                       indent=None if self.pubkey else 4,  # Fast settings if encrypted,
-                       sort_keys=not self.pubkey)          # readable settings otherwise.
-        if self.pubkey:
-            s = bytes(s, 'utf8')
-            c = zlib.compress(s)
-            s = bitcoin.encrypt_message(c, self.pubkey)
-            s = s.decode('utf8')
-
         temp_path = self.path + TMP_SUFFIX
-        with open(temp_path, "w", encoding='utf-8') as f:
-            f.write(s)
-            f.flush()
-            os.fsync(f.fileno())
+        if self.journal:
+            if not self._journal_needs_compaction():
+                self._append_journal()
+                return
+            # Compact: write a fresh journal consisting of a single snapshot,
+            # plus a binary section if possible
+            tables = self._encode_binary_tables()
+            snapshot = self._encode_journal_record(
+                {'put': {k: v for k, v in self.data.items() if k not in tables}})
+            with open(temp_path, "wb") as f:
+                binary_span = self._write_journal_file(f, tables, snapshot)
+                f.flush()
+                os.fsync(f.fileno())
+                size = f.tell()
+            tables = None
+        else:
+            s = json.dumps(self.data,
+                           indent=None if self.pubkey else 4,  # Fast settings if encrypted,
+                           sort_keys=not self.pubkey)          # readable settings otherwise.
+            if self.pubkey:
+                s = bytes(s, 'utf8')
+                c = zlib.compress(s)
+                s = bitcoin.encrypt_message(c, self.pubkey)
+                s = s.decode('utf8')
+
+            with open(temp_path, "w", encoding='utf-8') as f:
+                f.write(s)
+                f.flush()
+                os.fsync(f.fileno())
 
         default_mode = stat.S_IREAD | stat.S_IWRITE
         try:
@@ -209,13 +537,56 @@ class WalletStorage(PrintError):
         if not self.file_exists():
             # See: https://github.com/spesmilo/electrum/issues/5082
             assert not os.path.exists(self.path)
-        os.replace(temp_path, self.path)
+        try:
+            os.replace(temp_path, self.path)
+        except OSError:
+            if not (self.journal and self._binary):
+                raise
+            # Windows won't replace a file that is mapped: move the LazyDicts
+            # into memory, close the old section and try again.
+            self._detach_binary()
+            os.replace(temp_path, self.path)
         os.chmod(self.path, mode)
-        self.raw = s
+        if self.journal:
+            # We don't keep the text of journal files around in self.raw
+            self.raw = None
+            self._binary_span = binary_span
+            self._map_binary()
+            self._journal_on_disk = True
+            self._journal_torn = False
+            self._journal_encrypted = bool(self.pubkey)
+            self._journal_pubkey = self.pubkey
+            self._journal_base_size = size
+            self._journal_size = size
+            self._journal_records = 0
+        else:
+            self.raw = s
+        self._dirty = {}
         self._file_exists = True
         self.print_error("saved", self.path)
         self.modified = False
 
+    def _map_binary(self):
+        ''' Opens the binary section of the freshly written wallet file and
+        points the LazyDicts in self.data at it. The previous section is only
+        closed after that (LazyDicts not in the new one are moved into memory
+        first), so that a LazyDict always has a readable base, even for
+        threads that don't hold self.lock. '''
+        old = self._binary
+        self._binary = BinarySection(self.path, *self._binary_span) if self._binary_span else None
+        tables = self._binary.tables if self._binary else {}
+        for key, table in tables.items():
+            value = self.data.get(key)
+            if isinstance(value, LazyDict):
+                value.rebase(table)
+            else:
+                self.data[key] = LazyDict(table)
+        if old:
+            for key, value in self.data.items():
+                if isinstance(value, LazyDict) and key not in tables:
+                    value.detach()
+            old.close()
+
     def requires_split(self):
         d = self.get('accounts', {})
         return len(d) > 1
@@ -25,6 +25,8 @@
 
 from threading import Lock
 import hashlib
+import random
+import time
 import traceback
 
 from .transaction import Transaction
@@ -33,6 +35,16 @@ from . import networks
 from .bitcoin import InvalidXKeyFormat
 
 
+def history_status(h):
+    ''' Returns the status of an address history (a list of (tx_hash,
+    height) tuples), as defined by the Electrum protocol, or None for an
+    empty history. '''
+    if not h:
+        return None
+    status = ''.join(tx_hash + ':%d:' % height for tx_hash, height in h)
+    return bh2u(hashlib.sha256(status.encode('ascii')).digest())
+
+
 class Synchronizer(ThreadJob):
     '''The synchronizer keeps the wallet up-to-date with its set of
     addresses and their transactions.  It subscribes over the network
@@ -57,8 +69,25 @@ class Synchronizer(ThreadJob):
         self.h2addr = {}
         self.lock = Lock()
         self._tick_ct = 0
+        # Optionally, history and tx requests are spread over all the
+        # healthy servers rather than all going to the main one (see
+        # send_spread). Off by default, as it reveals the wallet's addresses
+        # to more servers.
+        self.multi_server = bool(network and network.config.get('sync_multi_server', False))
+        # (method, first param) -> (interface, time sent), for requests
+        # that send_spread sent to a server other than the main one
+        self.spread_requests = {}
+        # Optionally, on start the addresses are subscribed to in stages,
+        # recently used ones first, rather than all at once (see
+        # subscribe_next_stage).
+        self.staged = bool(network and network.config.get('sync_staged_subscriptions', False))
+        self.pending_subscriptions = []  # reversed, next one last
         self.initialize()
 
+    # run() only has work to do when we get a response or new addresses
+    # (which wake it up), but also checks for timed out requests
+    run_interval = 1.0
+
     def diagnostic_name(self):
         return f"{__class__.__name__}/{self.wallet.diagnostic_name()}"
 
@@ -74,7 +103,7 @@ class Synchronizer(ThreadJob):
 
     def is_up_to_date(self):
         return (not self.requested_tx and not self.requested_histories
-                and not self.requested_hashes)
+                and not self.requested_hashes and not self.pending_subscriptions)
 
     def _release(self):
         ''' Called from the Network (DaemonThread) -- to prevent race conditions
@@ -92,11 +121,13 @@ class Synchronizer(ThreadJob):
         ''' Called from main thread, enqueues a 'release' to happen in the
         Network thread. '''
         self._need_release = True
+        self.wakeup()
 
     def add(self, address):
         '''This can be called from the proxy or GUI threads.'''
         with self.lock:
             self.new_addresses.add(address)
+        self.wakeup()
 
     def subscribe_to_addresses(self, addresses):
         hashes = [addr.to_scripthash_hex() for addr in addresses]
@@ -105,19 +136,77 @@ class Synchronizer(ThreadJob):
         self.network.subscribe_to_scripthashes(hashes, self.on_address_status)
         self.requested_hashes |= set(hashes)
 
+    SPREAD_TIMEOUT = 30.0  # seconds before a spread request is retried on the main server
+
+    def send_spread(self, requests, callback):
+        ''' Like network.send, but when multi-server sync is enabled, spreads
+        the requests over the healthy servers in proportion to their score
+        (a contiguous run per server, so they still get batched). Responses
+        coming from other servers than the main one are checked like any
+        other: histories against the status hash announced by the main
+        server, and tx's against their txid (and later, by the SPV
+        verifier). Failures are retried on the main server. '''
+        interfaces = self.network.get_sync_interfaces() if self.multi_server else ()
+        if len(interfaces) < 2:
+            self.network.send(requests, callback)
+            return
+        weights = [1.0 / max(i.score(), 1e-3) for i in interfaces]
+        if len(requests) == 1:
+            runs = [(random.choices(interfaces, weights)[0], requests)]
+        else:
+            runs, start, acc, total = [], 0, 0.0, sum(weights)
+            for interface, weight in zip(interfaces, weights):
+                acc += weight
+                end = round(len(requests) * acc / total)
+                runs.append((interface, requests[start:end]))
+                start = end
+        now = time.time()
+        main = self.network.interface
+        for interface, reqs in runs:
+            for method, params in reqs:
+                if interface is not main:
+                    self.spread_requests[(method, params[0])] = (interface, now)
+                self.network.queue_request(method, params, interface, callback=callback)
+
+    def retry_on_main(self, response, callback):
+        ''' If `response` is to a request that send_spread sent to another
+        server than the main one, counts an error against that server and
+        re-sends the request to the main server. Returns True if so. '''
+        method, params = response.get('method'), response.get('params')
+        ent = params and self.spread_requests.pop((method, params[0]), None)
+        if not ent or ent[0] is self.network.interface:
+            return False
+        if not response.get('error'):
+            ent[0].num_errors += 1  # (error responses were counted by the interface)
+        self.print_error("retrying {} {} on the main server".format(method, params[0]))
+        self.network.send([(method, params)], callback)
+        return True
+
+    def check_spread_requests(self):
+        ''' Re-sends spread requests to the main server if their server went
+        away or didn't answer in time. '''
+        if not self.spread_requests:
+            return
+        live = set(self.network.get_interfaces(interfaces=True))
+        cutoff = time.time() - self.SPREAD_TIMEOUT
+        callbacks = {'blockchain.scripthash.get_history': self.on_address_history,
+                     'blockchain.transaction.get': self.tx_response}
+        for key, (interface, t) in list(self.spread_requests.items()):
+            if interface not in live or t < cutoff:
+                del self.spread_requests[key]
+                method, param = key
+                self.print_error("re-requesting {} {} from the main server".format(method, param))
+                self.network.send([(method, [param])], callbacks[method])
+
     def get_status(self, h):
-        if not h:
-            return None
-        status = ''
-        for tx_hash, height in h:
-            status += tx_hash + ':%d:' % height
-        return bh2u(hashlib.sha256(status.encode('ascii')).digest())
+        return history_status(h)
 
     def on_address_status(self, response):
         if self.cleaned_up:
             self.print_error("Already cleaned-up, ignoring stale reponse:", response)
             self._release()  # defensive programming: make doubly sure we aren't registered to receive any callbacks from netwok class and cancel subscriptions again.
             return
+        self.wakeup()
         params, result, error = self.parse_response(response)
         if error:
             return
@@ -125,28 +214,28 @@ class Synchronizer(ThreadJob):
         addr = self.h2addr.get(scripthash, None)
         if not addr:
             return  # Bad server response?
-        history = self.wallet.get_address_history(addr)
-        if self.get_status(history) != result:
+        if self.wallet.get_address_status(addr) != result:
             if self.requested_histories.get(scripthash) is None:
                 self.requested_histories[scripthash] = result
-                self.network.request_scripthash_history(scripthash,
-                                                        self.on_address_history)
+                self.send_spread([('blockchain.scripthash.get_history', [scripthash])],
+                                 self.on_address_history)
         # remove addr from list only after it is added to requested_histories
         self.requested_hashes.discard(scripthash)  # Notifications won't be in
 
     def on_address_history(self, response):
         if self.cleaned_up:
             return
+        self.wakeup()
         params, result, error = self.parse_response(response)
         if error:
+            self.retry_on_main(response, self.on_address_history)
             return
         scripthash = params[0]
         addr = self.h2addr.get(scripthash, None)
         if not addr or not scripthash in self.requested_histories:
             return  # Bad server response?
         self.print_error("receiving history {} {}".format(addr, len(result)))
-        # Remove request; this allows up_to_date to be True
-        server_status = self.requested_histories.pop(scripthash)
+        server_status = self.requested_histories[scripthash]
         hashes = set(map(lambda item: item['tx_hash'], result))
         hist = list(map(lambda item: (item['tx_hash'], item['height']), result))
         # tx_fees
@@ -156,24 +245,38 @@ class Synchronizer(ThreadJob):
         if hist != sorted(hist, key=lambda x:x[1]):
             which = self.network.interface or self
             which.print_error("serving improperly sorted address histories")
+        status = self.get_status(hist)
+        if len(hashes) != len(result) or status != server_status:
+            # if this came from another server than the main one, it may just
+            # not be in sync with the main one (yet)
+            if self.retry_on_main(response, self.on_address_history):
+                return
+        self.spread_requests.pop((response.get('method'), scripthash), None)
+        # Remove request; this allows up_to_date to be True
+        del self.requested_histories[scripthash]
         # Check that txids are unique
         if len(hashes) != len(result):
             self.print_error("error: server history has non-unique txids: {}"
                              .format(addr))
         # Check that the status corresponds to what was announced
-        elif self.get_status(hist) != server_status:
+        elif status != server_status:
             self.print_error("error: status mismatch: {}".format(addr))
         else:
             # Store received history
-            self.wallet.receive_history_callback(addr, hist, tx_fees)
+            self.wallet.receive_history_callback(addr, hist, tx_fees, status=status)
             # Request transactions we don't have
             self.request_missing_txs(hist)
 
     def tx_response(self, response):
         if self.cleaned_up:
             return
+        self.wakeup()
         params, result, error = self.parse_response(response)
         tx_hash = params[0] or ''
+        if tx_hash not in self.requested_tx:
+            return  # late reply to a request we re-sent elsewhere
+        if error and self.retry_on_main(response, self.tx_response):
+            return
         # unconditionally pop. so we don't end up in a "not up to date" state
         # on bad server reply or reorg.
         # see Electrum commit 7b8114f865f644c5611c3bb849c4f4fc6ce9e376 fix#5122
@@ -189,17 +292,24 @@ class Synchronizer(ThreadJob):
         except Exception:
             traceback.print_exc()
             self.print_msg("cannot deserialize transaction, skipping", tx_hash)
-            return
+            tx = None
         # Paranoia - in case server is malicious and serves bogus tx.
         # We must do this because verifier verifies merkle_proof based on this
         # tx_hash.
-        chk_txid = tx.txid_fast()
-        if tx_hash != chk_txid:
+        chk_txid = tx and tx.txid_fast()
+        if tx and tx_hash != chk_txid:
             self.print_error("received tx does not match expected txid ({} != {}), skipping"
                              .format(tx_hash, chk_txid))
+        if tx_hash != chk_txid:
+            # bad tx; if it came from another server than the main one, we
+            # can still get it from the main one
+            self.requested_tx[tx_hash] = tx_height
+            if not self.retry_on_main(response, self.tx_response):
+                del self.requested_tx[tx_hash]
             return
         del chk_txid
         # /Paranoia
+        self.spread_requests.pop((response.get('method'), tx_hash), None)
         self.wallet.receive_tx_callback(tx_hash, tx, tx_height)
         self.print_error("received tx %s height: %d bytes: %d" %
                          (tx_hash, tx_height, len(tx.raw)))
@@ -219,7 +329,8 @@ class Synchronizer(ThreadJob):
                 continue
             requests.append(('blockchain.transaction.get', [tx_hash]))
             self.requested_tx[tx_hash] = tx_height
-        self.network.send(requests, self.tx_response)
+        if requests:
+            self.send_spread(requests, self.tx_response)
 
 
     def initialize(self):
@@ -233,7 +344,37 @@ class Synchronizer(ThreadJob):
 
         if self.requested_tx:
             self.print_error("missing tx", self.requested_tx)
-        self.subscribe_to_addresses(self.wallet.get_addresses())
+        addresses = self.wallet.get_addresses()
+        if self.staged:
+            self.pending_subscriptions = self.subscription_order(addresses)[::-1]
+            self.subscribe_next_stage()
+        else:
+            self.subscribe_to_addresses(addresses)
+
+    SUBSCRIBE_STAGE = 200  # number of addresses subscribed to at a time in staged mode
+
+    def subscription_order(self, addresses):
+        ''' Returns `addresses` sorted by how recently they were used: those
+        with unconfirmed tx's first, then by the height of their last tx, and
+        those never used last. '''
+        def key(addr):
+            hist = self.wallet.get_address_history(addr)
+            if not hist:
+                return 0
+            height = max(height for tx_hash, height in hist)
+            return -height if height > 0 else float('-inf')
+        return sorted(addresses, key=key)
+
+    def subscribe_next_stage(self):
+        ''' In staged mode, subscribes to the next SUBSCRIBE_STAGE addresses
+        once most of the previous stage has been answered. '''
+        if (not self.pending_subscriptions
+                or len(self.requested_hashes) > self.SUBSCRIBE_STAGE // 2):
+            return
+        n = min(self.SUBSCRIBE_STAGE, len(self.pending_subscriptions))
+        stage = self.pending_subscriptions[-n:][::-1]
+        del self.pending_subscriptions[-n:]
+        self.subscribe_to_addresses(stage)
 
     def run(self):
         '''Called from the network proxy thread main loop.'''
@@ -256,8 +397,12 @@ class Synchronizer(ThreadJob):
                 self.new_addresses = set()
             if addresses:
                 self.subscribe_to_addresses(addresses)
+            self.subscribe_next_stage()
+
+            # 3. Retry requests that went to servers that went away
+            self.check_spread_requests()
 
-            # 3. Detect if situation has changed
+            # 4. Detect if situation has changed
             up_to_date = self.is_up_to_date()
             if up_to_date != self.wallet.is_up_to_date():
                 self.wallet.set_up_to_date(up_to_date)
@@ -1,5 +1,12 @@
+import os
+import shutil
+import tempfile
 import unittest
+import unittest.mock
 from .. import blockchain as bc
+from .. import networks
+from ..interface import Interface
+from ..network import Network, PipelinedChunk
 
 
 class MyBlockchain(bc.Blockchain):
@@ -74,3 +81,105 @@ class TestBlockchain(unittest.TestCase):
         # MTP(1010) is TimeStamp(1005), MTP(1004) is TimeStamp(999)
         hdr = {'block_height': block['block_height'] + 1}
         self.assertEqual(chain.get_bits(hdr, chunk), 0x1801b553)
+
+    def test_verify_chunk_detached(self):
+        anchor = networks.net.asert_daa.anchor
+        z = '00' * 32
+        first = {
+            'version': 4,
+            'prev_block_hash': z,
+            'merkle_root': z,
+            'timestamp': anchor.prev_time + 100 * 600,
+            'bits': anchor.bits,
+            'nonce': 0,
+            'block_height': anchor.height + 100
+        }
+        chain = MyBlockchain()
+        blocks = [first]
+        chunk_bytes = bytes.fromhex(bc.serialize_header(first))
+        for n in range(40):
+            block = get_block(blocks[-1], 600, first['bits'])
+            if n >= chain.MTP_SPAN:
+                block['bits'] = chain.get_bits(block, bc.HeaderChunk(first['block_height'], chunk_bytes))
+            blocks.append(block)
+            chunk_bytes += bytes.fromhex(bc.serialize_header(block))
+        base = first['block_height'] + 20
+        self.assertTrue(chain.can_verify_detached(base))
+        prev_data = chunk_bytes[(20 - chain.MTP_SPAN) * bc.HEADER_SIZE:20 * bc.HEADER_SIZE]
+        data = chunk_bytes[20 * bc.HEADER_SIZE:]
+        # no proof of work in these
+        with unittest.mock.patch.object(bc, 'bits_to_target', return_value=1 << 256):
+            chain.verify_chunk(base, data, prev_data)
+            bad = bytearray(data)
+            bad[bc.HEADER_SIZE + 72] ^= 1  # bits of the 2nd header
+            self.assertRaises(bc.VerifyError, chain.verify_chunk, base, bytes(bad), prev_data)
+
+    def test_header_store(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        open(os.path.join(tmp, 'blockchain_headers'), 'wb').close()
+        chain = bc.Blockchain(unittest.mock.Mock(path=tmp), 0, None)
+        self.addCleanup(chain.reset_cache)
+        z = '00' * 32
+        blocks = [{'version': 4, 'prev_block_hash': z, 'merkle_root': z,
+                   'timestamp': 1269211443, 'bits': 0x18015ddc, 'nonce': 0,
+                   'block_height': 0}]
+        for n in range(9):
+            blocks.append(get_block(blocks[-1], 600, blocks[0]['bits']))
+        chain.write(b''.join(bytes.fromhex(bc.serialize_header(b)) for b in blocks), 0)
+        self.assertEqual(9, chain.height())
+        self.assertEqual(blocks[5], chain.read_header(5))
+        chain.read_header(5)['nonce'] = 1  # callers get copies
+        self.assertEqual(blocks[5], chain.read_header(5))
+        self.assertEqual(bc.hash_header(blocks[7]), chain.get_hash(7))
+        self.assertIsNone(chain.read_header(10))
+        self.assertEqual(bc.hash_header(blocks[9]), chain.get_hash(9))
+        # replacing the tip drops what was cached for it
+        tip = dict(blocks[9], nonce=1)
+        chain.write(bytes.fromhex(bc.serialize_header(tip)), 9 * bc.HEADER_SIZE)
+        self.assertEqual(tip, chain.read_header(9))
+        self.assertEqual(bc.hash_header(tip), chain.get_hash(9))
+        self.assertEqual(bc.hash_header(blocks[7]), chain.get_hash(7))
+
+
+class TestHeaderPipeline(unittest.TestCase):
+
+    def make_network(self, owners):
+        net = unittest.mock.Mock(spec=Network)
+        net.header_pipeline = {}
+        net.interfaces = {owner.server: owner for owner in owners}
+        return net
+
+    def make_owner(self, server, height):
+        owner = unittest.mock.Mock(spec=Interface, server=server, tip=100000,
+                                   mode=Interface.MODE_CATCH_UP, blockchain=unittest.mock.Mock())
+        owner.blockchain.height.return_value = height - 1
+        owner.blockchain.can_verify_detached.return_value = False
+        return owner
+
+    def add_chunk(self, net, owner, height, interface=None):
+        entry = PipelinedChunk(owner, interface or owner, 2016)
+        entry.data = b'\0' * bc.HEADER_SIZE
+        net.header_pipeline[(owner, height)] = entry
+        return entry
+
+    def test_forking_chunk_keeps_connection(self):
+        owner = self.make_owner('a', 4032)
+        net = self.make_network([owner])
+        self.add_chunk(net, owner, 4032)
+        self.add_chunk(net, owner, 6048)
+        net._connect_pipelined_chunk.return_value = bc.CHUNK_FORKS
+        Network.process_header_pipeline(net)
+        net.connection_down.assert_not_called()
+        net._on_bad_pipelined_chunk.assert_not_called()
+        self.assertEqual({}, net.header_pipeline)
+
+    def test_owners_at_the_same_height(self):
+        owner1, owner2 = self.make_owner('a', 4032), self.make_owner('b', 4032)
+        net = self.make_network([owner1, owner2])
+        self.add_chunk(net, owner1, 4032)
+        self.add_chunk(net, owner2, 4032)
+        net._connect_pipelined_chunk.return_value = bc.CHUNK_ACCEPTED
+        Network.process_header_pipeline(net)
+        self.assertEqual(2, net._connect_pipelined_chunk.call_count)
+        self.assertEqual({}, net.header_pipeline)
@@ -1,3 +1,6 @@
+import json
+import socket
+import time
 import unittest
 
 from .. import interface
@@ -36,3 +39,76 @@ class TestInterface(unittest.TestCase):
         self.assertFalse(i.check_host_name(
             peercert={'subject': ((('commonName', '*.bar.com'),),)},
             name='sub.foo.bar.com'))
+
+    def test_batch_requests(self):
+        a, b = socket.socketpair()
+        self.addCleanup(a.close)
+        self.addCleanup(b.close)
+        i = interface.Interface('127.0.0.1:1:t', a)
+        i.batch_size = n = i.BATCH_MIN
+        for wire_id in range(n + 1):
+            i.queue_request('server.ping', [], wire_id)
+        self.assertTrue(i.send_requests())
+        self.assertTrue(i.send_requests())
+        f = b.makefile('rb')
+        batch = json.loads(f.readline())
+        self.assertEqual(list(range(n)), [r['id'] for r in batch])
+        self.assertEqual(n, json.loads(f.readline())['id'])  # single requests aren't batched
+        replies = [{'id': wire_id, 'result': None} for wire_id in reversed(range(n))]
+        b.sendall(json.dumps(replies).encode() + b'\n' + json.dumps({'id': n, 'result': None}).encode() + b'\n')
+        responses = []
+        while len(responses) < n + 1:
+            responses += i.get_responses()
+        self.assertEqual(list(reversed(range(n))) + [n], [req[2] for req, resp in responses])
+        self.assertEqual(2 * n, i.batch_size)  # a full batch came back quickly
+        self.assertFalse(i.unanswered_requests)
+        self.assertFalse(i.batches_in_flight)
+        self.assertEqual(n + 1, i.num_responses)
+        self.assertIsNotNone(i.rtt)
+
+    def test_batch_rejected(self):
+        a, b = socket.socketpair()
+        self.addCleanup(a.close)
+        self.addCleanup(b.close)
+        i = interface.Interface('127.0.0.1:1:t', a)
+        i.batch_size = n = 4 * i.BATCH_MIN
+        for wire_id in range(n):
+            i.queue_request('server.ping', [], wire_id)
+        self.assertTrue(i.send_requests())
+        f = b.makefile('rb')
+        self.assertEqual(n, len(json.loads(f.readline())))
+        # as Fulcrum answers a batch larger than its max_batch
+        b.sendall(json.dumps({'id': None, 'error': {'code': -32600, 'message': 'Batch too large'}}).encode() + b'\n')
+        responses, deadline = [], time.time() + 5
+        while not i.unsent_requests and time.time() < deadline:
+            responses += i.get_responses()
+        self.assertEqual([], responses)
+        self.assertFalse(i.unanswered_requests)
+        self.assertFalse(i.batches_in_flight)
+        self.assertEqual(list(range(n)), [req[2] for req in i.unsent_requests])
+        self.assertEqual(n // 2, i.batch_size)
+        i.on_batch_response(time.time(), n // 2, 0)
+        self.assertEqual(n // 2, i.batch_size)  # no bigger than the server takes
+        # the requests go out again, in smaller batches
+        self.assertTrue(i.send_requests())
+        self.assertEqual(list(range(n // 2)), [r['id'] for r in json.loads(f.readline())])
+        i.on_batch_error(0)
+        self.assertEqual(i.BATCH_MIN, i.batch_size)
+        # a batch that can't get any smaller being rejected turns batching off
+        self.assertTrue(i.send_requests())
+        i.on_batch_error(0)
+        self.assertFalse(i.use_batches)
+        self.assertEqual(list(range(n)), [req[2] for req in i.unsent_requests])
+
+    def test_score(self):
+        a, b = socket.socketpair()
+        self.addCleanup(a.close)
+        self.addCleanup(b.close)
+        i = interface.Interface('127.0.0.1:1:t', a)
+        i.rtt = 0.1
+        score = i.score()
+        i.num_responses, i.num_errors = 9, 1
+        self.assertGreater(i.score(), score)  # errors make it worse
+        i.rtt = 0.05
+        i.num_errors = 0
+        self.assertLess(i.score(), score)  # a faster server is better
@@ -1,7 +1,17 @@
+import os
+import shutil
+import tempfile
+import time
 import unittest
+import unittest.mock
 from pprint import pprint
+from types import SimpleNamespace
 
+import ecdsa
+
+from .. import bitcoin
 from .. import transaction
+from ..caches import RawTxDiskCache
 from ..address import Address, ScriptOutput, PublicKey
 from ..bitcoin import TYPE_ADDRESS, TYPE_PUBKEY, TYPE_SCRIPT
 
@@ -303,3 +313,155 @@ class NetworkMock(object):
 
     def synchronous_get(self, arg):
         return self.unspent
+
+
+class FetchNetworkMock:
+    ''' Records queued requests, answering them only when told to '''
+
+    def __init__(self, txs):
+        self.txs = txs
+        self.requests = []
+
+    def get_interfaces(self, *, interfaces=False):
+        return []
+
+    def get_server_height(self):
+        return 0
+
+    def queue_request(self, method, params, interface=None, *, callback=None):
+        self.requests.append((params, callback))
+
+    def cancel_requests(self, callback):
+        self.requests = [r for r in self.requests if r[1] != callback]
+
+    def answer_all(self):
+        requests, self.requests = self.requests, []
+        for params, callback in requests:
+            if len(params) > 1:
+                callback({'params': params, 'result': {'confirmations': 0}})
+            else:
+                callback({'params': params, 'result': self.txs[params[0]]})
+
+
+class TestFetchInputData(unittest.TestCase):
+
+    prevout_raw = '010000000100000000000000000000000000000000000000000000000000000000000000000000000000000000000100000000000000000000000000'
+    prevout_hash = '50fa7bd4e5e2d3220fd2e84effec495b9845aba379d853408779d59a4b0b4f59'
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        transaction.Transaction.set_tx_disk_cache(RawTxDiskCache(self.tmpdir))
+
+    def tearDown(self):
+        transaction.Transaction.set_tx_disk_cache(None)
+        transaction.Transaction._fetched_tx_cache.d.pop(self.prevout_hash, None)
+        shutil.rmtree(self.tmpdir)
+
+    def spender(self, locktime):
+        ''' A tx spending output 0 of prevout_hash '''
+        tx = transaction.Transaction(
+            '01000000' '01' + bytes.fromhex(self.prevout_hash)[::-1].hex() + '00000000' '00' 'ffffffff'
+            '01' '1027000000000000' '00' + locktime.to_bytes(4, 'little').hex())
+        tx.deserialize()
+        return tx
+
+    def wait_for(self, cond):
+        t0 = time.time()
+        while not cond():
+            self.assertLess(time.time() - t0, 5.0)
+            time.sleep(0.01)
+
+    def test_concurrent_fetches_share_requests(self):
+        network = FetchNetworkMock({self.prevout_hash: self.prevout_raw})
+        wallet = SimpleNamespace(network=network, transactions={}, get_local_height=lambda: 0)
+        tx1, tx2 = self.spender(1), self.spender(2)
+        done = []
+        self.assertTrue(tx1.fetch_input_data(wallet, done_callback=done.append, done_args=(1,)))
+        self.assertTrue(tx2.fetch_input_data(wallet, done_callback=done.append, done_args=(2,)))
+        # one tx request, plus a block height request per tx
+        self.wait_for(lambda: len(network.requests) == 3)
+        self.assertEqual(1, sum(1 for params, _cb in network.requests if len(params) == 1))
+        network.answer_all()
+        self.wait_for(lambda: len(done) == 2)
+        for tx in (tx1, tx2):
+            self.assertEqual(0, tx.fetched_inputs()[0]['value'])
+        # the tx went to the disk cache too, and is found there once it has
+        # dropped out of the in-memory cache
+        disk_cache = transaction.Transaction._tx_disk_cache
+        self.wait_for(lambda: not disk_cache.pending)
+        transaction.Transaction._fetched_tx_cache.d.pop(self.prevout_hash)
+        self.assertEqual(self.prevout_raw, transaction.Transaction.tx_cache_get(self.prevout_hash).raw)
+
+    def test_disk_cache_prune(self):
+        cache = RawTxDiskCache(self.tmpdir, max_bytes=1000)
+        raws = [bytes([i]) * 100 for i in range(15)]
+        for raw in raws:
+            cache.put(bitcoin.Hash(raw)[::-1].hex(), raw)
+        self.wait_for(lambda: not cache.pending and cache.size is not None and cache.size <= 1000)
+        self.assertIsNone(cache.get('../' + '0' * 61))
+        self.assertEqual(raws[14], cache.get(bitcoin.Hash(raws[14])[::-1].hex()))
+
+    def test_disk_cache_corrupt_file(self):
+        cache = RawTxDiskCache(self.tmpdir)
+        cache.put(self.prevout_hash, bytes.fromhex(self.prevout_raw))
+        self.wait_for(lambda: not cache.pending)
+        fn = cache._file(self.prevout_hash)
+        with open(fn, 'r+b') as f:
+            f.truncate(10)
+        self.assertIsNone(cache.get(self.prevout_hash))
+        self.assertFalse(os.path.exists(fn))
+
+
+class TestSign(unittest.TestCase):
+
+    privkey = 'Kz7FS9Adyj6RgSVGx5YLjZPanUhuze4yvcziZ1qLA24a3GJJZvBr'
+
+    def make_tx(self, n_inputs, sign_schnorr):
+        txin_type, privkey, compressed = bitcoin.deserialize_privkey(self.privkey)
+        pubkey = bitcoin.public_key_from_private_key(privkey, compressed)
+        addr = Address.from_pubkey(pubkey)
+        inputs = [{'address': addr, 'type': txin_type, 'prevout_hash': '%064x' % (i + 1),
+                   'prevout_n': 0, 'value': 10000, 'pubkeys': [pubkey],
+                   'x_pubkeys': [pubkey], 'signatures': [None], 'num_sig': 1}
+                  for i in range(n_inputs)]
+        tx = transaction.Transaction.from_io(inputs, [(TYPE_ADDRESS, addr, 10000 * n_inputs - 1000)],
+                                             sign_schnorr=sign_schnorr)
+        return tx, {pubkey: (privkey, compressed)}
+
+    def test_sign_in_process_pool(self):
+        for sign_schnorr in (False, True):
+            tx, keypairs = self.make_tx(4, sign_schnorr)
+            tx.sign(keypairs)
+            self.assertTrue(tx.is_complete())
+            tx2, keypairs = self.make_tx(4, sign_schnorr)
+            with unittest.mock.patch.object(transaction.Transaction, 'PARALLEL_SIGN_MIN', 2):
+                tx2.sign(keypairs, workers=2)
+            self.assertEqual(str(tx), str(tx2))
+
+    def test_verify_signatures(self):
+        items = []
+        for sign_schnorr in (False, True):
+            tx, keypairs = self.make_tx(2, sign_schnorr)
+            tx.sign(keypairs)
+            for i, txin in enumerate(tx.inputs()):
+                pre_hash = bitcoin.Hash(bytes.fromhex(tx.serialize_preimage(i)))
+                items.append((bytes.fromhex(txin['pubkeys'][0]), bytes.fromhex(txin['signatures'][0][:-2]), pre_hash))
+        good = list(items)
+        items.append(good[0][:2] + (good[1][2],))  # ecdsa sig for another input
+        items.append(good[2][:2] + (good[3][2],))  # schnorr sig for another input
+        order = ecdsa.SECP256k1.order
+        items.append((good[0][0], ecdsa.util.sigencode_der(2**300, 5, order), good[0][2]))  # r too wide
+        items.append((good[0][0], ecdsa.util.sigencode_der(5, order, order), good[0][2]))  # s out of range
+        items.append((good[0][0], b'', good[0][2]))  # bad arguments
+        expected = [True] * 4 + [False] * 5
+        self.assertEqual(expected, transaction.Transaction.verify_signatures(items))
+        self.assertEqual(expected, [transaction.Transaction.verify_signature(*item) for item in items[:-1]] + [False])
+
+    def test_update_signatures(self):
+        tx, keypairs = self.make_tx(3, False)
+        tx.sign(keypairs)
+        signatures = [txin['signatures'][0][:-2] for txin in tx.inputs()]
+        tx2, keypairs = self.make_tx(3, False)
+        signatures[1] = signatures[0]  # bad
+        tx2.update_signatures(signatures)
+        self.assertEqual([1, 0, 1], [len(list(filter(None, txin['signatures']))) for txin in tx2.inputs()])
@@ -1,5 +1,5 @@
 import unittest
-from ..util import format_satoshis
+from ..util import format_satoshis, DaemonThread, ThreadJob, HeightIndex
 from ..web import parse_URI
 
 class TestUtil(unittest.TestCase):
@@ -110,3 +110,59 @@ class TestUtil(unittest.TestCase):
 
     def test_parse_URI_parameter_polution(self):
         self.assertRaises(Exception, parse_URI, 'bitcoincash:15mKKb2eos1hWa6tisdPwwDC1a5J1y9nma?amount=0.0003&label=test&amount=30.0')
+
+
+class Job(ThreadJob):
+    def __init__(self, run_interval=None):
+        self.run_interval = run_interval
+        self.runs = 0
+    def run(self):
+        self.runs += 1
+
+class TestDaemonThread(unittest.TestCase):
+
+    def test_run_jobs(self):
+        thread = DaemonThread()
+        polled, scheduled = Job(), Job(run_interval=3600)
+        thread.add_jobs([polled, scheduled])
+        for i in range(3):
+            thread.run_jobs()
+        self.assertEqual(3, polled.runs)
+        self.assertEqual(1, scheduled.runs)  # runs once when added
+        scheduled.wakeup()
+        thread.run_jobs()
+        self.assertEqual(2, scheduled.runs)
+        scheduled._next_run = 0  # due
+        thread.run_jobs()
+        self.assertEqual(3, scheduled.runs)
+        stats = thread.get_job_stats()
+        self.assertEqual([5, 3], [s['run_count'] for s in stats])
+
+    def test_run_duck_typed_job(self):
+        class DuckJob:
+            # like the plugins that return [self] from thread_jobs()
+            runs = 0
+            def run(self):
+                self.runs += 1
+        thread = DaemonThread()
+        duck, job = DuckJob(), Job()
+        thread.add_jobs([duck, job])
+        thread.run_jobs()
+        thread.run_jobs()
+        self.assertEqual(2, duck.runs)
+        self.assertEqual(2, job.runs)
+        self.assertEqual([2, 2], [s['run_count'] for s in thread.get_job_stats()])
+
+
+class TestHeightIndex(unittest.TestCase):
+
+    def test_keys_from(self):
+        index = HeightIndex([('a', 10), ('b', 5), ('c', 20)])
+        self.assertEqual(['a', 'c'], index.keys_from(10))
+        index.add('d', 10)
+        index.add('c', 7)  # moves it
+        index.discard('b')
+        index.discard('x')
+        self.assertEqual(3, len(index))
+        self.assertEqual(['c', 'a', 'd'], index.keys_from(0))
+        self.assertEqual([], index.keys_from(11))
@@ -0,0 +1,71 @@
+import unittest
+import unittest.mock
+
+from ..bitcoin import Hash, hash_decode, hash_encode
+from ..verifier import SPV, SPVDelegate
+
+
+class Delegate(SPVDelegate):
+
+    def __init__(self, unverified):
+        self.unverified = dict(unverified)
+        self.verified = {}
+        self.saved = 0
+
+    def get_unverified_txs(self):
+        return dict(self.unverified)
+
+    def add_verified_tx(self, tx_hash, height_ts_pos_tup, header):
+        del self.unverified[tx_hash]
+        self.verified[tx_hash] = height_ts_pos_tup
+
+    def is_up_to_date(self):
+        return True
+
+    def save_verified_tx(self, write=False):
+        self.saved += 1
+
+    def undo_verifications(self, blkchain, height):
+        return set()
+
+    def verification_failed(self, tx_hash, reason):
+        self.verified[tx_hash] = reason
+
+    def diagnostic_name(self):
+        return 'test'
+
+
+class TestSPV(unittest.TestCase):
+
+    def test_proofs_are_requested_and_verified_in_bulk(self):
+        # a block with 4 tx's, 3 of which are ours
+        txids = [hash_encode(Hash(bytes([i]))) for i in range(4)]
+        leaves = [hash_decode(txid) for txid in txids]
+        nodes = [Hash(leaves[0] + leaves[1]), Hash(leaves[2] + leaves[3])]
+        root = hash_encode(Hash(nodes[0] + nodes[1]))
+        def proof(pos):
+            return {'block_height': 100, 'pos': pos,
+                    'merkle': [hash_encode(leaves[pos ^ 1]), hash_encode(nodes[(pos >> 1) ^ 1])]}
+
+        network = unittest.mock.Mock()
+        network.get_local_height.return_value = 100
+        network.blockchain().read_header.return_value = {'merkle_root': root, 'timestamp': 1234}
+        delegate = Delegate({txids[0]: 100, txids[1]: 100, txids[3]: 100})
+        spv = SPV(network, delegate)
+        spv.run()
+        (requests, callback), kwargs = network.send.call_args
+        self.assertEqual(3, len(requests))
+        self.assertEqual({txids[0], txids[1], txids[3]}, {params[0] for method, params in requests})
+
+        network.blockchain().read_header.reset_mock()
+        for method, params in requests:
+            pos = txids.index(params[0])
+            response = {'method': method, 'params': params, 'result': proof(pos)}
+            if pos == 3:
+                response['result']['merkle'][0] = txids[0]  # bad proof
+            callback(response)
+        spv.run()
+        self.assertEqual({txids[0]: (100, 1234, 0), txids[1]: (100, 1234, 1), txids[3]: 'merkle_mismatch'},
+                         delegate.verified)
+        network.blockchain().read_header.assert_called_once_with(100)
+        self.assertEqual(0, delegate.saved)  # the bad one is still pending
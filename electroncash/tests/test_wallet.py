@@ -2,15 +2,22 @@ import shutil
 import tempfile
 import sys
 import unittest
+import unittest.mock
 import os
 import json
+import threading
+import time
 
 from io import StringIO
-from ..storage import WalletStorage, FINAL_SEED_VERSION
+from ..storage import WalletStorage, FINAL_SEED_VERSION, JOURNAL_COMPACT_MAX_RECORDS
+from .. import keystore
 from .. import wallet
 from ..wallet import create_new_wallet, restore_wallet_from_text
 from ..simple_config import SimpleConfig
 from ..address import Address
+from ..synchronizer import history_status
+from ..transaction import Transaction
+from .. import bitcoin
 
 
 class FakeSynchronizer(object):
@@ -73,6 +80,441 @@ class TestWalletStorage(WalletTestCase):
             contents = f.read()
         self.assertEqual(some_dict, json.loads(contents))
 
+    def test_put_items_and_get_view(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put("txi", {"a": 1, "b": 2})
+        storage.write()
+        self.assertFalse(storage.modified)
+
+        view = storage.get_view("txi")
+        with self.assertRaises(TypeError):
+            view["c"] = 3
+        storage.put_items("txi", {"c": 3}, removed=["a"])
+        self.assertTrue(storage.modified)
+        self.assertEqual({"b": 2, "c": 3}, dict(view))  # views are live
+        storage.put_items("new_key", {"x": [1]})
+        storage.write()
+
+        storage2 = WalletStorage(self.wallet_path)
+        self.assertEqual({"b": 2, "c": 3}, storage2.get("txi"))
+        self.assertEqual({"x": [1]}, storage2.get("new_key"))
+
+    def test_journal_appends_only_changes(self):
+        storage = WalletStorage(self.wallet_path)
+        txs = {"%064x" % i: "00" * 100 for i in range(100)}
+        storage.put("transactions", txs)
+        storage.put("labels", {"a": "b"})
+        storage.write()
+        self.assertTrue(storage.convert_to_journal())
+        size_before = os.path.getsize(self.wallet_path)
+
+        txs["%064x" % 1000] = "11" * 100
+        del txs["%064x" % 0]
+        storage.put("transactions", txs)
+        storage.put("labels", None)
+        storage.write()
+        # only the new tx (and the deletions) got appended to the file
+        self.assertLess(os.path.getsize(self.wallet_path) - size_before, 500)
+
+        storage2 = WalletStorage(self.wallet_path)
+        self.assertTrue(storage2.is_journal())
+        self.assertEqual(txs, storage2.get("transactions"))
+        self.assertIsNone(storage2.get("labels"))
+        self.assertEqual(FINAL_SEED_VERSION, storage2.get("seed_version"))
+
+    def test_journal_truncated_record_is_dropped(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put("a", {"x": 1})
+        storage.convert_to_journal()
+        storage.put("a", {"x": 2})
+        storage.write()
+        with open(self.wallet_path, "a") as f:
+            f.write('{"put":{"a":')  # simulate a crash in the middle of an append
+        storage2 = WalletStorage(self.wallet_path)
+        self.assertEqual({"x": 2}, storage2.get("a"))
+        # the next write compacts the journal, dropping the truncated record
+        storage2.put("a", {"x": 3})
+        storage2.write()
+        self.assertEqual({"x": 3}, WalletStorage(self.wallet_path).get("a"))
+
+    def test_journal_encrypted(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put("a", {"x": 1})
+        storage.set_password("secret", encrypt=True)
+        storage.convert_to_journal()
+        storage.put("a", {"x": 1, "y": 2})
+        storage.write()
+
+        storage2 = WalletStorage(self.wallet_path)
+        self.assertTrue(storage2.is_encrypted())
+        storage2.decrypt("secret")
+        self.assertEqual({"x": 1, "y": 2}, storage2.get("a"))
+
+    def test_journal_binary_section(self):
+        addr = Address.from_string('qrrqa5sv8xrg7lrq3l4c3ememxfwwsa09gcgf0r5jf').to_storage_string()
+        txid = lambda i: "%064x" % i
+        data = {
+            "transactions": {txid(i): "ab" * 50 for i in range(100)},
+            "txi": {txid(1): {addr: [[txid(5) + ":3", 1000]]}},
+            "txo": {txid(1): {addr: [[0, 1000, False]]}},
+            "addr_history": {addr: [[txid(1), 100], [txid(2), -1]]},
+            "tx_fees": {txid(1): 226},
+        }
+        storage = WalletStorage(self.wallet_path)
+        for key, value in data.items():
+            storage.put(key, value)
+        storage.convert_to_journal()
+
+        storage2 = WalletStorage(self.wallet_path)
+        for key, value in data.items():
+            self.assertEqual(value, storage2.get(key))
+        # changes to a key stored in the binary section survive compaction
+        storage2.put_items("transactions", {txid(1000): "cd"}, removed=[txid(0)])
+        storage2.write()
+        storage2._journal_records = JOURNAL_COMPACT_MAX_RECORDS
+        storage2.put_items("transactions", {txid(1001): "ef"})
+        storage2.write()
+        # ... as does a key that can't be stored in binary form
+        storage2.put("addr_history", {"not an address": []})
+        storage2._journal_records = JOURNAL_COMPACT_MAX_RECORDS
+        storage2.write()
+
+        storage3 = WalletStorage(self.wallet_path)
+        txs = storage3.get("transactions")
+        self.assertEqual(101, len(txs))
+        self.assertNotIn(txid(0), txs)
+        self.assertEqual("cd", txs[txid(1000)])
+        self.assertEqual("ef", txs[txid(1001)])
+        self.assertEqual({"not an address": []}, storage3.get("addr_history"))
+        self.assertEqual(data["txi"], storage3.get("txi"))
+
+    def test_journal_compaction_keeps_views_readable(self):
+        addr = Address.from_string('qrrqa5sv8xrg7lrq3l4c3ememxfwwsa09gcgf0r5jf').to_storage_string()
+        txid = lambda i: "%064x" % i
+        storage = WalletStorage(self.wallet_path)
+        storage.put("transactions", {txid(i): "ab" * 50 for i in range(10)})
+        storage.put("addr_history", {addr: [[txid(1), 100]]})
+        storage.convert_to_journal()
+
+        storage2 = WalletStorage(self.wallet_path)
+        txs, hist = storage2.get_view("transactions"), storage2.get_view("addr_history")
+        storage2.put_items("transactions", {txid(1000): "cd"})
+        # addr_history can't go in the binary section anymore, so it's moved
+        # into memory before the old section is closed
+        storage2.put_items("addr_history", {"not an address": []})
+        storage2._journal_records = JOURNAL_COMPACT_MAX_RECORDS
+        storage2.write()
+        self.assertEqual("cd", txs[txid(1000)])
+        self.assertEqual("ab" * 50, txs[txid(1)])
+        self.assertEqual({addr: [[txid(1), 100]], "not an address": []}, dict(hist))
+
+        # if the file can't be replaced while it's mapped (Windows), the
+        # section is closed first and the replace retried
+        real_replace = os.replace
+        def replace(src, dst):
+            if storage2._binary:
+                raise PermissionError
+            real_replace(src, dst)
+        storage2.put_items("transactions", {txid(1001): "ef"})
+        storage2._journal_records = JOURNAL_COMPACT_MAX_RECORDS
+        with unittest.mock.patch("os.replace", replace):
+            storage2.write()
+        self.assertEqual("ef", txs[txid(1001)])
+        self.assertEqual(12, len(WalletStorage(self.wallet_path).get("transactions")))
+
+class TestTransactionStore(unittest.TestCase):
+
+    def test_store_keeps_raw_and_caches_objects(self):
+        store = wallet.TransactionStore(maxlen=2)
+        txs = {"%064x" % i: "%02x" % i * 10 for i in range(4)}
+        for tx_hash, raw in txs.items():
+            store.set_raw(tx_hash, raw)
+        self.assertEqual(4, len(store))
+        self.assertEqual(txs, dict(store.raw_items()))
+        tx0 = store["%064x" % 0]
+        self.assertEqual(txs["%064x" % 0], tx0.raw)
+        self.assertIs(tx0, store.get("%064x" % 0))  # cached
+        store["%064x" % 1], store["%064x" % 2]
+        self.assertEqual(2, len(store._cache))  # bounded
+        self.assertIsNot(tx0, store.get("%064x" % 0))
+        del store["%064x" % 3]
+        self.assertNotIn("%064x" % 3, store)
+        self.assertIsNone(store.get_raw("%064x" % 3))
+
+    def test_iterate_while_view_changes(self):
+        view = {"%064x" % i: "%02x" % i * 10 for i in range(4)}
+        stores = [wallet.TransactionStore(get_view=lambda: view), wallet.TxIOStore(lambda: view)]
+        for store in stores:
+            it = iter(store)
+            first = next(it)
+            # as a put_items() on another thread would
+            view["%064x" % 4] = "04" * 10
+            del view[first]
+            self.assertEqual(3, len(list(it)))
+            view[first] = "%02x" % int(first, 16) * 10
+            del view["%064x" % 4]
+        self.assertEqual(4, len(list(stores[1].items())))
+
+
+class TestWalletTransactions(WalletTestCase):
+    ''' Feeds hand-made transactions to a single-key wallet '''
+
+    privkey = 'Kz7FS9Adyj6RgSVGx5YLjZPanUhuze4yvcziZ1qLA24a3GJJZvBr'
+    other = Address.from_string('qr2q6aadv6nxmqwjt8qmax76yqp09mlqzq5jsz5fe9')
+
+    def setUp(self):
+        super().setUp()
+        d = restore_wallet_from_text(self.privkey, path=self.wallet_path, config=self.config)
+        self.wallet = d['wallet']
+        self.addr = self.wallet.get_addresses()[0]
+        self.wallet._history[self.addr] = []
+
+    def make_tx(self, prevouts, outputs):
+        ''' prevouts is a list of (prevout_hash, n, value) spent from our
+        address, outputs a list of (Address, value). '''
+        txin_type, privkey, compressed = bitcoin.deserialize_privkey(self.privkey)
+        pubkey = bitcoin.public_key_from_private_key(privkey, compressed)
+        inputs = [{'address': self.addr, 'type': txin_type, 'prevout_hash': h,
+                   'prevout_n': n, 'value': v, 'pubkeys': [pubkey],
+                   'x_pubkeys': [pubkey], 'signatures': [None], 'num_sig': 1}
+                  for h, n, v in prevouts]
+        tx = Transaction.from_io(inputs, [(bitcoin.TYPE_ADDRESS, addr, v) for addr, v in outputs])
+        tx.sign({pubkey: (privkey, compressed)})
+        tx = Transaction(str(tx))
+        return tx.txid(), tx
+
+    def add_tx(self, tx_hash, tx, height):
+        hist = self.wallet.get_address_history(self.addr) + [(tx_hash, height)]
+        self.wallet.receive_history_callback(self.addr, hist, {})
+        self.wallet.add_transaction(tx_hash, tx)
+
+    def test_outpoint_index(self):
+        w = self.wallet
+        tx1_hash, tx1 = self.make_tx([('ab' * 32, 0, 300000)], [(self.addr, 200000), (self.other, 90000)])
+        self.add_tx(tx1_hash, tx1, 100)
+        ser = tx1_hash + ':0'
+        self.assertEqual((self.addr, 200000, False, frozenset()), w.get_outpoint(ser))
+        self.assertIsNone(w.get_outpoint(tx1_hash + ':1'))  # not ours
+        self.assertEqual([ser], [c['prevout_hash'] + ':%d' % c['prevout_n'] for c in w.get_utxos()])
+
+        tx2_hash, tx2 = self.make_tx([(tx1_hash, 0, 200000)], [(self.other, 190000)])
+        self.add_tx(tx2_hash, tx2, 101)
+        self.assertEqual({tx2_hash}, w.get_outpoint(ser)[3])
+        self.assertEqual([], w.get_utxos())
+        self.assertEqual(-200000, w.get_wallet_delta(tx2).v)
+        self.assertEqual((0, 0, 0), w.get_addr_balance(self.addr))
+
+        w.remove_transaction(tx2_hash)
+        self.assertEqual(frozenset(), w.get_outpoint(ser)[3])
+        self.assertEqual(1, len(w.get_utxos()))
+        # removing the funding tx moves its spend back to pruned_txo
+        self.add_tx(tx2_hash, tx2, 101)
+        w.remove_transaction(tx1_hash)
+        self.assertIsNone(w.get_outpoint(ser))
+        self.assertEqual(tx2_hash, w.pruned_txo[ser])
+        self.assertEqual({}, w.txi[tx2_hash])
+        # ... and re-adding it hooks the spend up again
+        w.add_transaction(tx1_hash, tx1)
+        self.assertEqual({tx2_hash}, w.get_outpoint(ser)[3])
+        self.assertNotIn(ser, w.pruned_txo)
+
+    def test_outpoint_double_spend(self):
+        w = self.wallet
+        tx1_hash, tx1 = self.make_tx([('ab' * 32, 0, 300000)], [(self.addr, 200000)])
+        tx2_hash, tx2 = self.make_tx([(tx1_hash, 0, 200000)], [(self.other, 190000)])
+        tx3_hash, tx3 = self.make_tx([(tx1_hash, 0, 200000)], [(self.other, 180000)])
+        self.add_tx(tx1_hash, tx1, 100)
+        self.add_tx(tx2_hash, tx2, 0)
+        self.add_tx(tx3_hash, tx3, 0)  # conflicts with tx2
+        ser = tx1_hash + ':0'
+        self.assertEqual({tx2_hash, tx3_hash}, w.get_outpoint(ser)[3])
+        self.assertEqual({ser: 0}, w.get_addr_io(self.addr)[1])
+        w.remove_transaction(tx2_hash)
+        self.assertEqual({tx3_hash}, w.get_outpoint(ser)[3])
+        self.assertEqual([], w.get_utxos())  # still spent by tx3
+        # removing the funding tx undoes the spends of both
+        self.add_tx(tx2_hash, tx2, 0)
+        w.remove_transaction(tx1_hash)
+        self.assertEqual({}, w.txi[tx2_hash])
+        self.assertEqual({}, w.txi[tx3_hash])
+
+    def test_utxo_set(self):
+        w = self.wallet
+        tx1_hash, tx1 = self.make_tx([('ab' * 32, 0, 300000)], [(self.addr, 100000), (self.addr, 150000)])
+        self.add_tx(tx1_hash, tx1, 0)
+        coins = w.get_utxos()
+        self.assertEqual([0, 1], [c['prevout_n'] for c in coins])
+        self.assertEqual([], w.get_utxos(confirmed_only=True))
+        w.add_unverified_tx(tx1_hash, 100)
+        self.assertEqual(100, w.get_utxos(confirmed_only=True)[0]['height'])
+
+        w.set_frozen_coin_state([tx1_hash + ':1'], True)
+        self.assertEqual([0], [c['prevout_n'] for c in w.get_utxos(exclude_frozen=True)])
+        w.set_frozen_state([self.addr], True)
+        self.assertEqual([], w.get_utxos(exclude_frozen=True))
+        self.assertEqual([], w.get_utxos(domain=[self.other]))
+
+        tx2_hash, tx2 = self.make_tx([(tx1_hash, 1, 150000)], [(self.other, 140000)])
+        self.add_tx(tx2_hash, tx2, 0)
+        self.assertEqual({tx1_hash + ':0'}, set(w.get_addr_utxo(self.addr)))
+        self.assertNotIn(tx1_hash + ':1', w.frozen_coins)  # spent coins get unfrozen
+
+    def test_running_balance(self):
+        w = self.wallet
+        tx1_hash, tx1 = self.make_tx([('ab' * 32, 0, 300000)], [(self.addr, 100000), (self.addr, 150000)])
+        self.add_tx(tx1_hash, tx1, 100)
+        self.assertEqual((250000, 0, 0), w.get_balance())
+        w.set_frozen_coin_state([tx1_hash + ':1'], True)
+        self.assertEqual((100000, 0, 0), w.get_balance(exclude_frozen_coins=True))
+        self.assertEqual((150000, 0, 0), w.get_frozen_balance())
+        w.set_frozen_state([self.addr], True)
+        self.assertEqual((0, 0, 0), w.get_balance(exclude_frozen_addresses=True))
+        self.assertEqual((250000, 0, 0), w.get_frozen_balance())
+
+        tx2_hash, tx2 = self.make_tx([(tx1_hash, 0, 100000)], [(self.other, 90000)])
+        self.add_tx(tx2_hash, tx2, 0)
+        self.assertEqual((250000, -100000, 0), w.get_balance())
+        w.remove_transaction(tx2_hash)
+        self.assertEqual((250000, 0, 0), w.get_balance())
+        self.assertEqual(w.get_balance(w.get_addresses()), w.get_balance())
+
+    def test_history_index(self):
+        w = self.wallet
+        tx1_hash, tx1 = self.make_tx([('ab' * 32, 0, 300000)], [(self.addr, 250000)])
+        tx2_hash, tx2 = self.make_tx([(tx1_hash, 0, 250000)], [(self.addr, 200000), (self.other, 40000)])
+        tx3_hash, tx3 = self.make_tx([(tx2_hash, 0, 200000)], [(self.other, 190000)])
+        self.add_tx(tx2_hash, tx2, 0)
+        self.add_tx(tx1_hash, tx1, 100)
+        h = w.get_history()
+        self.assertEqual([tx1_hash, tx2_hash], [item.tx_hash for item in h])
+        self.assertEqual([None, -50000], [item.amount for item in h])  # tx1 spends a coin we don't know about
+        self.assertEqual([250000, 200000], [item.balance for item in h])
+        self.assertEqual(w.get_history(w.get_addresses()), h)
+
+        self.add_tx(tx3_hash, tx3, 0)
+        w.network = unittest.mock.Mock()
+        w.network.get_local_height.return_value = 110
+        w.add_verified_tx(tx2_hash, (101, 1234, 5), None)
+        h = w.get_history(reverse=True)
+        self.assertEqual([tx3_hash, tx2_hash, tx1_hash], [item.tx_hash for item in h])
+        self.assertEqual([0, 200000, 250000], [item.balance for item in h])
+        self.assertEqual((101, 10, 1234), (h[1].height, h[1].conf, h[1].timestamp))
+        self.assertEqual(w.get_history(w.get_addresses(), reverse=True), h)
+        self.assertEqual(h[1:2], w.get_history(reverse=True, offset=1, limit=1))
+        self.assertEqual(h[::-1][1:], w.get_history(offset=1))
+
+    def test_history_index_ties(self):
+        w = self.wallet
+        prev = [('ab' * 32, 0, 300000)]
+        for i in range(4):
+            tx_hash, tx = self.make_tx(prev, [(self.addr, 290000 - 10000 * i)])
+            self.add_tx(tx_hash, tx, 0)  # all unconfirmed, at the same txpos
+            prev = [(tx_hash, 0, 290000 - 10000 * i)]
+            self.assertEqual(w.get_history(w.get_addresses()), w.get_history())
+        w._hist_index = None  # built in one go, rather than tx by tx
+        self.assertEqual(w.get_history(w.get_addresses()), w.get_history())
+        self.assertEqual(w.get_history(w.get_addresses(), reverse=True), w.get_history(reverse=True))
+
+    def test_export_history_pages(self):
+        w = self.wallet
+        tx1_hash, tx1 = self.make_tx([('ab' * 32, 0, 300000)], [(self.addr, 250000)])
+        tx2_hash, tx2 = self.make_tx([(tx1_hash, 0, 250000)], [(self.addr, 200000), (self.other, 40000)])
+        tx3_hash, tx3 = self.make_tx([(tx2_hash, 0, 200000)], [(self.other, 190000)])
+        w.network = unittest.mock.Mock()
+        w.network.get_local_height.return_value = 110
+        for height, (tx_hash, tx) in enumerate([(tx1_hash, tx1), (tx2_hash, tx2), (tx3_hash, tx3)], 100):
+            self.add_tx(tx_hash, tx, height)
+            w.add_verified_tx(tx_hash, (height, 1000 + height, 0), None)
+        full = w.export_history(show_addresses=True)
+        self.assertEqual([tx3_hash, tx2_hash, tx1_hash], [item['txid'] for item in full])
+        self.assertEqual(['0.0001', '0.0001', '--'], [item['fee'] for item in full])
+        self.assertEqual(10000, w.tx_fees[tx2_hash])  # fetched from wallet inputs and cached
+        self.assertEqual(full, list(w.iter_history_export(show_addresses=True, page_size=1)))
+        # resuming after an item, and after an item which has since gone away
+        first = full[0]
+        self.assertEqual(full[1:2], w.export_history(show_addresses=True, limit=1,
+                                                     cursor=(first['timestamp'], first['txid'])))
+        self.assertEqual(full[2:], w.export_history(show_addresses=True,
+                                                    cursor=(full[1]['timestamp'], 'ff' * 32)))
+        self.assertEqual(full[1:2], w.export_history(show_addresses=True, from_timestamp=1101, to_timestamp=1102))
+        # a tx arriving during the export doesn't shift the pages
+        items = w.iter_history_export(page_size=1)
+        self.assertEqual(tx3_hash, next(items)['txid'])
+        tx4_hash, tx4 = self.make_tx([('cd' * 32, 0, 60000)], [(self.addr, 50000)])
+        self.add_tx(tx4_hash, tx4, 0)
+        self.assertEqual([tx2_hash, tx1_hash], [item['txid'] for item in items])
+        # fetching inputs is done on copies of the wallet's (shared) tx's
+        shared = [w.transactions[tx_hash] for tx_hash in (tx1_hash, tx4_hash)]
+        with unittest.mock.patch.object(Transaction, 'fetch_input_data', autospec=True,
+                                        return_value=False) as fetch_input_data:
+            self.assertEqual(4, len(list(w.iter_history_export())))
+        fetched = [args[0] for args, kwargs in fetch_input_data.call_args_list]
+        self.assertEqual([tx4_hash, tx1_hash], [tx.txid() for tx in fetched])
+        self.assertFalse(any(tx is shared_tx for tx in fetched for shared_tx in shared))
+
+    def test_address_status(self):
+        w = self.wallet
+        self.assertIsNone(w.get_address_status(self.addr))
+        tx1_hash, tx1 = self.make_tx([('ab' * 32, 0, 300000)], [(self.addr, 250000)])
+        tx2_hash, tx2 = self.make_tx([(tx1_hash, 0, 250000)], [(self.other, 240000)])
+        self.add_tx(tx1_hash, tx1, 100)
+        status = w.get_address_status(self.addr)
+        self.assertEqual(history_status([(tx1_hash, 100)]), status)
+        w.save_transactions(write=True)
+        self.assertEqual({self.addr.to_storage_string(): status},
+                         WalletStorage(self.wallet_path).get('addr_status'))
+        # another client rewrites the history, leaving addr_status alone
+        storage = WalletStorage(self.wallet_path)
+        storage.put('addr_history', {self.addr.to_storage_string(): [[tx1_hash, 101]]})
+        storage.write()
+        w2 = wallet.Wallet(WalletStorage(self.wallet_path))
+        self.assertEqual(history_status([(tx1_hash, 101)]), w2.get_address_status(self.addr))
+        # a local tx changes the history
+        w.add_transaction(tx2_hash, tx2)
+        w.add_tx_to_history(tx2_hash)
+        self.assertEqual(history_status([(tx1_hash, 100), (tx2_hash, 0)]),
+                         w.get_address_status(self.addr))
+
+
+    def test_load_transactions_lazily(self):
+        w = self.wallet
+        tx1_hash, tx1 = self.make_tx([('ab' * 32, 0, 300000)], [(self.addr, 250000)])
+        tx2_hash, tx2 = self.make_tx([(tx1_hash, 0, 250000)], [(self.addr, 200000), (self.other, 40000)])
+        self.add_tx(tx1_hash, tx1, 100)
+        self.add_tx(tx2_hash, tx2, 101)
+        w.save_transactions()
+        w.storage.convert_to_journal()
+
+        w2 = wallet.Wallet(WalletStorage(self.wallet_path))
+        # nothing was copied out of the binary section at load
+        self.assertEqual({}, w2.txi._entries)
+        self.assertEqual({}, w2.txo._entries)
+        self.assertEqual({}, w2.transactions._raw)
+        self.assertEqual({tx1_hash, tx2_hash}, set(w2.transactions))
+        self.assertEqual(tx2.raw, w2.transactions[tx2_hash].raw)
+        self.assertEqual([[tx1_hash + ':0', 250000]], [list(x) for x in w2.txi[tx2_hash][self.addr]])
+        self.assertEqual([tx2_hash + ':0'], [c['prevout_hash'] + ':%d' % c['prevout_n'] for c in w2.get_utxos()])
+        w2.remove_transaction(tx2_hash)
+        self.assertNotIn(tx2_hash, w2.txi)
+        self.assertEqual([tx1_hash + ':0'], [c['prevout_hash'] + ':%d' % c['prevout_n'] for c in w2.get_utxos()])
+
+    def test_undo_verifications(self):
+        w = self.wallet
+        tx1_hash, tx1 = self.make_tx([('ab' * 32, 0, 300000)], [(self.addr, 250000)])
+        tx2_hash, tx2 = self.make_tx([(tx1_hash, 0, 250000)], [(self.addr, 200000), (self.other, 40000)])
+        w.network = unittest.mock.Mock()
+        w.network.get_local_height.return_value = 110
+        for height, (tx_hash, tx) in ((100, (tx1_hash, tx1)), (105, (tx2_hash, tx2))):
+            self.add_tx(tx_hash, tx, height)
+            w.add_verified_tx(tx_hash, (height, 1000 + height, 0), None)
+        chain = unittest.mock.Mock()
+        chain.read_header.return_value = {'timestamp': 2000}  # block 105 got reorged
+        self.assertEqual({tx2_hash}, w.undo_verifications(chain, 103))
+        chain.read_header.assert_called_once_with(105)  # tx1 was not looked at
+        self.assertEqual([tx1_hash], list(w.verified_tx))
+        self.assertEqual([tx1_hash], w._verified_heights.keys_from(0))
+        self.assertEqual(set(), w.undo_verifications(chain, 103))
+
 class TestCreateRestoreWallet(WalletTestCase):
 
     def test_create_new_wallet(self):
@@ -114,6 +556,96 @@ class TestCreateRestoreWallet(WalletTestCase):
         self.assertEqual(text, wallet.keystore.get_master_public_key())
         self.assertEqual(Address.from_string('qzrseeup3rhehuaf9e6nr3sgm6t5eegufu96l404mu'), wallet.get_receiving_addresses()[0])
 
+    def test_synchronize_gap_limit(self):
+        text = 'xpub6CUzEfgtza7ZNtfDGYwHPnbPMPiQh93mAbP6v7C3ozUgkZq4tXSgYb9qqZ62oh8RCeexdSF7ZJmTzCm5bdWLB3zSMF8rNfuY8kccNAsdF4d'
+        wallet = restore_wallet_from_text(text, path=self.wallet_path, config=self.config)['wallet']
+        wallet.storage.put('stored_height', 101)
+        wallet.synchronize()
+        self.assertEqual((20, 20), (len(wallet.get_receiving_addresses()), len(wallet.get_change_addresses())))
+        addr = wallet.get_receiving_addresses()[5]
+        wallet.receive_history_callback(addr, [('ab' * 32, 100)], {})
+        wallet.synchronize()
+        self.assertEqual(20, len(wallet.get_receiving_addresses()))  # not old yet
+        with unittest.mock.patch.object(wallet, 'address_is_old') as address_is_old:
+            wallet.storage.put('stored_height', 102)
+            wallet.synchronize()
+            address_is_old.assert_not_called()
+        self.assertEqual(26, len(wallet.get_receiving_addresses()))
+        self.assertEqual(20, len(wallet.get_change_addresses()))
+        self.assertTrue(wallet.address_is_old(addr))
+
+    def test_synchronize_gap_limit_old_history(self):
+        text = 'xpub6CUzEfgtza7ZNtfDGYwHPnbPMPiQh93mAbP6v7C3ozUgkZq4tXSgYb9qqZ62oh8RCeexdSF7ZJmTzCm5bdWLB3zSMF8rNfuY8kccNAsdF4d'
+        wallet = restore_wallet_from_text(text, path=self.wallet_path, config=self.config)['wallet']
+        wallet.storage.put('stored_height', 1000)
+        wallet.synchronize()
+        self.assertEqual(20, len(wallet.get_receiving_addresses()))
+        # as when restoring, the history is already old when it comes in
+        addr = wallet.get_receiving_addresses()[19]
+        wallet.receive_history_callback(addr, [('ab' * 32, 50)], {})
+        self.assertTrue(wallet.address_is_old(addr))
+        wallet.synchronize()
+        self.assertEqual(40, len(wallet.get_receiving_addresses()))
+        self.assertEqual(20, len(wallet.get_change_addresses()))
+
+    def test_derive_pubkeys_range(self):
+        text = 'xpub6CUzEfgtza7ZNtfDGYwHPnbPMPiQh93mAbP6v7C3ozUgkZq4tXSgYb9qqZ62oh8RCeexdSF7ZJmTzCm5bdWLB3zSMF8rNfuY8kccNAsdF4d'
+        ks = restore_wallet_from_text(text, path=self.wallet_path, config=self.config)['wallet'].keystore
+        pubkeys = ks.derive_pubkeys_range(True, 3, 4)
+        self.assertEqual([ks.get_pubkey_from_xpub(text, (1, n)) for n in range(3, 7)], pubkeys)
+        self.assertEqual(pubkeys[1], ks.derive_pubkey(True, 4))
+
+    def test_derive_pubkeys_range_threads(self):
+        text = 'xpub6CUzEfgtza7ZNtfDGYwHPnbPMPiQh93mAbP6v7C3ozUgkZq4tXSgYb9qqZ62oh8RCeexdSF7ZJmTzCm5bdWLB3zSMF8rNfuY8kccNAsdF4d'
+        ks = restore_wallet_from_text(text, path=self.wallet_path, config=self.config)['wallet'].keystore
+        have = len(ks._pubkey_cache[1]) // 33
+        derive = ks._derive_pubkeys
+        def slow_derive(for_change, sequence):
+            time.sleep(0.1)  # let the other thread in, if it can
+            return derive(for_change, sequence)
+        with unittest.mock.patch.object(ks, '_derive_pubkeys', side_effect=slow_derive):
+            threads = [threading.Thread(target=ks.derive_pubkeys_range, args=(True, have, n))
+                       for n in (2, 5)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        self.assertEqual(have + 5, len(ks._pubkey_cache[1]) // 33)
+        self.assertEqual([ks.get_pubkey_from_xpub(text, (1, n)) for n in range(have, have + 5)],
+                         [ks.get_cached_pubkey(1, n) for n in range(have, have + 5)])
+
+    def test_pubkey_cache(self):
+        text = 'xpub6CUzEfgtza7ZNtfDGYwHPnbPMPiQh93mAbP6v7C3ozUgkZq4tXSgYb9qqZ62oh8RCeexdSF7ZJmTzCm5bdWLB3zSMF8rNfuY8kccNAsdF4d'
+        w = restore_wallet_from_text(text, path=self.wallet_path, config=self.config)['wallet']
+        addr = w.get_change_addresses()[7]
+        pubkey = w.get_public_key(addr)
+        x_pubkey = w.keystore.get_xpubkey(True, 7)
+        w.save_addresses()
+        w.storage.write()
+        # reopened, the keys come from the wallet file
+        w = wallet.Standard_Wallet(WalletStorage(self.wallet_path))
+        with unittest.mock.patch.object(keystore, 'CKD_pub', side_effect=AssertionError):
+            self.assertEqual(pubkey, w.get_public_key(addr))
+            self.assertEqual(pubkey, keystore.xpubkey_to_pubkey(x_pubkey))
+        self.assertEqual(20, len(w.storage.get('pubkey_cache')['0/1/0']) // 66)
+        # a new address only rewrites the last chunk of its branch
+        w.storage.convert_to_journal()
+        w.storage._dirty.clear()
+        w.create_new_address(for_change=True)
+        self.assertEqual({'0/1/0'}, w.storage._dirty['pubkey_cache'])
+        for n in range(w.PUBKEY_CACHE_CHUNK):
+            w.create_new_address(for_change=False, save=False)
+        w.storage._dirty.clear()
+        w.save_addresses()
+        self.assertEqual({'0/0/0', '0/0/1'}, w.storage._dirty['pubkey_cache'])
+
+    def test_get_address_index_without_addresses(self):
+        text = 'xpub6CUzEfgtza7ZNtfDGYwHPnbPMPiQh93mAbP6v7C3ozUgkZq4tXSgYb9qqZ62oh8RCeexdSF7ZJmTzCm5bdWLB3zSMF8rNfuY8kccNAsdF4d'
+        w = restore_wallet_from_text(text, path=self.wallet_path, config=self.config)['wallet']
+        addr = w.get_receiving_addresses()[3]
+        w._gap_addr_index = {}  # as right after _init_gap_state() with no addresses
+        self.assertEqual((False, 3), w.get_address_index(addr))
+
     def test_restore_wallet_from_text_xprv(self):
         text = 'xprv9y4nb6Akxru8R68sYGrihutfqUgMNxmiF83ViTf65MobJrRRyHWc1M8mSZJSmZ1nQCJntxmF99sKGkkcQQGziECvdkwA4kqxsH5srNAzRin'
         d = restore_wallet_from_text(text, path=self.wallet_path, config=self.config)
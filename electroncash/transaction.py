@@ -34,9 +34,14 @@ from .bitcoin import *
 from .address import (PublicKey, Address, Script, ScriptOutput, hash160,
                       UnknownAddress, OpCodes as opcodes,
                       P2PKH_prefix, P2PKH_suffix, P2SH_prefix, P2SH_suffix)
+from . import ecc_fast
 from . import schnorr
 from . import util
+import concurrent.futures
+import os
 import struct
+import threading
+import time
 import warnings
 
 #
@@ -373,11 +378,37 @@ def multisig_script(public_keys, m):
 
 
 
+def _sign_preimage(job):
+    ''' Makes one signature for Transaction.sign. Only takes and returns
+    picklable things, so that it can be run in a process pool. Returns
+    (pubkey hex, signature bytes, failure reason); the signature is None if it
+    failed to verify. '''
+    sec, compressed, preimage, sign_schnorr, ndata, verify = job
+    pubkey = public_key_from_private_key(sec, compressed)
+    pre_hash = Hash(preimage)
+    if sign_schnorr:
+        sig = schnorr.sign(sec, pre_hash, ndata=ndata)
+    else:
+        sig = Transaction._ecdsa_sign(sec, pre_hash, check=False)
+    reason = []
+    if verify and not Transaction.verify_signature(bfh(pubkey), sig, pre_hash, reason=reason):
+        return pubkey, None, str(reason)
+    return pubkey, sig, None
+
+
 class Transaction:
 
     SIGHASH_FORKID = 0x40  # do not use this; deprecated
     FORKID = 0x000000  # do not use this; deprecated
 
+    # Number of processes sign() uses by default, see sign(). Set from the
+    # 'sign_workers' config key at startup.
+    sign_workers = 1
+    # ... but only for transactions needing at least this many signatures
+    PARALLEL_SIGN_MIN = 64
+    # verify_signatures() splits batches at least this big across threads
+    PARALLEL_VERIFY_MIN = 256
+
     def __str__(self):
         if self.raw is None:
             self.raw = self.serialize()
@@ -472,6 +503,10 @@ class Transaction:
             raise Exception('API changed: update_signatures expects a list.')
         if len(self.inputs()) != len(signatures):
             raise Exception('expected {} signatures; got {}'.format(len(self.inputs()), len(signatures)))
+        # see which pubkey matches each sig (in non-multisig only 1 pubkey,
+        # in multisig may be multiple pubkeys), verifying them all in one batch
+        todo, items = [], []
+        self.calc_common_sighash()  # so that serialize_preimage can use the cache below
         for i, txin in enumerate(self.inputs()):
             pubkeys, x_pubkeys = self.get_sorted_pubkeys(txin)
             sig = signatures[i]
@@ -482,19 +517,21 @@ class Transaction:
             if sig_final in txin.get('signatures'):
                 # skip if we already have this signature
                 continue
-            pre_hash = Hash(bfh(self.serialize_preimage(i)))
+            pre_hash = Hash(bfh(self.serialize_preimage(i, use_cache=True)))
             sig_bytes = bfh(sig)
+            todo.append((i, pubkeys, sig, pre_hash, len(items)))
+            items.extend((bfh(pubkey), sig_bytes, pre_hash) for pubkey in pubkeys)
+        results = self.verify_signatures(items)
+        for i, pubkeys, sig, pre_hash, first in todo:
+            sig_final = sig + '41'
             added = False
-            reason = []
             for j, pubkey in enumerate(pubkeys):
-                # see which pubkey matches this sig (in non-multisig only 1 pubkey, in multisig may be multiple pubkeys)
-                if self.verify_signature(bfh(pubkey), sig_bytes, pre_hash, reason):
+                if results[first + j]:
                     print_error("adding sig", i, j, pubkey, sig_final)
                     self._inputs[i]['signatures'][j] = sig_final
                     added = True
             if not added:
-                resn = ', '.join(reversed(reason)) if reason else ''
-                print_error("failed to add signature {} for any pubkey for reason(s): '{}' ; pubkey(s) / sig / pre_hash = ".format(i, resn),
+                print_error("failed to add signature {} for any pubkey; pubkey(s) / sig / pre_hash = ".format(i),
                             pubkeys, '/', sig, '/', bh2u(pre_hash))
         # redo raw
         self.raw = self.serialize()
@@ -923,30 +960,79 @@ class Transaction:
             return False
 
 
+    @classmethod
+    def verify_signatures(cls, items, *, workers=None):
+        ''' Batch version of verify_signature(). `items` is a list of
+        (pubkey, sig, msghash) bytes triples, Schnorr and ECDSA signatures may
+        be mixed. Returns a list of bools, with False for items with bad
+        arguments.
+
+        With libsecp256k1, pubkeys are parsed once per batch, and batches of
+        at least PARALLEL_VERIFY_MIN items are split across `workers` threads
+        (default: the number of CPUs), as the library releases the GIL. '''
+        items = list(items)
+        if workers is None:
+            workers = os.cpu_count() or 1
+        if workers > 1 and len(items) >= cls.PARALLEL_VERIFY_MIN and ecc_fast.is_using_fast_ecc():
+            n = -(-len(items) // workers)
+            chunks = [items[k:k+n] for k in range(0, len(items), n)]
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+                return [ok for results in pool.map(cls._verify_signatures, chunks) for ok in results]
+        return cls._verify_signatures(items)
+
+    @classmethod
+    def _verify_signatures(cls, items):
+        results = [False] * len(items)
+        schnorr_idx, ecdsa_idx = [], []
+        for k, (pubkey, sig, msghash) in enumerate(items):
+            if (any(not arg or not isinstance(arg, bytes) for arg in (pubkey, sig, msghash))
+                    or len(msghash) != 32):
+                continue
+            (schnorr_idx if len(sig) == 64 else ecdsa_idx).append(k)
+        for k, ok in zip(schnorr_idx, schnorr.verify_batch([items[k] for k in schnorr_idx])):
+            results[k] = ok
+        ecdsa_items = [items[k] for k in ecdsa_idx]
+        oks = ecc_fast.ecdsa_verify_batch(ecdsa_items)
+        if oks is None:
+            oks = [cls.verify_signature(*item) for item in ecdsa_items]
+        for k, ok in zip(ecdsa_idx, oks):
+            results[k] = ok
+        return results
+
     @staticmethod
-    def _ecdsa_sign(sec, pre_hash):
+    def _ecdsa_sign(sec, pre_hash, *, check=True):
         pkey = regenerate_key(sec)
         secexp = pkey.secret
         private_key = MySigningKey.from_secret_exponent(secexp, curve = SECP256k1)
-        public_key = private_key.get_verifying_key()
         sig = private_key.sign_digest_deterministic(pre_hash, hashfunc=hashlib.sha256, sigencode = ecdsa.util.sigencode_der)
-        assert public_key.verify_digest(sig, pre_hash, sigdecode = ecdsa.util.sigdecode_der)
+        if check:
+            public_key = private_key.get_verifying_key()
+            assert public_key.verify_digest(sig, pre_hash, sigdecode = ecdsa.util.sigdecode_der)
         return sig
 
-    @staticmethod
-    def _schnorr_sign(pubkey, sec, pre_hash, *, ndata=None):
-        pubkey = bytes.fromhex(pubkey)
-        sig = schnorr.sign(sec, pre_hash, ndata=ndata)
-        assert schnorr.verify(pubkey, sig, pre_hash)  # verify what we just signed
-        return sig
+    def sign(self, keypairs, *, use_cache=False, ndata=None, workers=None, verify=True):
+        ''' Signs the inputs we have keys for. `keypairs` maps pubkeys or
+        x_pubkeys to (privkey, compressed) tuples.
 
-    def sign(self, keypairs, *, use_cache=False, ndata=None):
+        The common sighash parts are computed once. If the tx needs at least
+        PARALLEL_SIGN_MIN signatures, they are made in a pool of `workers`
+        processes (default: self.sign_workers), which get the private keys
+        involved. With `verify`, each signature is checked right after it is
+        made (in the same process) and dropped if it is bad. '''
+        nHashType = 0x00000041 # hardcoded, perhaps should be taken from unsigned input dict
+        self.calc_common_sighash(use_cache=use_cache)
+        todo, jobs = [], []
         for i, txin in enumerate(self.inputs()):
+            if self.is_txin_complete(txin):
+                continue
             pubkeys, x_pubkeys = self.get_sorted_pubkeys(txin)
+            needed = txin.get('num_sig', 1) - len(list(filter(None, txin['signatures'])))
+            preimage = None
             for j, (pubkey, x_pubkey) in enumerate(zip(pubkeys, x_pubkeys)):
-                if self.is_txin_complete(txin):
-                    # txin is complete
+                if needed <= 0:
                     break
+                if txin['signatures'][j]:
+                    continue
                 if pubkey in keypairs:
                     _pubkey = pubkey
                     kname = 'pubkey'
@@ -957,29 +1043,29 @@ class Transaction:
                     continue
                 print_error(f"adding signature for input#{i} sig#{j}; {kname}: {_pubkey} schnorr: {self._sign_schnorr}")
                 sec, compressed = keypairs.get(_pubkey)
-                self._sign_txin(i, j, sec, compressed, use_cache=use_cache, ndata=ndata)
+                if preimage is None:
+                    # the common sighash was just computed, so the cache is good
+                    preimage = bfh(self.serialize_preimage(i, nHashType, use_cache=True))
+                todo.append((i, j))
+                jobs.append((sec, compressed, preimage, self._sign_schnorr, ndata, verify))
+                needed -= 1
+        if workers is None:
+            workers = self.sign_workers
+        if workers > 1 and len(jobs) >= self.PARALLEL_SIGN_MIN:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+                results = list(pool.map(_sign_preimage, jobs, chunksize=max(1, len(jobs) // (4 * workers))))
+        else:
+            results = map(_sign_preimage, jobs)
+        for (i, j), (pubkey, sig, reason) in zip(todo, results):
+            if sig is None:
+                print_error(f"Signature verification failed for input#{i} sig#{j}, reason: {reason}")
+                continue
+            txin = self._inputs[i]
+            txin['signatures'][j] = bh2u(sig + bytes((nHashType & 0xff,)))
+            txin['pubkeys'][j] = pubkey # needed for fd keys
         print_error("is_complete", self.is_complete())
         self.raw = self.serialize()
 
-    def _sign_txin(self, i, j, sec, compressed, *, use_cache=False, ndata=None):
-        '''Note: precondition is self._inputs is valid (ie: tx is already deserialized)'''
-        pubkey = public_key_from_private_key(sec, compressed)
-        # add signature
-        nHashType = 0x00000041 # hardcoded, perhaps should be taken from unsigned input dict
-        pre_hash = Hash(bfh(self.serialize_preimage(i, nHashType, use_cache=use_cache)))
-        if self._sign_schnorr:
-            sig = self._schnorr_sign(pubkey, sec, pre_hash, ndata=ndata)
-        else:
-            sig = self._ecdsa_sign(sec, pre_hash)
-        reason = []
-        if not self.verify_signature(bfh(pubkey), sig, pre_hash, reason=reason):
-            print_error(f"Signature verification failed for input#{i} sig#{j}, reason: {str(reason)}")
-            return None
-        txin = self._inputs[i]
-        txin['signatures'][j] = bh2u(sig + bytes((nHashType & 0xff,)))
-        txin['pubkeys'][j] = pubkey # needed for fd keys
-        return txin
-
     def get_outputs(self):
         """convert pubkeys to addresses"""
         o = []
@@ -1024,6 +1110,16 @@ class Transaction:
     # code, otherwise the cache may grow to 10x memory consumption if you
     # put deserialized tx's in here.
     _fetched_tx_cache = ExpiringCache(maxlen=1000, name="TransactionFetchCache")
+    # Optional persistent backing store for the above (a caches.RawTxDiskCache),
+    # so that fetched tx's survive restarts. See set_tx_disk_cache.
+    _tx_disk_cache = None
+
+    # txid -> [time requested, set of queues waiting for the reply], for the
+    # 'blockchain.transaction.get' requests issued by fetch_input_data. This
+    # lets concurrent fetches share a single network request per txid.
+    _fetch_inflight = dict()
+    _fetch_inflight_lock = threading.Lock()
+    _fetch_inflight_timeout = 20.0  # seconds after which a request is re-issued
 
     def fetch_input_data(self, wallet, done_callback=None, done_args=tuple(),
                          prog_callback=None, *, force=False, use_network=True):
@@ -1048,8 +1144,10 @@ class Transaction:
         progress after inputs are retrieved, and it is passed a single arg,
         "percent" (eg: 5.1, 10.3, 26.3, 76.1, etc) to indicate percent progress.
 
-        Note 1: Results (fetched transactions) are cached, so subsequent
-        calls to this function for the same transaction are cheap.
+        Note 1: Results (fetched transactions) are cached (on disk too, if
+        set_tx_disk_cache was called), so subsequent calls to this function
+        for the same transaction are cheap. Concurrent calls needing the same
+        prevout tx share a single network request.
 
         Note 2: Multiple, rapid calls to this function will cause the previous
         asynchronous fetch operation (if active) to be canceled and only the
@@ -1071,9 +1169,7 @@ class Transaction:
         eph['fetched_inputs'] = inps = inps.copy()  # paranoia: in case another thread is running on this list
         # Lazy imports to keep this functionality very self-contained
         # These modules are always available so no need to globally import them.
-        import threading
         import queue
-        import time
         from copy import deepcopy
         from collections import defaultdict
         t0 = time.time()
@@ -1167,39 +1263,8 @@ class Transaction:
                     # Next, queue the transaction.get requests, spreading them
                     # out randomly over the connected interfaces
                     q = queue.Queue()
-                    q_ct = 0
-                    bad_txids = set()
-                    def put_in_queue_and_cache(r):
-                        ''' we cache the results directly in the network callback
-                        as even if the user cancels the operation, we would like
-                        to save the returned tx in our cache, since we did the
-                        work to retrieve it anyway. '''
-                        q.put(r)  # put the result in the queue no matter what it is
-                        txid = ''
-                        try:
-                            # Below will raise if response was 'error' or
-                            # otherwise invalid. Note: for performance reasons
-                            # we don't validate the tx here or deserialize it as
-                            # this function runs in the network thread and we
-                            # don't want to eat up that thread's CPU time
-                            # needlessly. Also note the cache doesn't store
-                            # deserializd tx's so as to save memory. We
-                            # always deserialize a copy when reading the cache.
-                            tx = Transaction(r['result'])
-                            txid = r['params'][0]
-                            assert txid == cls._txid(tx.raw), "txid-is-sane-check"  # protection against phony responses
-                            cls.tx_cache_put(tx=tx, txid=txid)  # save tx to cache here
-                        except Exception as e:
-                            # response was not valid, ignore (don't cache)
-                            if txid:  # txid may be '' if KeyError from r['result'] above
-                                bad_txids.add(txid)
-                            print_error("fetch_input_data: put_in_queue_and_cache fail for txid:", txid, repr(e))
-                    for txid, l in need_dl_txids.items():
-                        wallet.network.queue_request('blockchain.transaction.get', [txid],
-                                                     interface='random',
-                                                     callback=put_in_queue_and_cache)
-                        callback_funcs_to_cancel.add(put_in_queue_and_cache)
-                        q_ct += 1
+                    cls._fetch_txs(wallet.network, need_dl_txids, q)
+                    q_ct = len(need_dl_txids)
 
                     def get_bh():
                         if eph.get('block_height'):
@@ -1245,7 +1310,6 @@ class Transaction:
                                 raise ErrorResp(msg)
                             rawhex = r['result']
                             txid = r['params'][0]
-                            assert txid not in bad_txids, "txid marked bad"  # skip if was marked bad by our callback code
                             tx = Transaction(rawhex); tx.deserialize()
                             for item in need_dl_txids[txid]:
                                 ii, n = item
@@ -1266,6 +1330,9 @@ class Transaction:
                     # crucial on error/timeout/failure.
                     for func in callback_funcs_to_cancel:
                         wallet.network.cancel_requests(func)
+                    # the tx requests themselves may be shared with other
+                    # fetches, so they are left to complete (and be cached)
+                    cls._fetch_forget(need_dl_txids, q)
             if len(inps) == len(self._inputs) and eph.get('_fetch') == t:  # sanity check
                 eph.pop('_fetch', None)  # potential race condition here, popping wrong t -- but in practice w/ CPython threading it won't matter
                 print_error(f"fetch_input_data: elapsed {(time.time()-t0):.4f} sec")
@@ -1305,12 +1372,81 @@ class Transaction:
         ''' Cancels the currently-active running fetch operation, if any '''
         return bool(self.ephemeral.pop('_fetch', None))
 
+    @classmethod
+    def _fetch_txs(cls, network, txids, q):
+        ''' Requests the raw tx's for `txids` from the network. A reply dict
+        for each txid (see _on_fetched_tx) is put to queue `q`. Tx's already
+        being fetched for another caller are not requested again. New requests
+        are spread over the connected interfaces in contiguous runs, so that
+        each server gets a pipeline of requests to work on. '''
+        now = time.time()
+        to_request = []
+        with cls._fetch_inflight_lock:
+            for txid in txids:
+                ent = cls._fetch_inflight.get(txid)
+                if ent is None or now - ent[0] > cls._fetch_inflight_timeout:
+                    ent = cls._fetch_inflight[txid] = [now, ent[1] if ent else set()]
+                    to_request.append(txid)
+                ent[1].add(q)
+        interfaces = network.get_interfaces(interfaces=True) or [None]
+        run = -(-len(to_request) // len(interfaces))  # ceil
+        for i, txid in enumerate(to_request):
+            network.queue_request('blockchain.transaction.get', [txid],
+                                  interface=interfaces[i // run],
+                                  callback=cls._on_fetched_tx)
+
+    @classmethod
+    def _fetch_forget(cls, txids, q):
+        ''' Stop delivering replies for `txids` to `q`. '''
+        with cls._fetch_inflight_lock:
+            for txid in txids:
+                ent = cls._fetch_inflight.get(txid)
+                if ent:
+                    ent[1].discard(q)
+
+    @classmethod
+    def _on_fetched_tx(cls, r):
+        ''' Network callback for the requests issued by _fetch_txs. We cache
+        the results directly in the network callback as even if the user
+        cancels the operation, we would like to save the returned tx in our
+        cache, since we did the work to retrieve it anyway. '''
+        txid = ''
+        try:
+            txid = r['params'][0]
+            if not r.get('error'):
+                # Note: for performance reasons we don't deserialize the tx
+                # here as this function runs in the network thread. Also note
+                # the cache doesn't store deserializd tx's so as to save memory.
+                tx = Transaction(r['result'])
+                assert txid == cls._txid(tx.raw), "txid-is-sane-check"  # protection against phony responses
+                cls.tx_cache_put(tx=tx, txid=txid)  # save tx to cache here
+        except Exception as e:
+            # response was not valid, don't cache it
+            print_error("fetch_input_data: bad reply for txid:", txid, repr(e))
+            r = {'params': [txid], 'error': repr(e)}
+        with cls._fetch_inflight_lock:
+            ent = cls._fetch_inflight.pop(txid, None)
+        for q in (ent[1] if ent else ()):
+            q.put(r)
+
+    @classmethod
+    def set_tx_disk_cache(cls, cache):
+        ''' Sets (or with None, clears) the persistent cache used to back
+        the in-memory tx cache. '''
+        cls._tx_disk_cache = cache
+
     @classmethod
     def tx_cache_get(cls, txid : str) -> object:
         ''' Attempts to retrieve txid from the tx cache that this class
-        keeps in-memory.  Returns None on failure. The returned tx is
-        not deserialized, and is a copy of the one in the cache. '''
+        keeps in-memory (or, failing that, on disk).  Returns None on failure.
+        The returned tx is not deserialized, and is a copy of the one in the
+        cache. '''
         tx = cls._fetched_tx_cache.get(txid)
+        if tx is None and cls._tx_disk_cache:
+            raw = cls._tx_disk_cache.get(txid)
+            if raw:
+                tx = Transaction(raw.hex())
+                cls._fetched_tx_cache.put(txid, tx)
         if tx is not None and tx.raw:
             # make sure to return a copy of the transaction from the cache
             # so that if caller does .deserialize(), *his* instance will
@@ -1319,13 +1455,23 @@ class Transaction:
             return Transaction(tx.raw)
         return None
 
+    @classmethod
+    def tx_cache_remove(cls, txid : str):
+        ''' Drops txid from the in-memory tx cache and the disk cache. '''
+        cls._fetched_tx_cache.d.pop(txid, None)  # despite appearances, this is atomic (thread-safe)
+        if cls._tx_disk_cache:
+            cls._tx_disk_cache.discard(txid)
+
     @classmethod
     def tx_cache_put(cls, tx : object, txid : str = None):
-        ''' Puts a non-deserialized copy of tx into the tx_cache. '''
+        ''' Puts a non-deserialized copy of tx into the tx_cache (and the
+        disk cache, if any). '''
         if not tx or not tx.raw:
             raise ValueError('Please pass a tx which has a valid .raw attribute!')
         txid = txid or cls._txid(tx.raw)  # optionally, caller can pass-in txid to save CPU time for hashing
         cls._fetched_tx_cache.put(txid, Transaction(tx.raw))
+        if cls._tx_disk_cache:
+            cls._tx_disk_cache.put(txid, bytes.fromhex(tx.raw))
 
 
 def tx_from_str(txt):
@@ -22,6 +22,7 @@
 # SOFTWARE.
 
 import binascii
+import bisect
 import os, sys, re, json, time
 from collections import defaultdict
 from datetime import datetime
@@ -142,12 +143,33 @@ class PrintError:
 class ThreadJob(ABC, PrintError):
     """A job that is run periodically from a thread's main loop.  run() is
     called from that thread's context.
+
+    By default run() is called on every iteration of the loop. Jobs that set
+    run_interval are only run when woken up with wakeup() (by whatever gives
+    them something to do), or else every run_interval seconds.
     """
 
+    run_interval = None
+    _wakeup_pending = True  # so that the job runs once when added
+    _next_run = 0.0
+    # timing stats, see DaemonThread.get_job_stats()
+    run_count = 0
+    run_time = 0.0
+    max_run_time = 0.0
+
     @abstractmethod
     def run(self):
         """Called periodically from the thread"""
 
+    def wakeup(self):
+        """Makes the job run on the next iteration of the thread's loop. May
+        be called from any thread."""
+        self._wakeup_pending = True
+
+    def is_due(self, now):
+        return (self.run_interval is None or self._wakeup_pending
+                or now >= self._next_run)
+
 class DebugMem(ThreadJob):
     '''A handy class for debugging GC memory leaks'''
     def __init__(self, classes, interval=30):
@@ -220,9 +242,26 @@ class DaemonThread(threading.Thread, PrintError):
 
     def run_jobs(self):
         with self.job_lock:
+            now = time.time()
             for job in self.jobs:
                 try:
-                    job.run()
+                    # Jobs need not subclass ThreadJob (e.g. plugins that
+                    # return [self] from thread_jobs()); those are always due.
+                    is_due = getattr(job, 'is_due', None)
+                    if is_due is not None and not is_due(now):
+                        continue
+                    job._wakeup_pending = False
+                    run_interval = getattr(job, 'run_interval', None)
+                    if run_interval is not None:
+                        job._next_run = now + run_interval
+                    t0 = time.perf_counter()
+                    try:
+                        job.run()
+                    finally:
+                        elapsed = time.perf_counter() - t0
+                        job.run_count = getattr(job, 'run_count', 0) + 1
+                        job.run_time = getattr(job, 'run_time', 0.0) + elapsed
+                        job.max_run_time = max(getattr(job, 'max_run_time', 0.0), elapsed)
                 except Exception as e:
                     # Don't let a throwing job disrupt the thread, future runs of
                     # itself, or other jobs.  This is useful protection against
@@ -241,6 +280,16 @@ class DaemonThread(threading.Thread, PrintError):
                     self.print_error("Job removed", rmjob)
             self._jobs2rm.clear()
 
+    def get_job_stats(self):
+        """Returns a list of dicts with the number of times each job was run,
+        and the total and longest time it took, in seconds."""
+        with self.job_lock:
+            return [{'job': (job.diagnostic_name() if isinstance(job, PrintError) else str(job)),
+                     'run_count': getattr(job, 'run_count', 0),
+                     'run_time': getattr(job, 'run_time', 0.0),
+                     'max_run_time': getattr(job, 'max_run_time', 0.0)}
+                    for job in self.jobs]
+
     def start(self):
         with self.running_lock:
             self.running = True
@@ -296,6 +345,50 @@ class Monotonic:
                 with lock: return incr()
             self.__call__ = incr_with_lock
 
+class HeightIndex:
+    ''' Keeps a set of keys (eg tx hashes) sorted by block height, so that
+    the keys at or above a given height can be found without scanning all of
+    them. Used to quickly find the verified tx's affected by a reorg. Not
+    thread-safe; callers should use their own lock. '''
+
+    def __init__(self, items=()):
+        ''' `items` is an iterable of (key, height) pairs '''
+        self._heights = dict(items)  # key -> height
+        self._sorted = sorted((h, k) for k, h in self._heights.items())
+
+    def __len__(self):
+        return len(self._heights)
+
+    def __contains__(self, key):
+        return key in self._heights
+
+    def add(self, key, height):
+        ''' Adds key at height, moving it if it was already in the index at
+        another height. '''
+        old = self._heights.get(key)
+        if old == height:
+            return
+        if old is not None:
+            self.discard(key)
+        self._heights[key] = height
+        bisect.insort(self._sorted, (height, key))
+
+    def discard(self, key):
+        height = self._heights.pop(key, None)
+        if height is None:
+            return
+        i = bisect.bisect_left(self._sorted, (height, key))
+        del self._sorted[i]
+
+    def keys_from(self, height):
+        ''' Returns a list of the keys at or above height, lowest first. '''
+        i = bisect.bisect_left(self._sorted, (height,))
+        return [k for h, k in self._sorted[i:]]
+
+    def clear(self):
+        self._heights.clear()
+        self._sorted.clear()
+
 _human_readable_thread_ids = defaultdict(Monotonic(locking=False))  # locking not needed on Monotonic instance as we lock the dict anyway
 _human_readable_thread_ids_lock = threading.Lock()
 _t0 = time.time()
@@ -715,6 +808,7 @@ class JSONSocketPipe(PrintError):
         self.max_message_bytes = max_message_bytes
         self.recv_buf = bytearray()
         self.send_buf = bytearray()
+        self.last_message_bytes = 0  # size of the last message returned by get()
 
     def idle_time(self):
         return time.time() - self.recv_time
@@ -743,8 +837,10 @@ class JSONSocketPipe(PrintError):
         some known reason, raises .Closed; other errors will raise other exceptions.
         '''
         while True:
+            buf_len = len(self.recv_buf)
             response, self.recv_buf = parse_json(self.recv_buf)
             if response is not None:
+                self.last_message_bytes = buf_len - len(self.recv_buf)
                 return response
 
             try:
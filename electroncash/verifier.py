@@ -92,11 +92,16 @@ class SPV(ThreadJob):
         self.blockchain = network.blockchain()
         self.merkle_roots = {}  # txid -> merkle root (once it has been verified)
         self.requested_merkle = set()  # txid set of pending requests
+        self.proof_responses = []  # received, to be processed by run()
         self.qbusy = False
         self.cleaned_up = False
         self._need_release = False
         self._tick_ct = 0
 
+    # run() is woken up when proofs arrive (and by the wallet when it gets
+    # new unverified tx's), and otherwise checks for new headers every second
+    run_interval = 1.0
+
     def diagnostic_name(self):
         return f"{__class__.__name__}/{self.wallet.diagnostic_name()}"
 
@@ -106,6 +111,7 @@ class SPV(ThreadJob):
         unregister ourselves as a job from within the Network thread itself. '''
         self._need_release = False
         self.cleaned_up = True
+        self.proof_responses = []
         self.network.cancel_requests(self.verify_merkle)
         self.network.remove_jobs([self])
 
@@ -113,6 +119,7 @@ class SPV(ThreadJob):
         ''' Called from main thread, enqueues a 'release' to happen in the
         Network thread. '''
         self._need_release = True
+        self.wakeup()
 
     def run(self):
         if self._need_release:
@@ -134,19 +141,42 @@ class SPV(ThreadJob):
             self.spam_error("v.no blockchain", interface.server)
             return
 
-        local_height = self.network.get_local_height()
-        unverified = self.wallet.get_unverified_txs()
-        for tx_hash, tx_height in unverified.items():
-            # do not request merkle branch if we already requested it
-            if tx_hash in self.requested_merkle or tx_hash in self.merkle_roots:
-                continue
-            # or before headers are available
-            if tx_height <= 0 or tx_height > local_height:
-                continue
+        if self.proof_responses:
+            self.process_proofs()
 
+        self.qbusy = len(self.requested_merkle) >= self.MAX_REQUESTED
+        if not self.qbusy:
+            self.request_proofs(interface, blockchain)
+
+        if self.network.blockchain() != self.blockchain:
+            self.blockchain = self.network.blockchain()
+            self.undo_verifications()
+
+    MAX_REQUESTED = 1000  # max. number of proofs requested and not yet processed
+
+    def request_proofs(self, interface, blockchain):
+        ''' Requests the merkle proofs of the unverified tx's, in block
+        order, so that the proofs for a block tend to arrive (and get
+        processed) together. They are sent with network.send, so that they
+        go out as batches. '''
+        local_height = self.network.get_local_height()
+        unverified = sorted((tx_height, tx_hash)
+                            for tx_hash, tx_height in self.wallet.get_unverified_txs().items()
+                            # do not request merkle branch if we already requested it
+                            if tx_hash not in self.requested_merkle and tx_hash not in self.merkle_roots
+                            # or before headers are available
+                            and 0 < tx_height <= local_height)
+        requests = []
+        have_header = {}  # height -> bool
+        for tx_height, tx_hash in unverified:
+            if len(self.requested_merkle) >= self.MAX_REQUESTED:
+                # will try again later
+                self.qbusy = True
+                break
             # if it's in the checkpoint region, we still might not have the header
-            header = blockchain.read_header(tx_height)
-            if header is None:
+            if tx_height not in have_header:
+                have_header[tx_height] = blockchain.read_header(tx_height) is not None
+            if not have_header[tx_height]:
                 if tx_height <= networks.net.VERIFICATION_BLOCK_HEIGHT:
                     # Per-header requests might be a lot heavier.
                     # Also, they're not supported as header requests are
@@ -155,19 +185,11 @@ class SPV(ThreadJob):
                     if self.network.request_chunk(interface, index):
                         interface.print_error("verifier requesting chunk {} for height {}".format(index, tx_height))
                 continue
-            # enqueue request
-            msg_id = self.network.get_merkle_for_transaction(tx_hash, tx_height,
-                                                             self.verify_merkle)
-            self.qbusy = msg_id is None
-            if self.qbusy:
-                # interface queue busy, will try again later
-                break
-            self.print_error('requested merkle', tx_hash)
+            requests.append(('blockchain.transaction.get_merkle', [tx_hash, tx_height]))
             self.requested_merkle.add(tx_hash)
-
-        if self.network.blockchain() != self.blockchain:
-            self.blockchain = self.network.blockchain()
-            self.undo_verifications()
+        if requests:
+            self.print_error('requested {} merkle proofs'.format(len(requests)))
+            self.network.send(requests, self.verify_merkle)
 
     failure_reasons = (
         'inner_node_tx', 'missing_header', 'merkle_mismatch', 'error_response',
@@ -175,8 +197,28 @@ class SPV(ThreadJob):
     )
 
     def verify_merkle(self, response):
+        ''' Called by the network with a merkle proof. They are verified in
+        bulk by process_proofs(), on the next run(). '''
         if self.cleaned_up:
             return  # we have been killed, this was just a delayed callback
+        self.proof_responses.append(response)
+        self.wakeup()
+
+    def process_proofs(self):
+        ''' Verifies the received merkle proofs, reading the header of each
+        block only once, and saves the verified tx's once done. '''
+        responses, self.proof_responses = self.proof_responses, []
+        headers = {}  # height -> header
+        verified = False
+        for response in responses:
+            verified = self.verify_proof(response, headers) or verified
+        if verified and self.is_up_to_date() and self.wallet.is_up_to_date() and not self.qbusy:
+            self.wallet.save_verified_tx(write=True)
+            self.network.trigger_callback('wallet_updated', self.wallet)  # This callback will happen very rarely.. mostly right as the last tx is verified. It's to ensure GUI is updated fully.
+
+    def verify_proof(self, response, headers):
+        ''' Returns True if the tx was verified. `headers` caches the block
+        headers already read. '''
         try:
             params = response.get('params')
             tx_hash = params and params[0]
@@ -198,7 +240,7 @@ class SPV(ThreadJob):
             if tx_hash:
                 self.wallet.verification_failed(tx_hash, freason)
             self.print_error("verify_merkle:", str(e))
-            return
+            return False
 
         try:
             # Verify the hash of the server-provided merkle branch to a
@@ -209,9 +251,11 @@ class SPV(ThreadJob):
         except Exception as e:
             self.print_error(f"exception while verifying tx {tx_hash}: {repr(e)}")
             self.wallet.verification_failed(tx_hash, self.failure_reasons[4])
-            return
+            return False
 
-        header = self.network.blockchain().read_header(tx_height)
+        if tx_height not in headers:
+            headers[tx_height] = self.network.blockchain().read_header(tx_height)
+        header = headers[tx_height]
         # FIXME: if verification fails below,
         # we should make a fresh connection to a server to
         # recover from this, as this TX will now never verify
@@ -220,13 +264,13 @@ class SPV(ThreadJob):
                 "merkle verification failed for {} (missing header {})"
                 .format(tx_hash, tx_height))
             self.wallet.verification_failed(tx_hash, self.failure_reasons[1])
-            return
+            return False
         if header.get('merkle_root') != merkle_root:
             self.print_error(
                 "merkle verification failed for {} (merkle root mismatch {} != {})"
                 .format(tx_hash, header.get('merkle_root'), merkle_root))
             self.wallet.verification_failed(tx_hash, self.failure_reasons[2])
-            return
+            return False
         # we passed all the tests
         self.merkle_roots[tx_hash] = merkle_root
         # note: we could pop in the beginning, but then we would request
@@ -234,9 +278,7 @@ class SPV(ThreadJob):
         self.requested_merkle.discard(tx_hash)
         self.print_error("verified %s" % tx_hash)
         self.wallet.add_verified_tx(tx_hash, (tx_height, header.get('timestamp'), pos), header)
-        if self.is_up_to_date() and self.wallet.is_up_to_date() and not self.qbusy:
-            self.wallet.save_verified_tx(write=True)
-            self.network.trigger_callback('wallet_updated', self.wallet)  # This callback will happen very rarely.. mostly right as the last tx is verified. It's to ensure GUI is updated fully.
+        return True
 
     @classmethod
     def hash_merkle_root(cls, merkle_s, target_hash, pos):
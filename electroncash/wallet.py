@@ -28,6 +28,7 @@
 #   - Multisig_Wallet: several keystores, P2SH
 
 
+import bisect
 import copy
 import errno
 import json
@@ -38,14 +39,15 @@ import queue
 import random
 import threading
 import time
-from collections import defaultdict, namedtuple
+from collections import defaultdict, namedtuple, OrderedDict
+from collections.abc import ItemsView, MutableMapping
 from enum import Enum, auto
 from functools import partial
 from typing import Set, Tuple, Union
 
 from .i18n import ngettext
 from .util import (NotEnoughFunds, ExcessiveFee, PrintError, UserCancelled, profiler, format_satoshis, format_time,
-                   finalization_print_error, to_string)
+                   finalization_print_error, to_string, HeightIndex)
 
 from .address import Address, Script, ScriptOutput, PublicKey, OpCodes
 from .bitcoin import *
@@ -60,7 +62,7 @@ from .transaction import Transaction, InputValueMissing
 from .plugins import run_hook
 from . import bitcoin
 from . import coinchooser
-from .synchronizer import Synchronizer
+from .synchronizer import Synchronizer, history_status
 from .verifier import SPV, SPVDelegate
 from . import schnorr
 from . import ecc_fast
@@ -175,6 +177,319 @@ def sweep(privkeys, network, config, recipient, fee=None, imax=100, sign_schnorr
     return tx
 
 
+class TransactionStore(MutableMapping):
+    ''' A dict-like object mapping tx_hash -> Transaction, used for
+    Abstract_Wallet.transactions.
+
+    Only the raw bytes of each tx are kept. Transaction objects are created on
+    demand and kept in a small LRU cache, so that the (at least partially)
+    deserialized objects of a wallet with many transactions don't all sit in
+    memory at once. A deserialized tx uses on the order of 10x the memory of
+    its raw bytes.
+
+    The tx's the wallet was loaded with are read on demand from `get_view()`,
+    a read-only mapping of tx_hash -> raw tx hex (normally the storage view of
+    the wallet file's 'transactions'), rather than copied in at load time.
+    Only tx's added or removed since then are tracked here. Iterating goes
+    over a snapshot of the keys taken under `view_lock` (normally the storage
+    lock), so that the view may be updated by other threads meanwhile.
+
+    Note that the Transaction returned for a given tx_hash is shared by all
+    callers for as long as it stays in the cache, so callers should not modify
+    it (deserializing it is fine). '''
+
+    def __init__(self, maxlen=1000, get_view=dict, view_lock=None):
+        assert maxlen > 0
+        self.maxlen = maxlen
+        self._get_view = get_view
+        self._view_lock = view_lock or threading.RLock()
+        self._raw = dict()  # tx_hash -> bytes, for tx's set since load
+        self._deleted = set()  # tx_hash's removed from the view
+        self._cache = OrderedDict()  # tx_hash -> Transaction, in LRU order
+        self._lock = threading.Lock()
+
+    def __getitem__(self, tx_hash):
+        with self._lock:
+            tx = self._cache.get(tx_hash)
+            if tx is not None:
+                self._cache.move_to_end(tx_hash)
+                return tx
+            raw = self.get_raw(tx_hash)
+            if raw is None:
+                raise KeyError(tx_hash)
+            tx = Transaction(raw)
+            self._cache_put(tx_hash, tx)
+            return tx
+
+    def __setitem__(self, tx_hash, tx):
+        raw = bytes.fromhex(str(tx))
+        with self._lock:
+            self._raw[tx_hash] = raw
+            self._deleted.discard(tx_hash)
+            self._cache_put(tx_hash, tx)
+
+    def __delitem__(self, tx_hash):
+        with self._lock:
+            if tx_hash not in self:
+                raise KeyError(tx_hash)
+            self._raw.pop(tx_hash, None)
+            self._deleted.add(tx_hash)
+            self._cache.pop(tx_hash, None)
+
+    def __contains__(self, tx_hash):
+        return tx_hash in self._raw or (tx_hash not in self._deleted
+                                        and tx_hash in self._get_view())
+
+    def _keys(self):
+        ''' Returns a snapshot of the keys of the view and of self._raw. '''
+        with self._lock:
+            view = self._get_view()
+            with self._view_lock:
+                return list(view), list(self._raw)
+
+    def __iter__(self):
+        view_keys, raw_keys = self._keys()
+        for tx_hash in view_keys:
+            if tx_hash not in self._raw and tx_hash not in self._deleted:
+                yield tx_hash
+        yield from raw_keys
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def _cache_put(self, tx_hash, tx):
+        self._cache[tx_hash] = tx
+        self._cache.move_to_end(tx_hash)
+        while len(self._cache) > self.maxlen:
+            self._cache.popitem(last=False)
+
+    def set_raw(self, tx_hash, raw):
+        ''' Like self[tx_hash] = Transaction(raw), but without creating a
+        Transaction object. `raw` is the tx in hex. '''
+        raw = bytes.fromhex(raw)
+        with self._lock:
+            self._raw[tx_hash] = raw
+            self._deleted.discard(tx_hash)
+            self._cache.pop(tx_hash, None)
+
+    def get_raw(self, tx_hash):
+        ''' Returns the hex of the tx with hash `tx_hash`, or None if it is not
+        in the store. Doesn't touch the cache. '''
+        raw = self._raw.get(tx_hash)
+        if raw is not None:
+            return raw.hex()
+        if tx_hash in self._deleted:
+            return None
+        return self._get_view().get(tx_hash)
+
+    def raw_items(self):
+        ''' Yields (tx_hash, raw tx hex) pairs. '''
+        for tx_hash in list(self):
+            raw = self.get_raw(tx_hash)
+            if raw is not None:
+                yield tx_hash, raw
+
+    def clear(self):
+        with self._lock:
+            view = self._get_view()
+            with self._view_lock:
+                self._deleted.update(view)
+            self._raw.clear()
+            self._cache.clear()
+
+
+class _TxIOItemsView(ItemsView):
+    def __iter__(self):
+        return self._mapping.iter_items()
+
+
+class TxIOStore(MutableMapping):
+    ''' A dict-like object mapping tx_hash -> {Address: list}, used for
+    Abstract_Wallet.txi and .txo.
+
+    Like TransactionStore, entries are read on demand from `get_view()`, the
+    storage view of the key as stored (with Address strings), and converted
+    with `convert`. Looked-up entries are then kept here, since callers
+    modify them in place. Iterating over items() doesn't keep the entries it
+    converts. '''
+
+    def __init__(self, get_view=dict, convert=None, view_lock=None):
+        self._get_view = get_view
+        self._view_lock = view_lock or threading.RLock()
+        self._convert = convert
+        self._entries = {}  # tx_hash -> {Address: list}, for entries looked up or set
+        self._deleted = set()  # tx_hash's removed from the view
+
+    def _from_view(self, tx_hash):
+        value = self._get_view()[tx_hash]
+        return self._convert(value) if self._convert else value
+
+    def __getitem__(self, tx_hash):
+        d = self._entries.get(tx_hash)
+        if d is not None:
+            return d
+        if tx_hash in self._deleted:
+            raise KeyError(tx_hash)
+        d = self._entries[tx_hash] = self._from_view(tx_hash)
+        return d
+
+    def __setitem__(self, tx_hash, d):
+        self._entries[tx_hash] = d
+        self._deleted.discard(tx_hash)
+
+    def __delitem__(self, tx_hash):
+        if tx_hash not in self:
+            raise KeyError(tx_hash)
+        self._entries.pop(tx_hash, None)
+        self._deleted.add(tx_hash)
+
+    def __contains__(self, tx_hash):
+        return tx_hash in self._entries or (tx_hash not in self._deleted
+                                            and tx_hash in self._get_view())
+
+    def __iter__(self):
+        view = self._get_view()
+        with self._view_lock:
+            view_keys = list(view)
+        for tx_hash in view_keys:
+            if tx_hash not in self._entries and tx_hash not in self._deleted:
+                yield tx_hash
+        yield from list(self._entries)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def iter_items(self):
+        for tx_hash in self:
+            d = self._entries.get(tx_hash)
+            if d is None:
+                try:
+                    d = self._from_view(tx_hash)
+                except KeyError:
+                    continue  # removed since the keys were taken
+            yield tx_hash, d
+
+    def items(self):
+        return _TxIOItemsView(self)
+
+
+class HistoryIndex:
+    ''' The history of the whole wallet, kept sorted by tx position (see
+    Abstract_Wallet.get_txpos), oldest first. Used by get_history().
+
+    For each tx we keep its delta (the effect on the wallet balance, or None
+    if unknown) and running sums of the deltas, so that the balance after any
+    tx can be found without walking the whole history. The index is built in
+    one go with from_entries(), then updated one tx at a time with remove()
+    and insert().
+
+    Tx's with the same position (eg unconfirmed ones) are ordered like
+    get_history() always did: the one seen first, walking the addresses'
+    histories, comes last. Tx's inserted later count as seen after all
+    the others. '''
+
+    def __init__(self):
+        self.keys = []  # sorted list of (txpos, -seen order, tx_hash)
+        self.deltas = []  # delta of each tx in self.keys
+        self.infos = []  # (height, timestamp, is_verified) of each tx in self.keys
+        self.sums = []  # sums[i] = sum of deltas[0:i+1], counting None as 0
+        self.nones = []  # nones[i] = number of None deltas in deltas[0:i+1]
+        self.txpos = {}  # tx_hash -> key in self.keys
+        self.seen = {}  # tx_hash -> order in which it was first seen
+        self._next_seen = 0
+        self._fixup_from = None  # the sums and nones from this index on are stale
+
+    @classmethod
+    def from_entries(cls, entries):
+        ''' Builds the index from a list of (tx_hash, txpos, delta, info), in
+        the order the tx's were seen, with a single sort. '''
+        self = cls()
+        keys = []
+        for seen, (tx_hash, txpos, delta, info) in enumerate(entries):
+            self.seen[tx_hash] = seen
+            keys.append(((txpos, -seen, tx_hash), delta, info))
+        self._next_seen = len(entries)
+        keys.sort(key=lambda e: e[0])
+        s = n = 0
+        for key, delta, info in keys:
+            if delta is None:
+                n += 1
+            else:
+                s += delta
+            self.keys.append(key)
+            self.deltas.append(delta)
+            self.infos.append(info)
+            self.sums.append(s)
+            self.nones.append(n)
+            self.txpos[key[2]] = key
+        return self
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, tx_hash):
+        return tx_hash in self.txpos
+
+    def remove(self, tx_hash):
+        ''' Removes tx_hash, but remembers when it was seen in case it gets
+        re-inserted. Use forget() to drop that too. '''
+        key = self.txpos.pop(tx_hash, None)
+        if key is None:
+            return
+        i = bisect.bisect_left(self.keys, key)
+        for l in (self.keys, self.deltas, self.infos, self.sums, self.nones):
+            del l[i]
+        self._stale(i)
+
+    def forget(self, tx_hash):
+        self.remove(tx_hash)
+        self.seen.pop(tx_hash, None)
+
+    def insert(self, tx_hash, txpos, delta, info):
+        assert tx_hash not in self.txpos
+        seen = self.seen.get(tx_hash)
+        if seen is None:
+            seen = self.seen[tx_hash] = self._next_seen
+            self._next_seen += 1
+        key = (txpos, -seen, tx_hash)
+        i = bisect.bisect_left(self.keys, key)
+        self.keys.insert(i, key)
+        self.deltas.insert(i, delta)
+        self.infos.insert(i, info)
+        self.sums.insert(i, 0)
+        self.nones.insert(i, 0)
+        self.txpos[tx_hash] = key
+        self._stale(i)
+
+    def _stale(self, i):
+        if self._fixup_from is None or i < self._fixup_from:
+            self._fixup_from = i
+
+    def fixup(self):
+        ''' Recomputes the running sums past the first modified entry. '''
+        i = self._fixup_from
+        if i is None:
+            return
+        s = self.sums[i-1] if i > 0 else 0
+        n = self.nones[i-1] if i > 0 else 0
+        for j in range(i, len(self.keys)):
+            d = self.deltas[j]
+            if d is None:
+                n += 1
+            else:
+                s += d
+            self.sums[j] = s
+            self.nones[j] = n
+        self._fixup_from = None
+
+    def balance_after(self, i, balance):
+        ''' Returns the wallet balance right after tx number i, given the
+        current wallet `balance`, or None if unknown. '''
+        if self.nones[-1] - self.nones[i]:
+            return None
+        return balance - (self.sums[-1] - self.sums[i])
+
+
 class Abstract_Wallet(PrintError, SPVDelegate):
     """
     Wallet classes are created to handle various address generation methods.
@@ -215,6 +530,35 @@ class Abstract_Wallet(PrintError, SPVDelegate):
         # Python's GIL makes thread-safe implicitly).
         self._addr_bal_cache = {}
 
+        # Running wallet-wide balance, see get_balance(). self._bal_contrib
+        # holds the (c,u,x) of each address summed into self._bal_total, and
+        # addresses in self._bal_dirty need to be re-summed (they are added
+        # whenever their _addr_bal_cache entry is invalidated). A total of
+        # None means everything needs to be re-summed. Addresses holding
+        # coinbase coins are re-summed whenever the chain height changes, as
+        # their coins may have matured.
+        self._bal_total = None
+        self._bal_contrib = {}
+        self._bal_dirty = set()
+        self._bal_coinbase_addrs = set()
+        self._bal_height = None
+
+        # Sorted history of the whole wallet, see get_history(). Tx's whose
+        # delta or position may have changed are flagged in self._hist_dirty
+        # and re-inserted on the next call. None means it needs a rebuild.
+        self._hist_index = None
+        self._hist_dirty = set()
+
+        # Dirty flags for save_transactions(). Rather than re-serializing and
+        # comparing the entire transactions/txi/txo/tx_fees/addr_history dicts
+        # on each save, we remember which tx hashes and addresses were touched
+        # since the last save and only hand those entries to storage. Code
+        # that modifies the above data structures must flag what it touched.
+        # Access with self.lock held.
+        self._dirty_txs = set()
+        self._dirty_addrs = set()
+        self._save_all = False  # if True, the next save writes everything
+
         # We keep a set of the wallet and receiving addresses so that is_mine()
         # checks are O(logN) rather than O(N). This creates/resets that cache.
         self.invalidate_address_set_cache()
@@ -240,8 +584,20 @@ class Abstract_Wallet(PrintError, SPVDelegate):
         self.change_reserved_tmp = set() # in-memory only
 
         # address -> list(txid, height)
-        history = storage.get('addr_history',{})
-        self._history = self.to_Address_dict(history)
+        history = storage.get_view('addr_history', {})
+        self._history = self.to_Address_dict_copy(history)
+        # address -> status of its history (see synchronizer.history_status),
+        # so that the synchronizer doesn't have to hash each history again on
+        # every start and status notification. Entries are dropped whenever
+        # the history changes, see get_address_status().
+        self._addr_status = {Address.from_string(text): status
+                             for text, status in storage.get_view('addr_status', {}).items()}
+        if not storage.is_journal():
+            # Plain wallet files may have had their addr_history rewritten by
+            # a version that doesn't know about addr_status (journal files
+            # can't be opened by those), so check the saved statuses.
+            self._addr_status = {addr: status for addr, status in self._addr_status.items()
+                                 if status == history_status(self._history.get(addr))}
 
         # there is a difference between wallet.up_to_date and interface.is_up_to_date()
         # interface.is_up_to_date() returns true when all requests have been answered and processed
@@ -269,6 +625,9 @@ class Abstract_Wallet(PrintError, SPVDelegate):
 
         # Verified transactions.  Each value is a (height, timestamp, block_pos) tuple.  Access with self.lock.
         self.verified_tx = storage.get('verified_tx3', {})
+        # self.verified_tx keys by height, so that a reorg only has to look at
+        # the tx's above the fork point. Keep in sync with self.verified_tx.
+        self._verified_heights = HeightIndex((tx_hash, info[0]) for tx_hash, info in self.verified_tx.items())
 
         # save wallet type the first time
         if self.storage.get('wallet_type') is None:
@@ -288,6 +647,7 @@ class Abstract_Wallet(PrintError, SPVDelegate):
         self.load_addresses()
         self.load_transactions()
         self.build_reverse_history()
+        self.build_outpoint_index()
 
         self.check_history()
 
@@ -304,6 +664,13 @@ class Abstract_Wallet(PrintError, SPVDelegate):
         '''Convert a dict of strings to a dict of Adddress objects.'''
         return {Address.from_string(text): value for text, value in d.items()}
 
+    @classmethod
+    def to_Address_dict_copy(cls, d):
+        '''Like to_Address_dict, but also takes a shallow copy of each value.
+        Used on read-only storage views so that we never mutate lists that
+        are owned by the storage object.'''
+        return {Address.from_string(text): list(value) for text, value in d.items()}
+
     @classmethod
     def from_Address_dict(cls, d):
         '''Convert a dict of Address objects to a dict of strings.'''
@@ -389,55 +756,104 @@ class Abstract_Wallet(PrintError, SPVDelegate):
 
     @profiler
     def load_transactions(self):
-        txi = self.storage.get('txi', {})
-        self.txi = {tx_hash: self.to_Address_dict(value)
-                    for tx_hash, value in txi.items()
-                    # skip empty entries to save memory and disk space
-                    if value}
-        txo = self.storage.get('txo', {})
-        self.txo = {tx_hash: self.to_Address_dict(value)
-                    for tx_hash, value in txo.items()
-                    # skip empty entries to save memory and disk space
-                    if value}
-        self.tx_fees = self.storage.get('tx_fees', {})
+        # txi, txo and transactions are read from storage on demand (from
+        # the wallet file's binary section, if it has one) rather than
+        # decoded here. We go through read-only views of storage to avoid
+        # deep-copying them (which would double peak memory).
+        self.txi = TxIOStore(partial(self.storage.get_view, 'txi', {}), self.to_Address_dict_copy,
+                             view_lock=self.storage.lock)
+        self.txo = TxIOStore(partial(self.storage.get_view, 'txo', {}), self.to_Address_dict_copy,
+                             view_lock=self.storage.lock)
+        self.tx_fees = dict(self.storage.get_view('tx_fees', {}))
         self.pruned_txo = self.storage.get('pruned_txo', {})
         self.pruned_txo_values = set(self.pruned_txo.values())
-        tx_list = self.storage.get('transactions', {})
-        self.transactions = {}
-        for tx_hash, raw in tx_list.items():
-            tx = Transaction(raw)
-            self.transactions[tx_hash] = tx
-            if not self.txi.get(tx_hash) and not self.txo.get(tx_hash) and (tx_hash not in self.pruned_txo_values):
+        self.transactions = TransactionStore(get_view=partial(self.storage.get_view, 'transactions', {}),
+                                             view_lock=self.storage.lock)
+        # (we never store empty txi/txo entries, so only the keys are needed)
+        for tx_hash in list(self.transactions):
+            if tx_hash not in self.txi and tx_hash not in self.txo and (tx_hash not in self.pruned_txo_values):
                 self.print_error("removing unreferenced tx", tx_hash)
-                self.transactions.pop(tx_hash)
+                self._dirty_txs.add(tx_hash)
                 self.cashacct.remove_transaction_hook(tx_hash)
                 self.slp.rm_tx(tx_hash)
+                del self.transactions[tx_hash]
 
     @profiler
     def save_transactions(self, write=False):
         with self.lock:
-            tx = {}
-            for k,v in self.transactions.items():
-                tx[k] = str(v)
-            self.storage.put('transactions', tx)
-            txi = {tx_hash: self.from_Address_dict(value)
-                   for tx_hash, value in self.txi.items()
-                   # skip empty entries to save memory and disk space
-                   if value}
-            txo = {tx_hash: self.from_Address_dict(value)
-                   for tx_hash, value in self.txo.items()
-                   # skip empty entries to save memory and disk space
-                   if value}
-            self.storage.put('txi', txi)
-            self.storage.put('txo', txo)
-            self.storage.put('tx_fees', self.tx_fees)
+            if self._save_all:
+                self._save_all_transactions()
+            else:
+                self._save_dirty_transactions()
+            self._dirty_txs, self._dirty_addrs, self._save_all = set(), set(), False
             self.storage.put('pruned_txo', self.pruned_txo)
-            history = self.from_Address_dict(self._history)
-            self.storage.put('addr_history', history)
             self.slp.save()
             if write:
                 self.storage.write()
 
+    def _save_all_transactions(self):
+        tx = dict(self.transactions.raw_items())
+        self.storage.put('transactions', tx)
+        txi = {tx_hash: self.from_Address_dict(value)
+               for tx_hash, value in self.txi.items()
+               # skip empty entries to save memory and disk space
+               if value}
+        txo = {tx_hash: self.from_Address_dict(value)
+               for tx_hash, value in self.txo.items()
+               # skip empty entries to save memory and disk space
+               if value}
+        self.storage.put('txi', txi)
+        self.storage.put('txo', txo)
+        self.storage.put('tx_fees', self.tx_fees)
+        history = self.from_Address_dict(self._history)
+        self.storage.put('addr_history', history)
+        self.storage.put('addr_status', self.from_Address_dict(self._addr_status))
+
+    def _save_dirty_transactions(self):
+        ''' Hands only the entries flagged in self._dirty_txs and
+        self._dirty_addrs over to storage. Cost is proportional to the number
+        of entries touched since the last save, not to the size of the
+        wallet. '''
+        def copy_Address_dict(d):
+            return {addr.to_storage_string(): list(l) for addr, l in d.items()}
+        tx, txi, txo, fees = {}, {}, {}, {}
+        tx_rm, txi_rm, txo_rm, fees_rm = [], [], [], []
+        for tx_hash in self._dirty_txs:
+            raw = self.transactions.get_raw(tx_hash)
+            if raw is not None:
+                tx[tx_hash] = raw
+            else:
+                tx_rm.append(tx_hash)
+            for d, items, rm in ((self.txi, txi, txi_rm), (self.txo, txo, txo_rm)):
+                value = d.get(tx_hash)
+                if value:
+                    items[tx_hash] = copy_Address_dict(value)
+                else:
+                    # we don't keep empty entries in storage
+                    rm.append(tx_hash)
+            fee = self.tx_fees.get(tx_hash)
+            if fee is not None:
+                fees[tx_hash] = fee
+            else:
+                fees_rm.append(tx_hash)
+        self.storage.put_items('transactions', tx, tx_rm)
+        self.storage.put_items('txi', txi, txi_rm)
+        self.storage.put_items('txo', txo, txo_rm)
+        self.storage.put_items('tx_fees', fees, fees_rm)
+        history, history_rm, status, status_rm = {}, [], {}, []
+        for addr in self._dirty_addrs:
+            h = self._history.get(addr)
+            if h is not None:
+                history[addr.to_storage_string()] = list(h)
+            else:
+                history_rm.append(addr.to_storage_string())
+            if addr in self._addr_status:
+                status[addr.to_storage_string()] = self._addr_status[addr]
+            else:
+                status_rm.append(addr.to_storage_string())
+        self.storage.put_items('addr_history', history, history_rm)
+        self.storage.put_items('addr_status', status, status_rm)
+
     def save_verified_tx(self, write=False):
         with self.lock:
             self.storage.put('verified_tx3', self.verified_tx)
@@ -460,33 +876,125 @@ class Abstract_Wallet(PrintError, SPVDelegate):
             self.pruned_txo = {}
             self.pruned_txo_values = set()
             self.slp.clear()
-            self.save_transactions()
-            self._addr_bal_cache = {}
+            self._invalidate_balances()
             self._history = {}
+            self._addr_status = {}
+            self._hist_index = None
+            self._save_all = True
+            self.build_outpoint_index()
+            self.save_transactions()
             self.tx_addr_hist = defaultdict(set)
             self.cashacct.on_clear_history()
 
     @profiler
     def build_reverse_history(self):
         self.tx_addr_hist = defaultdict(set)
+        self._hist_index = None
         for addr, hist in self._history.items():
             for tx_hash, h in hist:
                 self.tx_addr_hist[tx_hash].add(addr)
 
+    @profiler
+    def build_outpoint_index(self):
+        ''' (Re)builds the outpoint index from self.txo and self.txi.
+        self._outpoints maps each of our coins ('prevout_hash:n' strings) to
+        a list of [Address, value, is_coinbase, spent_by], where spent_by is
+        the set of the wallet tx's spending it (empty if it is unspent, and
+        more than one for conflicting tx's).
+        self._addr_outpoints maps Address -> set of its coins in
+        self._outpoints.
+        self._utxos is the wallet's UTXO set: it maps each Address that has
+        unspent coins to a dict of its unspent coins (used as an ordered
+        set). All of these are kept up-to-date by add_transaction and
+        remove_transaction. '''
+        with self.lock:
+            self._outpoints = {}
+            self._addr_outpoints = defaultdict(set)
+            self._utxos = {}
+            for tx_hash, d in self.txo.items():
+                for addr, l in d.items():
+                    for n, v, is_cb in l:
+                        self._index_txo(f'{tx_hash}:{n}', addr, v, is_cb)
+            for tx_hash, d in self.txi.items():
+                for addr, l in d.items():
+                    for ser, v in l:
+                        self._add_spender(ser, tx_hash)
+
+    def _index_txo(self, ser, addr, v, is_cb):
+        old = self._outpoints.get(ser)
+        spent_by = old[3] if old is not None else set()
+        if old is not None:
+            self._utxo_discard(ser, old)
+            if old[0] != addr:
+                self._addr_outpoints[old[0]].discard(ser)
+        self._outpoints[ser] = [addr, v, is_cb, spent_by]
+        self._addr_outpoints[addr].add(ser)
+        if not spent_by:
+            self._utxos.setdefault(addr, {})[ser] = None
+
+    def _unindex_txo(self, ser):
+        o = self._outpoints.pop(ser, None)
+        if o is not None:
+            self._utxo_discard(ser, o)
+            s = self._addr_outpoints.get(o[0])
+            if s is not None:
+                s.discard(ser)
+                if not s:
+                    del self._addr_outpoints[o[0]]
+        return o
+
+    def _add_spender(self, ser, tx_hash):
+        ''' Flags the coin `ser` as spent by tx `tx_hash`. '''
+        o = self._outpoints.get(ser)
+        if o is None:
+            return
+        o[3].add(tx_hash)
+        self._utxo_discard(ser, o)
+        # cleanup/detect if the 'frozen coin' was spent and remove it from the frozen coin set
+        self.frozen_coins.discard(ser)
+        self.frozen_coins_tmp.discard(ser)
+
+    def _remove_spender(self, ser, tx_hash):
+        ''' Undoes _add_spender(); the coin is unspent again once no wallet
+        tx spends it. '''
+        o = self._outpoints.get(ser)
+        if o is None:
+            return
+        o[3].discard(tx_hash)
+        if not o[3]:
+            self._utxos.setdefault(o[0], {})[ser] = None
+
+    def _utxo_discard(self, ser, o):
+        d = self._utxos.get(o[0])
+        if d is not None:
+            d.pop(ser, None)
+            if not d:
+                del self._utxos[o[0]]
+
+    def get_outpoint(self, ser):
+        ''' Returns a tuple of (Address, value, is_coinbase, spent_by) for the
+        wallet coin `ser` ('prevout_hash:n'), or None if it's not ours.
+        spent_by is the frozenset of the wallet tx's spending the coin, empty
+        if it is unspent. '''
+        o = self._outpoints.get(ser)
+        return (o[0], o[1], o[2], frozenset(o[3])) if o is not None else None
+
     @profiler
     def check_history(self):
         save = False
         my_addrs = [addr for addr in self._history if self.is_mine(addr)]
 
         for addr in set(self._history) - set(my_addrs):
-            self._history.pop(addr)
+            self._hist_dirty.update(tx_hash for tx_hash, height in self._history.pop(addr))
+            self._addr_status.pop(addr, None)
+            self._dirty_addrs.add(addr)
             save = True
 
         for addr in my_addrs:
             hist = self._history[addr]
 
             for tx_hash, tx_height in hist:
-                if tx_hash in self.pruned_txo_values or self.txi.get(tx_hash) or self.txo.get(tx_hash):
+                if tx_hash in self.pruned_txo_values or tx_hash in self.txi or tx_hash in self.txo:
                     continue
                 tx = self.transactions.get(tx_hash)
                 if tx is not None:
@@ -518,6 +1026,11 @@ class Abstract_Wallet(PrintError, SPVDelegate):
     def synchronize(self):
         pass
 
+    def _address_history_changed(self, addr, hist):
+        ''' Called with the lock held when the server sent us a new history
+        for addr. '''
+        pass
+
     def is_deterministic(self):
         return self.keystore.is_deterministic()
 
@@ -648,6 +1161,7 @@ class Abstract_Wallet(PrintError, SPVDelegate):
         with self.lock:
             if tx_height == 0 and tx_hash in self.verified_tx:
                 self.verified_tx.pop(tx_hash)
+                self._verified_heights.discard(tx_hash)
                 if self.verifier:
                     self.verifier.merkle_roots.pop(tx_hash, None)
 
@@ -655,12 +1169,17 @@ class Abstract_Wallet(PrintError, SPVDelegate):
             if tx_hash not in self.verified_tx:
                 self.unverified_tx[tx_hash] = tx_height
                 self.cashacct.add_unverified_tx_hook(tx_hash, tx_height)
+                if self.verifier and tx_height > 0:
+                    self.verifier.wakeup()
+            self._hist_dirty.add(tx_hash)
 
     def add_verified_tx(self, tx_hash, info, header):
         # Remove from the unverified map and add to the verified map and
         with self.lock:
             self.unverified_tx.pop(tx_hash, None)
             self.verified_tx[tx_hash] = info  # (tx_height, timestamp, pos)
+            self._verified_heights.add(tx_hash, info[0])
+            self._hist_dirty.add(tx_hash)
             height, conf, timestamp = self.get_tx_height(tx_hash)
             self.cashacct.add_verified_tx_hook(tx_hash, info, header)
         self.network.trigger_callback('verified2', self, tx_hash, height, conf, timestamp)
@@ -685,17 +1204,20 @@ class Abstract_Wallet(PrintError, SPVDelegate):
         '''Used by the verifier when a reorg has happened'''
         txs = set()
         with self.lock:
-            for tx_hash, item in list(self.verified_tx.items()):
-                tx_height, timestamp, pos = item
-                if tx_height >= height:
-                    header = blockchain.read_header(tx_height)
-                    # fixme: use block hash, not timestamp
-                    if not header or header.get('timestamp') != timestamp:
-                        self.verified_tx.pop(tx_hash, None)
-                        txs.add(tx_hash)
+            for tx_hash in self._verified_heights.keys_from(height):
+                tx_height, timestamp, pos = self.verified_tx[tx_hash]
+                header = blockchain.read_header(tx_height)
+                # fixme: use block hash, not timestamp
+                if not header or header.get('timestamp') != timestamp:
+                    self.verified_tx.pop(tx_hash, None)
+                    self._verified_heights.discard(tx_hash)
+                    txs.add(tx_hash)
             if txs: self.cashacct.undo_verifications_hook(txs)
-        if txs:
-            self._addr_bal_cache = {}  # this is probably not necessary -- as the receive_history_callback will invalidate bad cache items -- but just to be paranoid we clear the whole balance cache on reorg anyway as a safety measure
+            self._hist_dirty.update(txs)
+            # only the balances of the addresses these tx's touch can change
+            for tx_hash in txs:
+                for addr in self.tx_addr_hist.get(tx_hash, ()):
+                    self._invalidate_addr_balance(addr)
         return txs
 
     def get_local_height(self):
@@ -790,15 +1312,12 @@ class Abstract_Wallet(PrintError, SPVDelegate):
             if self.is_mine(addr):
                 is_mine = True
                 is_relevant = True
-                prevout_hash = item['prevout_hash']
-                prevout_n = item['prevout_n']
-                d = self.txo.get(prevout_hash, {}).get(addr, [])
-                for n, v, cb in d:
-                    if n == prevout_n:
-                        value = v
-                        if ver == 2:
-                            spends_coins_mine.append(f'{prevout_hash}:{prevout_n}')
-                        break
+                ser = f"{item['prevout_hash']}:{item['prevout_n']}"
+                o = self._outpoints.get(ser)
+                if o is not None and o[0] == addr:
+                    value = o[1]
+                    if ver == 2:
+                        spends_coins_mine.append(ser)
                 else:
                     value = None
                 if value is None:
@@ -925,43 +1444,57 @@ class Abstract_Wallet(PrintError, SPVDelegate):
                             status_enum)
 
     def get_addr_io(self, address):
-        h = self.get_address_history(address)
+        heights, pos = {}, {}
+        for i, (tx_hash, height) in enumerate(self.get_address_history(address)):
+            heights[tx_hash], pos[tx_hash] = height, i
         received = {}
         sent = {}
-        for tx_hash, height in h:
-            l = self.txo.get(tx_hash, {}).get(address, [])
-            for n, v, is_cb in l:
-                received[tx_hash + ':%d'%n] = (height, v, is_cb)
-        for tx_hash, height in h:
-            l = self.txi.get(tx_hash, {}).get(address, [])
-            for txi, v in l:
-                sent[txi] = height
+        # Note: we may be called without the lock held, so take a copy
+        for ser in list(self._addr_outpoints.get(address, ())):
+            o = self._outpoints.get(ser)
+            height = heights.get(ser.rpartition(':')[0])
+            if o is None or height is None:
+                continue
+            addr, v, is_cb, spent_by = o
+            received[ser] = (height, v, is_cb)
+            # with conflicting spends, the latest in the history wins, as it
+            # always did
+            spenders = [tx_hash for tx_hash in list(spent_by) if tx_hash in pos]
+            if spenders:
+                sent[ser] = heights[max(spenders, key=pos.get)]
         return received, sent
 
     def get_addr_utxo(self, address):
-        coins, spent = self.get_addr_io(address)
-        for txi in spent:
-            coins.pop(txi)
-            # cleanup/detect if the 'frozen coin' was spent and remove it from the frozen coin set
-            self.frozen_coins.discard(txi)
-            self.frozen_coins_tmp.discard(txi)
         out = {}
-        for txo, v in coins.items():
-            tx_height, value, is_cb = v
-            prevout_hash, prevout_n = txo.split(':')
-            x = {
-                'address':address,
-                'value':value,
-                'prevout_n':int(prevout_n),
-                'prevout_hash':prevout_hash,
-                'height':tx_height,
-                'coinbase':is_cb,
-                'is_frozen_coin':txo in self.frozen_coins or txo in self.frozen_coins_tmp,
-                'slp_token':self.slp.token_info_for_txo(txo),  # (token_id_hex, qty) tuple or None
-            }
-            out[txo] = x
+        # Note: we may be called without the lock held, so take a copy
+        for txo in list(self._utxos.get(address, ())):
+            x = self._make_utxo(txo)
+            if x is not None:
+                out[txo] = x
         return out
 
+    def _make_utxo(self, txo):
+        ''' Returns the coin dict for the unspent coin `txo`, as found in
+        get_addr_utxo() and get_utxos() results, or None if it's not in our
+        UTXO set. Doesn't take locks. '''
+        o = self._outpoints.get(txo)
+        if o is None:
+            return None
+        address, value, is_cb, spent_by = o
+        prevout_hash, _, prevout_n = txo.rpartition(':')
+        verified = self.verified_tx.get(prevout_hash)
+        tx_height = verified[0] if verified else self.unverified_tx.get(prevout_hash, 0)
+        return {
+            'address':address,
+            'value':value,
+            'prevout_n':int(prevout_n),
+            'prevout_hash':prevout_hash,
+            'height':tx_height,
+            'coinbase':is_cb,
+            'is_frozen_coin':txo in self.frozen_coins or txo in self.frozen_coins_tmp,
+            'slp_token':self.slp.token_info_for_txo(txo),  # (token_id_hex, qty) tuple or None
+        }
+
     # return the total amount ever received by an address
     def get_addr_received(self, address):
         received, sent = self.get_addr_io(address)
@@ -1052,18 +1585,22 @@ class Abstract_Wallet(PrintError, SPVDelegate):
         with self.lock:
             mempoolHeight = self.get_local_height() + 1
             coins = []
+            # Only addresses that are in the UTXO set can have results, so
+            # we never need to look at the others.
             if domain is None:
-                domain = self.get_addresses()
+                domain = [addr for addr in self._utxos if self.is_mine(addr)]
+            else:
+                domain = [addr for addr in domain if addr in self._utxos]
             if exclude_frozen:
-                domain = set(domain) - self.frozen_addresses
+                domain = [addr for addr in domain if addr not in self.frozen_addresses]
             for addr in domain:
-                utxos = self.get_addr_utxo(addr)
                 len_before = len(coins)
-                for x in utxos.values():
-                    if exclude_slp and x['slp_token']:
+                for txo in self._utxos[addr]:
+                    if exclude_slp and self.slp.txo_has_token(txo):
                         continue
-                    if exclude_frozen and x['is_frozen_coin']:
+                    if exclude_frozen and (txo in self.frozen_coins or txo in self.frozen_coins_tmp):
                         continue
+                    x = self._make_utxo(txo)
                     if confirmed_only and x['height'] <= 0:
                         continue
                     # A note about maturity: Previous versions of Electrum
@@ -1100,7 +1637,7 @@ class Abstract_Wallet(PrintError, SPVDelegate):
 
     def get_balance(self, domain=None, exclude_frozen_coins=False, exclude_frozen_addresses=False):
         if domain is None:
-            domain = self.get_addresses()
+            return self._get_wallet_balance(exclude_frozen_coins, exclude_frozen_addresses)
         if exclude_frozen_addresses:
             domain = set(domain) - self.frozen_addresses
         cc = uu = xx = 0
@@ -1111,10 +1648,92 @@ class Abstract_Wallet(PrintError, SPVDelegate):
             xx += x
         return cc, uu, xx
 
+    def _invalidate_addr_balance(self, address):
+        ''' Call this whenever the balance of `address` may have changed. '''
+        self._addr_bal_cache.pop(address, None)
+        self._bal_dirty.add(address)
+
+    def _invalidate_balances(self):
+        ''' Like _invalidate_addr_balance, but for all addresses. '''
+        self._addr_bal_cache = {}
+        self._bal_total = None
+
+    def _update_wallet_balance(self):
+        ''' Brings self._bal_total up-to-date by re-summing only the
+        addresses whose balance may have changed. Call with the lock held. '''
+        height = self.get_local_height()
+        if self._bal_total is None:
+            self._bal_contrib, self._bal_dirty, self._bal_coinbase_addrs = {}, set(), set()
+            dirty = self.get_addresses()
+            total = [0, 0, 0]
+        else:
+            dirty, self._bal_dirty = self._bal_dirty, set()
+            if height != self._bal_height:
+                # coinbase coins may have matured
+                dirty |= self._bal_coinbase_addrs
+            total = list(self._bal_total)
+        for addr in dirty:
+            old = self._bal_contrib.pop(addr, None)
+            if old is not None:
+                total = [t - o for t, o in zip(total, old)]
+            if not self.is_mine(addr):
+                continue
+            new = self._bal_contrib[addr] = self.get_addr_balance(addr)
+            total = [t + n for t, n in zip(total, new)]
+            # get_addr_balance doesn't cache the balance of coinbase-holding
+            # addresses
+            if addr in self._addr_bal_cache:
+                self._bal_coinbase_addrs.discard(addr)
+            else:
+                self._bal_coinbase_addrs.add(addr)
+        self._bal_total = tuple(total)
+        self._bal_height = height
+        return self._bal_total
+
+    def _get_wallet_balance(self, exclude_frozen_coins, exclude_frozen_addresses):
+        ''' get_balance() for the whole wallet. Starts from the running total
+        and only adjusts it for frozen addresses and for addresses holding
+        frozen coins, so the cost is proportional to the number of frozen
+        addresses and coins. '''
+        with self.lock:
+            c, u, x = self._update_wallet_balance()
+            if exclude_frozen_addresses:
+                for addr in self.frozen_addresses:
+                    cc, uu, xx = self._bal_contrib.get(addr, (0, 0, 0))
+                    c, u, x = c - cc, u - uu, x - xx
+            if exclude_frozen_coins:
+                addrs = set()
+                for txo in self.frozen_coins | self.frozen_coins_tmp:
+                    o = self._outpoints.get(txo)
+                    if o is not None and o[0] in self._bal_contrib:
+                        addrs.add(o[0])
+                if exclude_frozen_addresses:
+                    addrs -= self.frozen_addresses
+                for addr in addrs:
+                    cc, uu, xx = self._bal_contrib[addr]
+                    c2, u2, x2 = self.get_addr_balance(addr, exclude_frozen_coins=True)
+                    c, u, x = c - cc + c2, u - uu + u2, x - xx + x2
+            return c, u, x
+
     def get_address_history(self, address):
         assert isinstance(address, Address)
         return self._history.get(address, [])
 
+    def get_address_status(self, address):
+        ''' Returns the status of the address history, as announced by the
+        server in blockchain.scripthash.subscribe notifications. Cached, and
+        saved along with the history. '''
+        assert isinstance(address, Address)
+        try:
+            return self._addr_status[address]
+        except KeyError:
+            pass
+        with self.lock:
+            status = history_status(self._history.get(address))
+            self._addr_status[address] = status
+            self._dirty_addrs.add(address)
+        return status
+
     def _clean_pruned_txo_thread(self):
         ''' Runs in the thread self.pruned_txo_cleaner_thread which is only
         active if self.network. Cleans the self.pruned_txo dict and the
@@ -1141,6 +1760,7 @@ class Abstract_Wallet(PrintError, SPVDelegate):
                 with self.lock:
                     tx_hash = self.pruned_txo.pop(ser, None)
                     self.pruned_txo_values.discard(tx_hash)
+                    if tx_hash: self._hist_dirty.add(tx_hash)
         def add(ser):
             prevout_hash, prevout_n = deser(ser)
             txid_n[prevout_hash].add(prevout_n)
@@ -1268,6 +1888,8 @@ class Abstract_Wallet(PrintError, SPVDelegate):
             # HELPER FUNCTIONS
             def add_to_self_txi(tx_hash, addr, ser, v):
                 ''' addr must be 'is_mine' '''
+                self._dirty_txs.add(tx_hash)
+                self._hist_dirty.add(tx_hash)
                 d = self.txi.get(tx_hash)
                 if d is None:
                     self.txi[tx_hash] = d = {}
@@ -1275,18 +1897,15 @@ class Abstract_Wallet(PrintError, SPVDelegate):
                 if l is None:
                     d[addr] = l = []
                 l.append((ser, v))
-            def find_in_self_txo(prevout_hash: str, prevout_n: int) -> tuple:
+                self._add_spender(ser, tx_hash)
+            def find_in_self_txo(ser: str) -> tuple:
                 """Returns a tuple of the (Address,value) for a given
-                prevout_hash:prevout_n, or (None, None) if not found. If valid
-                return, the Address object is found by scanning self.txo. The
-                lookup below is relatively fast in practice even on pathological
-                wallets."""
-                dd = self.txo.get(prevout_hash, {})
-                for addr2, item in dd.items():
-                    for n, v, is_cb in item:
-                        if n == prevout_n:
-                            return addr2, v
-                return (None, None)
+                prevout_hash:prevout_n, or (None, None) if not found. The
+                Address object is found via the outpoint index."""
+                o = self._outpoints.get(ser)
+                if o is None:
+                    return (None, None)
+                return o[0], o[1]
             def txin_get_info(txi):
                 prevout_hash = txi['prevout_hash']
                 prevout_n = txi['prevout_n']
@@ -1301,11 +1920,15 @@ class Abstract_Wallet(PrintError, SPVDelegate):
                 next_tx = self.pruned_txo.pop(ser, None)
                 if next_tx:
                     self.pruned_txo_values.discard(next_tx)
+                    self._hist_dirty.add(next_tx)
                     t = self.pruned_txo_cleaner_thread
                     if t and t.q: t.q.put('r_' + ser)  # notify of removal
                 return next_tx
             # /HELPER FUNCTIONS
 
+            self._dirty_txs.add(tx_hash)
+            self._hist_dirty.add(tx_hash)
+
             # add inputs
             self.txi[tx_hash] = d = {}
             for txi in tx.inputs():
@@ -1315,28 +1938,26 @@ class Abstract_Wallet(PrintError, SPVDelegate):
                 # find value from prev output
                 if self.is_mine(addr):
                     prevout_hash, prevout_n, ser = txin_get_info(txi)
-                    dd = self.txo.get(prevout_hash, {})
-                    for n, v, is_cb in dd.get(addr, []):
-                        if n == prevout_n:
-                            add_to_self_txi(tx_hash, addr, ser, v)
-                            break
+                    o = self._outpoints.get(ser)
+                    if o is not None and o[0] == addr:
+                        add_to_self_txi(tx_hash, addr, ser, o[1])
                     else:
                         # Coin's spend tx came in before its receive tx: flag
                         # the spend for when the receive tx will arrive into
                         # this function later.
                         put_pruned_txo(ser, tx_hash)
-                    self._addr_bal_cache.pop(addr, None)  # invalidate cache entry
-                    del dd, prevout_hash, prevout_n, ser
+                    self._invalidate_addr_balance(addr)  # invalidate cache entry
+                    del o, prevout_hash, prevout_n, ser
                 elif addr is None:
                     # Unknown/unparsed address.. may be a strange p2sh scriptSig
                     # Try and find it in txout's if it's one of ours.
                     # See issue #895.
                     prevout_hash, prevout_n, ser = txin_get_info(txi)
                     # Find address in self.txo for this prevout_hash:prevout_n
-                    addr2, v = find_in_self_txo(prevout_hash, prevout_n)
+                    addr2, v = find_in_self_txo(ser)
                     if addr2 is not None and self.is_mine(addr2):
                         add_to_self_txi(tx_hash, addr2, ser, v)
-                        self._addr_bal_cache.pop(addr2, None)  # invalidate cache entry
+                        self._invalidate_addr_balance(addr2)  # invalidate cache entry
                     else:
                         # Not found in self.txo. It may still be one of ours
                         # however since tx's can come in out of order due to
@@ -1388,7 +2009,8 @@ class Abstract_Wallet(PrintError, SPVDelegate):
                         d[addr] = l = []
                     l.append((n, v, is_coinbase))
                     del l
-                    self._addr_bal_cache.pop(addr, None)  # invalidate cache entry
+                    self._index_txo(ser, addr, v, is_coinbase)
+                    self._invalidate_addr_balance(addr)  # invalidate cache entry
                 # give v to txi that spends me
                 next_tx = pop_pruned_txo(ser)
                 if next_tx is not None and mine:
@@ -1424,28 +2046,38 @@ class Abstract_Wallet(PrintError, SPVDelegate):
                 if hh == tx_hash:
                     self.pruned_txo.pop(ser)
                     self.pruned_txo_values.discard(hh)
-            # add tx to pruned_txo, and undo the txi addition
-            for next_tx, dd in self.txi.items():
-                for addr, l in list(dd.items()):
-                    ll = l[:]
-                    for item in ll:
-                        ser, v = item
-                        prev_hash, prev_n = ser.split(':')
-                        if prev_hash == tx_hash:
-                            self._addr_bal_cache.pop(addr, None)  # invalidate cache entry
-                            l.remove(item)
-                            self.pruned_txo[ser] = next_tx
-                            self.pruned_txo_values.add(next_tx)
-                    if l == []:
-                        dd.pop(addr)
-                    else:
-                        dd[addr] = l
-
-            # invalidate addr_bal_cache for outputs involving this tx
+            # add tx to pruned_txo, and undo the txi addition. The outpoint
+            # index tells us which tx's spent this tx's outputs.
             d = self.txo.get(tx_hash, {})
-            for addr in d:
-                self._addr_bal_cache.pop(addr, None)  # invalidate cache entry
-
+            for addr, l in d.items():
+                for n, v, is_cb in l:
+                    ser = f'{tx_hash}:{n}'
+                    o = self._unindex_txo(ser)
+                    for next_tx in (o[3] if o else ()):
+                        dd = self.txi.get(next_tx)
+                        if not dd:
+                            continue
+                        ll = dd.get(addr, [])
+                        for item in ll[:]:
+                            if item[0] == ser:
+                                self._dirty_txs.add(next_tx)
+                                self._hist_dirty.add(next_tx)
+                                ll.remove(item)
+                                self.pruned_txo[ser] = next_tx
+                                self.pruned_txo_values.add(next_tx)
+                        if not ll:
+                            dd.pop(addr, None)
+                # invalidate addr_bal_cache for outputs involving this tx
+                self._invalidate_addr_balance(addr)  # invalidate cache entry
+
+            # the coins this tx spent are now unspent again
+            for addr, l in self.txi.get(tx_hash, {}).items():
+                for ser, v in l:
+                    self._remove_spender(ser, tx_hash)
+                self._invalidate_addr_balance(addr)  # invalidate cache entry
+
+            self._dirty_txs.add(tx_hash)
+            self._hist_dirty.add(tx_hash)
             try: self.txi.pop(tx_hash)
             except KeyError: self.print_error("tx was not in input history", tx_hash)
             try: self.txo.pop(tx_hash)
@@ -1467,7 +2099,7 @@ class Abstract_Wallet(PrintError, SPVDelegate):
                     status = status[0]  # unpack status from tuple
                     self.network.trigger_callback('payment_received', self, addr, status)
 
-    def receive_history_callback(self, addr, hist, tx_fees):
+    def receive_history_callback(self, addr, hist, tx_fees, *, status=None):
         with self.lock:
             old_hist = self.get_address_history(addr)
             for tx_hash, height in old_hist:
@@ -1485,8 +2117,13 @@ class Abstract_Wallet(PrintError, SPVDelegate):
                         # storage, it merely removes it from the self.txi
                         # and self.txo dicts
                         self.remove_transaction(tx_hash)
-            self._addr_bal_cache.pop(addr, None)  # unconditionally invalidate cache entry
+            self._invalidate_addr_balance(addr)  # unconditionally invalidate cache entry
+            self._hist_dirty.update(tx_hash for tx_hash, height in old_hist)
+            self._hist_dirty.update(tx_hash for tx_hash, height in hist)
             self._history[addr] = hist
+            self._addr_status[addr] = history_status(hist) if status is None else status
+            self._dirty_addrs.add(addr)
+            self._address_history_changed(addr, hist)
 
             for tx_hash, tx_height in hist:
                 # add it in case it was previously unconfirmed
@@ -1500,6 +2137,7 @@ class Abstract_Wallet(PrintError, SPVDelegate):
 
             # Store fees
             self.tx_fees.update(tx_fees)
+            self._dirty_txs.update(tx_fees)
 
         if self.network:
             self.network.trigger_callback('on_history', self)
@@ -1511,13 +2149,108 @@ class Abstract_Wallet(PrintError, SPVDelegate):
                 if not any(True for x in cur_hist if x[0] == txid):
                     cur_hist.append((txid, 0))
                     self._history[addr] = cur_hist
+                    self._addr_status.pop(addr, None)
+                    self._dirty_addrs.add(addr)
+                    self.tx_addr_hist[txid].add(addr)
+                    self._hist_dirty.add(txid)
 
     TxHistory = namedtuple("TxHistory", "tx_hash, height, conf, timestamp, amount, balance")
 
-    def get_history(self, domain=None, *, reverse=False):
-        # get domain
-        if domain is None:
-            domain = self.get_addresses()
+    def get_history(self, domain=None, *, reverse=False, offset=0, limit=None):
+        ''' Returns a list of TxHistory tuples for the addresses in `domain`
+        (None means the whole wallet), oldest first (or newest first if
+        `reverse`). `offset` and `limit` select a page of that list.
+
+        For the whole wallet this is served from a sorted index which is
+        updated incrementally, so that only the requested page is built. '''
+        assert offset >= 0
+        if domain is not None:
+            h2 = self._get_domain_history(domain, reverse=reverse)
+            return h2[offset:None if limit is None else offset + limit]
+        with self.lock:
+            idx = self._get_history_index()
+            c, u, x = self.get_balance()
+            balance = c + u + x
+            local_height = self.get_local_height()
+            n = len(idx)
+            stop = n if limit is None else min(n, offset + limit)
+            indices = range(offset, stop)
+            if reverse:
+                indices = range(n - 1 - offset, n - 1 - stop, -1)
+            return [self._history_index_item(idx, i, balance, local_height) for i in indices]
+
+    def _history_index_item(self, idx, i, balance, local_height):
+        txpos, _seen, tx_hash = idx.keys[i]
+        height, timestamp, verified = idx.infos[i]
+        conf = max(local_height - height + 1, 0) if verified else 0
+        return self.TxHistory(tx_hash, height, conf, timestamp,
+                              idx.deltas[i], idx.balance_after(i, balance))
+
+    def _get_history_items(self, tx_hashes):
+        ''' Returns the TxHistory tuples of the wallet tx's in tx_hashes, as
+        get_history() would, leaving out those no longer in the history. '''
+        with self.lock:
+            idx = self._get_history_index()
+            c, u, x = self.get_balance()
+            balance = c + u + x
+            local_height = self.get_local_height()
+            h2 = []
+            for tx_hash in tx_hashes:
+                key = idx.txpos.get(tx_hash)
+                if key is not None:
+                    i = bisect.bisect_left(idx.keys, key)
+                    h2.append(self._history_index_item(idx, i, balance, local_height))
+            return h2
+
+    def _get_history_index(self):
+        ''' Brings the HistoryIndex up-to-date, re-inserting only the tx's
+        flagged in self._hist_dirty. Call with the lock held. '''
+        idx = self._hist_index
+        if idx is None:
+            # First build: visit the tx's in the order get_history() always
+            # saw them, and sort once.
+            self._hist_dirty = set()
+            entries, done = [], set()
+            walk = (tx_hash for addr in self.get_addresses()
+                    for tx_hash, height in self.get_address_history(addr))
+            for tx_hash in itertools.chain(walk, list(self.tx_addr_hist)):
+                if tx_hash in done:
+                    continue
+                done.add(tx_hash)
+                entry = self._history_index_entry(tx_hash)
+                if entry:
+                    entries.append((tx_hash,) + entry)
+            idx = self._hist_index = HistoryIndex.from_entries(entries)
+            return idx
+        dirty, self._hist_dirty = self._hist_dirty, set()
+        for tx_hash in dirty:
+            idx.remove(tx_hash)
+            entry = self._history_index_entry(tx_hash)
+            if entry:
+                idx.insert(tx_hash, *entry)
+            else:
+                idx.forget(tx_hash)
+        idx.fixup()
+        return idx
+
+    def _history_index_entry(self, tx_hash):
+        ''' Returns the (txpos, delta, info) of tx_hash for the HistoryIndex,
+        or None if it doesn't touch any of our addresses. '''
+        addrs = [addr for addr in self.tx_addr_hist.get(tx_hash, ()) if self.is_mine(addr)]
+        if not addrs:
+            return None
+        delta = 0
+        for addr in addrs:
+            d = self.get_tx_delta(tx_hash, addr)
+            if d is None:
+                delta = None
+                break
+            delta += d
+        height, conf, timestamp = self.get_tx_height(tx_hash)
+        return (self.get_txpos(tx_hash), delta,
+                (height, timestamp, tx_hash in self.verified_tx))
+
+    def _get_domain_history(self, domain, *, reverse=False):
         # 1. Get the history of each address in the domain, maintain the
         #    delta of a tx as the sum of its deltas on domain addresses
         tx_deltas = defaultdict(int)
@@ -1556,14 +2289,33 @@ class Abstract_Wallet(PrintError, SPVDelegate):
     def export_history(self, domain=None, from_timestamp=None, to_timestamp=None, fx=None,
                        show_addresses=False, decimal_point=8,
                        *, fee_calc_timeout=10.0, download_inputs=False,
-                       progress_callback=None):
-        ''' Export history. Used by RPC & GUI.
+                       progress_callback=None, cursor=None, limit=None):
+        ''' Export history. Used by RPC & GUI. Returns a list of dicts, see
+        iter_history_export for the arguments (`limit`, if not None, limits
+        the number of items returned). Prefer iter_history_export when
+        writing the result to a file, as it doesn't need to hold all of the
+        items in memory at once. '''
+        it = self.iter_history_export(domain, from_timestamp, to_timestamp, fx,
+                                      show_addresses, decimal_point,
+                                      fee_calc_timeout=fee_calc_timeout,
+                                      download_inputs=download_inputs,
+                                      progress_callback=progress_callback,
+                                      cursor=cursor)
+        return list(itertools.islice(it, limit))
+
+    def iter_history_export(self, domain=None, from_timestamp=None, to_timestamp=None, fx=None,
+                            show_addresses=False, decimal_point=8,
+                            *, fee_calc_timeout=10.0, download_inputs=False,
+                            progress_callback=None, cursor=None, page_size=100):
+        ''' Generator yielding the exported history items (dicts), newest
+        first. The history is walked a page of `page_size` tx's at a time, so
+        memory use is bounded regardless of wallet size.
 
         Arg notes:
         - `fee_calc_timeout` is used when computing the fee (which is done
-          asynchronously in another thread) to limit the total amount of time in
+          asynchronously in other threads) to limit the total amount of time in
           seconds spent waiting for fee calculation. The timeout is a total time
-          allotment for this function call. (The reason the fee calc can take a
+          allotment for the whole export. (The reason the fee calc can take a
           long time is for some pathological tx's, it is very slow to calculate
           fee as it involves deserializing prevout_tx from the wallet, for each
           input).
@@ -1572,12 +2324,17 @@ class Abstract_Wallet(PrintError, SPVDelegate):
           fetcher to download *all* prevout_hash tx's for inputs (even for
           inputs not in wallet). This feature requires self.network (ie, we need
           to be online) otherwise it will behave as if download_inputs=False.
+          Inputs are fetched for a whole page of tx's in parallel, a bounded
+          number at a time.
         - `progress_callback`, if specified, is a callback which receives a
           single float argument in the range [0.0,1.0] indicating how far along
           the history export is going. This is intended for interop with GUI
           code. Node the progress callback is not guaranteed to be called in the
           context of the main thread, therefore GUI code should use appropriate
           signals/slots to update the GUI with progress info.
+        - `cursor`, if specified, is a (timestamp, txid) tuple taken from the
+          last item of a previous export. The export then resumes with the
+          item following it, so that an interrupted export can be continued.
 
         Note on side effects: This function may update self.tx_fees. Rationale:
         it will spend some time trying very hard to calculate accurate fees by
@@ -1587,10 +2344,11 @@ class Abstract_Wallet(PrintError, SPVDelegate):
         demanding on storage as even for very large wallets with huge histories,
         tx_fees does not use more than a few hundred kb of space. '''
         from .util import timestamp_to_datetime
-        # we save copies of tx's we deserialize to this temp dict because we do
-        # *not* want to deserialize tx's in wallet.transactoins since that
-        # wastes memory
-        local_tx_cache = {}
+        assert page_size > 0
+        # tx's we deserialize for the current page (private copies, see
+        # get_tx). This dict only lives as long as the page, so deserializing
+        # doesn't make them all stay in memory.
+        page_txs = {}
         # some helpers for this function
         t0 = time.time()
         def time_remaining(): return max(fee_calc_timeout - (time.time()-t0), 0)
@@ -1598,81 +2356,78 @@ class Abstract_Wallet(PrintError, SPVDelegate):
             ''' Can happen in rare circumstances if wallet history is being
             radically reorged by network thread while we are in this code. '''
         def get_tx(tx_hash):
-            ''' Try to get a tx from wallet, then from the Transaction class
-            cache if that fails. In either case it deserializes the copy and
-            puts the deserialized tx in local stack dict local_tx_cache. The
-            reason we don't deserialize the tx's from self.transactions is that
-            we do not want to keep deserialized tx's in memory. The
-            self.transactions dict should contain just raw tx's (not
-            deserialized). Deserialized tx's eat on the order of 10x the memory
-            because because of the Python lists, dict, etc they contain, per
-            instance. '''
-            tx = local_tx_cache.get(tx_hash)
+            ''' Try to get a tx from the page, then the wallet, then from the
+            Transaction class cache if that fails, and deserialize it. The tx
+            is a private copy, since fetching its inputs modifies it, and the
+            Transaction objects in self.transactions and the class cache are
+            shared with other threads. '''
+            tx = page_txs.get(tx_hash)
             if tx:
                 return tx
-            tx = Transaction.tx_cache_get(tx_hash)
-            if not tx:
-                tx = copy.deepcopy(self.transactions.get(tx_hash))
-            if tx:
-                tx.deserialize()
-                local_tx_cache[tx_hash] = tx
+            raw = self.transactions.get_raw(tx_hash)
+            if raw is not None:
+                tx = Transaction(raw)
             else:
+                tx = copy.deepcopy(Transaction.tx_cache_get(tx_hash))
+            if not tx:
                 raise MissingTx(f'txid {tx_hash} dropped out of wallet history while exporting')
+            tx.deserialize()
+            page_txs[tx_hash] = tx
             return tx
+        def try_get_fee(tx):
+            try: return tx.get_fee()
+            except InputValueMissing: pass
+        max_fetches = 10  # input fetches running at once, see prefetch_inputs
+        def prefetch_inputs(tx_hashes):
+            ''' Kicks off the Transaction class input fetcher for all the
+            tx's in the page whose fee we don't know yet, and waits for them
+            all (up to the remaining time allotment). Each fetch runs in its
+            own thread, so the network round trips overlap; at most
+            max_fetches run at once. '''
+            if not time_remaining():
+                return
+            q = queue.Queue()
+            def done():
+                q.put(1)
+            pending = 0
+            try:
+                for tx_hash in tx_hashes:
+                    if self.tx_fees.get(tx_hash) is not None:
+                        continue
+                    try:
+                        tx = get_tx(tx_hash)
+                    except MissingTx:
+                        continue  # will be reported below
+                    if pending >= max_fetches:
+                        q.get(timeout=time_remaining())
+                        pending -= 1
+                    if try_get_fee(tx) is None and tx.fetch_input_data(self, use_network=bool(download_inputs), done_callback=done):
+                        pending += 1
+                for _i in range(pending):
+                    q.get(timeout=time_remaining())
+            except queue.Empty:
+                pass
         def try_calc_fee(tx_hash):
             ''' Try to calc fee from cheapest to most expensive calculation.
-            Ultimately asks the transaction class to look at prevouts in wallet and uses
-            that scheme as a last (more CPU intensive) resort. '''
+            Ultimately asks the transaction class to look at prevouts in wallet
+            (and those fetched by prefetch_inputs) as a last (more CPU
+            intensive) resort. '''
             fee = self.tx_fees.get(tx_hash)
             if fee is not None:
                 return fee
-            def do_get_fee(tx_hash):
-                tx = get_tx(tx_hash)
-                def try_get_fee(tx):
-                    try: return tx.get_fee()
-                    except InputValueMissing: pass
-                fee = try_get_fee(tx)
-                t_remain = time_remaining()
-                if fee is None and t_remain:
-                    q = queue.Queue()
-                    def done():
-                        q.put(1)
-                    tx.fetch_input_data(self, use_network=bool(download_inputs), done_callback=done)
-                    try: q.get(timeout=t_remain)
-                    except queue.Empty: pass
-                    fee = try_get_fee(tx)
-                return fee
-            fee = do_get_fee(tx_hash)
+            fee = try_get_fee(get_tx(tx_hash))
             if fee is not None:
-                self.tx_fees[tx_hash] = fee  # save fee to wallet if we bothered to dl/calculate it.
+                with self.lock:
+                    self.tx_fees[tx_hash] = fee  # save fee to wallet if we bothered to dl/calculate it.
+                    self._dirty_txs.add(tx_hash)
             return fee
         def fmt_amt(v, is_diff):
             if v is None:
                 return '--'
             return format_satoshis(v, decimal_point=decimal_point,
                                    is_diff=is_diff)
-
-        # grab history
-        h = self.get_history(domain, reverse=True)
-        out = []
-
-        n, l = 0, max(1, float(len(h)))
-        for tx_hash, height, conf, timestamp, value, balance in h:
-            if progress_callback:
-                progress_callback(n/l)
-            n += 1
-            timestamp_safe = timestamp
-            if timestamp is None:
-                timestamp_safe = time.time()  # set it to "now" so below code doesn't explode.
-            if from_timestamp and timestamp_safe < from_timestamp:
-                continue
-            if to_timestamp and timestamp_safe >= to_timestamp:
-                continue
-            try:
-                fee = try_calc_fee(tx_hash)
-            except MissingTx as e:
-                self.print_error(str(e))
-                continue
+        def make_item(tx_hash, height, conf, timestamp, timestamp_safe, value, balance):
+            fee = try_calc_fee(tx_hash)
             item = {
                 'txid'          : tx_hash,
                 'height'        : height,
@@ -1713,10 +2468,61 @@ class Abstract_Wallet(PrintError, SPVDelegate):
                 item['fiat_value'] = fx.historical_value_str(value, date)
                 item['fiat_balance'] = fx.historical_value_str(balance, date)
                 item['fiat_fee'] = fx.historical_value_str(fee, date)
-            out.append(item)
+            return item
+
+        # grab history, a page at a time. For the whole wallet the pages come
+        # straight out of the history index, going by a snapshot of its tx's
+        # so that tx's arriving during a long export don't shift the pages.
+        # An explicit domain has to be computed in full anyway.
+        if domain is None:
+            with self.lock:
+                tx_hashes = [key[2] for key in reversed(self._get_history_index().keys)]
+            total = len(tx_hashes)
+            def get_page(offset):
+                return self._get_history_items(tx_hashes[offset:offset + page_size])
+        else:
+            h = self.get_history(domain, reverse=True)
+            total = len(h)
+            def get_page(offset):
+                return h[offset:offset + page_size]
+        skipping = cursor is not None
+        n, l = 0, max(1, float(total))
+        for offset in range(0, total, page_size):
+            page = get_page(offset)
+            rows = []
+            for tx_hash, height, conf, timestamp, value, balance in page:
+                timestamp_safe = timestamp
+                if timestamp is None:
+                    timestamp_safe = time.time()  # set it to "now" so below code doesn't explode.
+                if skipping:
+                    # skip up to and including the cursor item (or past its
+                    # timestamp, in case it has since left the history)
+                    if tx_hash == cursor[1]:
+                        skipping = False
+                        continue
+                    if timestamp_safe >= cursor[0]:
+                        continue
+                    skipping = False
+                if from_timestamp and timestamp_safe < from_timestamp:
+                    continue
+                if to_timestamp and timestamp_safe >= to_timestamp:
+                    continue
+                rows.append((tx_hash, height, conf, timestamp, timestamp_safe, value, balance))
+            prefetch_inputs([row[0] for row in rows])
+            for row in rows:
+                if progress_callback:
+                    progress_callback(min(n/l, 1.0))
+                n += 1
+                try:
+                    item = make_item(*row)
+                except MissingTx as e:
+                    self.print_error(str(e))
+                    continue
+                yield item
+            n = offset + page_size
+            page_txs.clear()
         if progress_callback:
             progress_callback(1.0)  # indicate done, just in case client code expects a 1.0 in order to detect completion
-        return out
 
     def get_label(self, tx_hash):
         label = self.labels.get(tx_hash, '')
@@ -2105,7 +2911,9 @@ class Abstract_Wallet(PrintError, SPVDelegate):
         for tx_hash in list(self.transactions):
             if tx_hash not in vr:
                 self.print_error("removing transaction", tx_hash)
-                self.transactions.pop(tx_hash)
+                with self.lock:
+                    self.transactions.pop(tx_hash)
+                    self._dirty_txs.add(tx_hash)
 
     def start_threads(self, network):
         self.network = network
@@ -2601,10 +3409,12 @@ class Abstract_Wallet(PrintError, SPVDelegate):
 
     def add_address(self, address):
         assert isinstance(address, Address)
-        self._addr_bal_cache.pop(address, None)  # paranoia, not really necessary -- just want to maintain the invariant that when we modify address history below we invalidate cache.
+        self._invalidate_addr_balance(address)  # paranoia, not really necessary -- just want to maintain the invariant that when we modify address history below we invalidate cache.
         self.invalidate_address_set_cache()
         if address not in self._history:
             self._history[address] = []
+            self._addr_status.pop(address, None)
+            self._dirty_addrs.add(address)
         if self.synchronizer:
             self.synchronizer.add(address)
         self.cashacct.on_address_addition(address)
@@ -2637,6 +3447,8 @@ class Abstract_Wallet(PrintError, SPVDelegate):
         do_addr_save = False
         with self.lock:
             self.transactions.clear(); self.unverified_tx.clear(); self.verified_tx.clear()
+            self._verified_heights.clear()
+            self._save_all = True
             self.clear_history()
             if isinstance(self, Standard_Wallet):
                 # reset the address list to default too, just in case. New synchronizer will pick up the addresses again.
@@ -2785,6 +3597,7 @@ class ImportedWalletBase(Simple_Wallet):
                 if addr == address:
                     for tx_hash, height in details:
                         transactions_to_remove.add(tx_hash)
+                        self._hist_dirty.add(tx_hash)
                         self.tx_addr_hist[tx_hash].discard(address)
                         if not self.tx_addr_hist.get(tx_hash):
                             self.tx_addr_hist.pop(tx_hash, None)
@@ -2793,14 +3606,18 @@ class ImportedWalletBase(Simple_Wallet):
                         transactions_new.add(tx_hash)
             transactions_to_remove -= transactions_new
             self._history.pop(address, None)
+            self._addr_status.pop(address, None)
+            self._dirty_addrs.add(address)
 
             for tx_hash in transactions_to_remove:
                 self.remove_transaction(tx_hash)
                 self.tx_fees.pop(tx_hash, None)
+                self._dirty_txs.add(tx_hash)
                 self.verified_tx.pop(tx_hash, None)
+                self._verified_heights.discard(tx_hash)
                 self.unverified_tx.pop(tx_hash, None)
                 self.transactions.pop(tx_hash, None)
-                self._addr_bal_cache.pop(address, None)  # not strictly necessary, above calls also have this side-effect. but here to be safe. :)
+                self._invalidate_addr_balance(address)  # not strictly necessary, above calls also have this side-effect. but here to be safe. :)
                 if self.verifier:
                     # TX is now gone. Toss its SPV proof in case we have it
                     # in memory. This allows user to re-add PK again and it
@@ -2990,6 +3807,10 @@ class ImportedPrivkeyWallet(ImportedWalletBase):
 
 class Deterministic_Wallet(Abstract_Wallet):
 
+    # State used by synchronize() to know when it needs to create addresses,
+    # (re)built by _init_gap_state(). None means it has to be rebuilt.
+    _gap_addr_index = None
+
     def __init__(self, storage):
         Abstract_Wallet.__init__(self, storage)
         self.gap_limit = storage.get('gap_limit', 20)
@@ -3006,12 +3827,79 @@ class Deterministic_Wallet(Abstract_Wallet):
     def get_seed(self, password):
         return self.keystore.get_seed(password)
 
+    def load_addresses(self):
+        super().load_addresses()
+        self.load_pubkey_cache()
+
+    def save_addresses(self):
+        super().save_addresses()
+        self.save_pubkey_cache()
+
+    # Number of pubkeys per 'pubkey_cache' storage entry
+    PUBKEY_CACHE_CHUNK = 64
+
+    def load_pubkey_cache(self):
+        ''' The pubkeys derived by the keystores are kept in the wallet file
+        so that looking up the keys of our addresses never needs EC math.
+
+        They are stored under 'pubkey_cache' as '<keystore>/xpub' and
+        '<keystore>/<branch>/<chunk>' entries, each chunk holding the hex of
+        PUBKEY_CACHE_CHUNK keys, so that deriving a new key only rewrites the
+        last chunk of its branch (see save_pubkey_cache). '''
+        saved = self.storage.get('pubkey_cache', {})
+        if not isinstance(saved, dict):
+            saved = {}
+        self._saved_pubkey_cache = saved
+        for i, k in enumerate(self.get_keystores()):
+            if not hasattr(k, 'load_pubkey_cache'):
+                continue
+            d = {'xpub': saved.get('%d/xpub' % i)}
+            for branch in ('0', '1'):
+                chunks = []
+                while True:
+                    chunk = saved.get('%d/%s/%d' % (i, branch, len(chunks)))
+                    if not isinstance(chunk, str):
+                        break
+                    chunks.append(chunk)
+                d[branch] = ''.join(chunks)
+            k.load_pubkey_cache(d)
+
+    def _pubkey_cache_entries(self):
+        entries = {}
+        size = self.PUBKEY_CACHE_CHUNK * 66
+        for i, k in enumerate(self.get_keystores()):
+            if not hasattr(k, 'dump_pubkey_cache'):
+                continue
+            d = k.dump_pubkey_cache()
+            entries['%d/xpub' % i] = d['xpub']
+            for branch in ('0', '1'):
+                h = d[branch]
+                for n, start in enumerate(range(0, len(h), size)):
+                    entries['%d/%s/%d' % (i, branch, n)] = h[start:start + size]
+        return entries
+
+    def save_pubkey_cache(self):
+        entries = self._pubkey_cache_entries()
+        saved = self._saved_pubkey_cache
+        changed = {key: value for key, value in entries.items() if saved.get(key) != value}
+        removed = [key for key in saved if key not in entries]
+        self.storage.put_items('pubkey_cache', changed, removed)
+        self._saved_pubkey_cache = entries
+
+    def get_address_index(self, address):
+        if self._gap_addr_index is not None:
+            idx = self._gap_addr_index.get(address)
+            if idx is not None:
+                return idx
+        return super().get_address_index(address)
+
     def add_seed(self, seed, pw):
         self.keystore.add_seed(seed, pw)
 
     def change_gap_limit(self, value):
         '''This method is not called in the code, it is kept for console use'''
         with self.lock:
+            self._gap_addr_index = None
             if value >= self.gap_limit:
                 self.gap_limit = value
                 self.storage.put('gap_limit', self.gap_limit)
@@ -3055,34 +3943,108 @@ class Deterministic_Wallet(Abstract_Wallet):
         return nmax + 1
 
     def create_new_address(self, for_change=False, save=True):
+        return self.create_new_addresses(for_change, 1, save=save)[0]
+
+    def create_new_addresses(self, for_change, count, save=True):
+        ''' Appends count new addresses to the chain and returns them. The
+        public keys are derived in one batch. '''
         for_change = bool(for_change)
         with self.lock:
             addr_list = self.change_addresses if for_change else self.receiving_addresses
-            n = len(addr_list)
-            x = self.derive_pubkeys(for_change, n)
-            address = self.pubkeys_to_address(x)
-            addr_list.append(address)
+            start = len(addr_list)
+            new_addresses = [self.pubkeys_to_address(x)
+                             for x in self.derive_pubkeys_range(for_change, start, count)]
+            for n, address in enumerate(new_addresses, start):
+                addr_list.append(address)
+                if self._gap_addr_index is not None:
+                    self._gap_addr_index[address] = (for_change, n)
             if save:
                 self.save_addresses()
-            self.add_address(address)
-            return address
+            for address in new_addresses:
+                self.add_address(address)
+            return new_addresses
 
-    def synchronize_sequence(self, for_change):
-        limit = self.gap_limit_for_change if for_change else self.gap_limit
-        while True:
+    def clear_history(self):
+        with self.lock:
+            super().clear_history()
+            self._gap_addr_index = None
+
+    def _init_gap_state(self):
+        ''' Builds the per-chain state synchronize() works from, out of the
+        address histories. Caller holds self.lock.
+
+        For each chain we keep the index of the last address that is known
+        to be old (see address_is_old), and for the used addresses past it,
+        the local height at which they will become old. '''
+        self._gap_addr_index = {}  # Address -> (for_change, n)
+        self._gap_old_index = {False: -1, True: -1}
+        self._gap_becomes_old = {False: {}, True: {}}  # n -> height
+        self._gap_height = None
+        self._gap_dirty = True
+        for for_change in (False, True):
             addresses = self.get_change_addresses() if for_change else self.get_receiving_addresses()
-            if len(addresses) < limit:
-                self.create_new_address(for_change, save=False)
+            for n, addr in enumerate(addresses):
+                self._gap_addr_index[addr] = (for_change, n)
+                hist = self._history.get(addr)
+                if hist:
+                    self._address_history_changed(addr, hist)
+
+    def _address_history_changed(self, addr, hist):
+        if self._gap_addr_index is None:
+            return
+        idx = self._gap_addr_index.get(addr)
+        if idx is None:
+            return
+        for_change, n = idx
+        if n <= self._gap_old_index[for_change]:
+            return
+        # an address is old once one of its tx's is more than 2 blocks deep
+        heights = [height for tx_hash, height in hist if height != 0]
+        if heights:
+            self._gap_becomes_old[for_change][n] = min(heights) + 2
+        else:
+            self._gap_becomes_old[for_change].pop(n, None)
+        self._gap_dirty = True
+
+    def _update_gap_height(self, height):
+        ''' Moves the addresses that are old at height out of
+        _gap_becomes_old. '''
+        self._gap_height = height
+        for for_change, pending in self._gap_becomes_old.items():
+            old = [n for n, h in pending.items() if h <= height]
+            if not old:
                 continue
-            if all(map(lambda a: not self.address_is_old(a), addresses[-limit:] )):
-                break
-            else:
-                self.create_new_address(for_change, save=False)
+            top = max(old)
+            self._gap_old_index[for_change] = max(top, self._gap_old_index[for_change])
+            for n in [n for n in pending if n <= top]:
+                del pending[n]
+            self._gap_dirty = True
+
+    def synchronize_sequence(self, for_change):
+        ''' Creates addresses until the last gap limit addresses of the
+        chain are all not old. '''
+        limit = self.gap_limit_for_change if for_change else self.gap_limit
+        addresses = self.get_change_addresses() if for_change else self.get_receiving_addresses()
+        wanted = self._gap_old_index[for_change] + 1 + limit
+        if len(addresses) < wanted:
+            self.create_new_addresses(for_change, wanted - len(addresses), save=False)
 
     def synchronize(self):
+        ''' Called on every tick of the synchronizer. Only does any work when
+        an address history or the local height has changed. '''
         with self.lock:
+            if self._gap_addr_index is None:
+                self._init_gap_state()
+            height = self.get_local_height()
+            if height != self._gap_height or self._gap_dirty:
+                # a history which is already old when it comes in moves the
+                # gap right away, not on the next block
+                self._update_gap_height(height)
+            if not self._gap_dirty:
+                return
             self.synchronize_sequence(False)
             self.synchronize_sequence(True)
+            self._gap_dirty = False
 
     def is_beyond_limit(self, address, is_change):
         with self.lock:
@@ -3149,6 +4111,9 @@ class Simple_Deterministic_Wallet(Simple_Wallet, Deterministic_Wallet):
     def derive_pubkeys(self, c, i):
         return self.keystore.derive_pubkey(c, i)
 
+    def derive_pubkeys_range(self, c, start, count):
+        return self.keystore.derive_pubkeys_range(c, start, count)
+
 
 
 
@@ -3184,6 +4149,10 @@ class Multisig_Wallet(Deterministic_Wallet):
     def derive_pubkeys(self, c, i):
         return [k.derive_pubkey(c, i) for k in self.get_keystores()]
 
+    def derive_pubkeys_range(self, c, start, count):
+        ranges = [k.derive_pubkeys_range(c, start, count) for k in self.get_keystores()]
+        return [list(pubkeys) for pubkeys in zip(*ranges)]
+
     def load_keystore(self):
         self.keystores = {}
         for i in range(self.n):
@@ -30,6 +30,7 @@ import json
 import os
 import shutil
 import sys
+import textwrap
 import threading
 import time
 import traceback
@@ -3722,41 +3723,16 @@ class ElectrumWindow(QMainWindow, MessageBoxMixin, PrintError):
         def task():
             def update_prog(x):
                 if dlg: dlg.update_progress(int(x*100))
-            return wallet.export_history(fx=self.fx,
-                                         show_addresses=include_addresses,
-                                         decimal_point=self.decimal_point,
-                                         fee_calc_timeout=timeout,
-                                         download_inputs=download_inputs,
-                                         progress_callback=update_prog)
-        success = False
-        def on_success(history):
-            nonlocal success
+            history = wallet.iter_history_export(fx=self.fx,
+                                                 show_addresses=include_addresses,
+                                                 decimal_point=self.decimal_point,
+                                                 fee_calc_timeout=timeout,
+                                                 download_inputs=download_inputs,
+                                                 progress_callback=update_prog)
             ccy = (self.fx and self.fx.get_currency()) or ''
-            has_fiat_columns = history and self.fx and self.fx.show_history() and 'fiat_value' in history[0] and 'fiat_balance' in history[0] and 'fiat_fee' in history[0]
-            lines = []
-            for item in history:
-                if is_csv:
-                    cols = [item['txid'], item.get('label', ''), item['confirmations'], item['value'], item['fee'], item['date']]
-                    if has_fiat_columns:
-                        cols += [item['fiat_value'], item['fiat_balance'], item['fiat_fee']]
-                    if include_addresses:
-                        inaddrs_filtered = (x for x in (item.get('input_addresses') or [])
-                                            if Address.is_valid(x))
-                        outaddrs_filtered = (x for x in (item.get('output_addresses') or [])
-                                             if Address.is_valid(x))
-                        cols.append( ','.join(inaddrs_filtered) )
-                        cols.append( ','.join(outaddrs_filtered) )
-                    lines.append(cols)
-                else:
-                    if has_fiat_columns and ccy:
-                        item['fiat_currency'] = ccy  # add the currency to each entry in the json. this wastes space but json is bloated anyway so this won't hurt too much, we hope
-                    elif not has_fiat_columns:
-                        # No need to include these fields as they will always be 'No Data'
-                        item.pop('fiat_value', None)
-                        item.pop('fiat_balance', None)
-                        item.pop('fiat_fee', None)
-                    lines.append(item)
-
+            has_fiat_columns = bool(self.fx and self.fx.show_history())
+            # Items are written out as they are produced, so that memory use
+            # doesn't grow with the size of the wallet history.
             with open(fileName, "w+", encoding="utf-8") as f:  # ensure encoding to utf-8. Avoid Windows cp1252. See #1453.
                 if is_csv:
                     transaction = csv.writer(f, lineterminator='\n')
@@ -3766,10 +3742,37 @@ class ElectrumWindow(QMainWindow, MessageBoxMixin, PrintError):
                     if include_addresses:
                         cols += ["input_addresses", "output_addresses"]
                     transaction.writerow(cols)
-                    for line in lines:
-                        transaction.writerow(line)
                 else:
-                    f.write(json.dumps(lines, indent=4))
+                    f.write('[')
+                n = 0
+                for item in history:
+                    if is_csv:
+                        cols = [item['txid'], item.get('label', ''), item['confirmations'], item['value'], item['fee'], item['date']]
+                        if has_fiat_columns:
+                            cols += [item.get('fiat_value', ''), item.get('fiat_balance', ''), item.get('fiat_fee', '')]
+                        if include_addresses:
+                            inaddrs_filtered = (x for x in (item.get('input_addresses') or [])
+                                                if Address.is_valid(x))
+                            outaddrs_filtered = (x for x in (item.get('output_addresses') or [])
+                                                 if Address.is_valid(x))
+                            cols.append( ','.join(inaddrs_filtered) )
+                            cols.append( ','.join(outaddrs_filtered) )
+                        transaction.writerow(cols)
+                    else:
+                        if has_fiat_columns and ccy:
+                            item['fiat_currency'] = ccy  # add the currency to each entry in the json. this wastes space but json is bloated anyway so this won't hurt too much, we hope
+                        elif not has_fiat_columns:
+                            # No need to include these fields as they will always be 'No Data'
+                            item.pop('fiat_value', None)
+                            item.pop('fiat_balance', None)
+                            item.pop('fiat_fee', None)
+                        f.write((',\n' if n else '\n') + textwrap.indent(json.dumps(item, indent=4), ' ' * 4))
+                    n += 1
+                if not is_csv:
+                    f.write('\n]' if n else ']')
+        success = False
+        def on_success(_result):
+            nonlocal success
             success = True
         # kick off the waiting dialog to do all of the above
         dlg = WaitingDialog(self.top_level_window(),